@@ -782,6 +782,15 @@ class KeepNote (object):
             "timestamp_formats",
             default=dict(keepnote.timestamp.DEFAULT_TIMESTAMP_FORMATS))
 
+        # durability level of written files, including these preferences
+        durability = self.pref.get("durability",
+                                   default=safefile.DURABILITY_DEFAULT)
+        try:
+            safefile.set_durability(durability)
+        except ValueError, e:
+            log_error(e, sys.exc_info()[2])
+            safefile.set_durability(safefile.DURABILITY_DEFAULT)
+
         # external apps
         self._load_external_app_preferences()
 
@@ -939,11 +948,16 @@ class KeepNote (object):
         return self._notebooks.itervalues()
 
     def save_notebooks(self, silent=False):
-        """Save all opened notebooks"""
+        """
+        Save all opened notebooks
+
+        Unless 'silent' (as for autosaves), wait until the notebooks are
+        written to disk.
+        """
 
         # save all the notebooks
         for notebook in self._notebooks.itervalues():
-            notebook.save()
+            notebook.save(wait=not silent)
 
     def get_node(self, nodeid):
         """Returns a node with 'nodeid' from any of the opened notebooks"""
@@ -958,7 +972,7 @@ class KeepNote (object):
     def save(self, silent=False):
         """Save notebooks and preferences"""
 
-        self.save_notebooks()
+        self.save_notebooks(silent)
 
         self.save_preferences()
 
@@ -1066,11 +1080,14 @@ class KeepNote (object):
     def run_external_app_node(self, app_key, node, kind, wait=False):
         """Runs an external application on a node"""
 
+        # node file to open, or None for the node dir
+        node_filename = None
         if kind == "dir":
             filename = node.get_path()
         else:
             if node.get_attr("content_type") == notebooklib.CONTENT_TYPE_PAGE:
                 # get html file
+                node_filename = notebooklib.PAGE_DATA_FILE
                 filename = node.get_data_file()
 
             elif node.get_attr("content_type") == notebooklib.CONTENT_TYPE_DIR:
@@ -1079,10 +1096,18 @@ class KeepNote (object):
 
             elif node.has_attr("payload_filename"):
                 # get payload file
-                filename = node.get_file(node.get_attr("payload_filename"))
+                node_filename = node.get_attr("payload_filename")
+                filename = node.get_file(node_filename)
             else:
                 raise KeepNoteError(_("Unable to determine note type."))
 
+        # the application may change the file in place
+        try:
+            node.unshare_file(node_filename)
+        except Exception, e:
+            raise KeepNoteError(_("Unable to prepare '%s' for editing.")
+                                % filename, e)
+
         #if not filename.startswith("http://"):
         #    filename = os.path.realpath(filename)
 
@@ -46,6 +46,7 @@ import keepnote
 from keepnote import unicode_gtk
 from keepnote.notebook import NoteBookError
 from keepnote import notebook as notebooklib
+from keepnote.notebook.connection.fs.paths import get_node_meta_file
 from keepnote import tasklib
 from keepnote import tarfile
 from keepnote.gui import extension, FileChooserDialog
@@ -199,7 +200,10 @@ def relpath(path, start):
         
 
 def nodeid2html_link(notebook, path, nodeid):
-    note = notebook.get_node_by_id(nodeid)
+    return node2html_link(path, notebook.get_node_by_id(nodeid))
+
+
+def node2html_link(path, note):
     if note:
         newpath = relpath(note.get_path(), path)
         if note.get_attr("content_type") == "text/xhtml+xml":
@@ -215,15 +219,15 @@ def nodeid2html_link(notebook, path, nodeid):
 
 def translate_links(notebook, path, node):
 
+    links = []
+
     def walk(node):
 
         if node.nodeType == node.ELEMENT_NODE and node.tagName == "a":
             url = node.getAttribute("href")
             if notebooklib.is_node_url(url):
                 host, nodeid = notebooklib.parse_node_url(url)
-                url2 = nodeid2html_link(notebook, path, nodeid)
-                if url2 != "":
-                    node.setAttribute("href", url2)
+                links.append((node, nodeid))
 
         
         # recurse
@@ -232,6 +236,13 @@ def translate_links(notebook, path, node):
 
     walk(node)
 
+    # lookup all linked nodes at once
+    notes = notebook.get_nodes_by_id([nodeid for node, nodeid in links])
+    for (node, nodeid), note in zip(links, notes):
+        url2 = node2html_link(path, note)
+        if url2 != "":
+            node.setAttribute("href", url2)
+
 
 def write_index(notebook, node, path):
 
@@ -357,12 +368,20 @@ font-weight: bold;
 
 """)
 
-    def walk(node):
+    # nodes whose children are being written
+    parents = []
+
+    for node in notebook.iter_subtree(node):
+
+        # close the children of finished nodes
+        while parents and parents[-1] is not node.get_parent():
+            parents.pop()
+            out.write(u"</div>\n")
 
         nodeid = node.get_attr("nodeid")
         expand = node.get_attr("expanded", False)
 
-        if len(node.get_children()) > 0:
+        if node.has_children():
             out.write(u"""<nobr><tt><a href='javascript: toggleDivName("%s", %s)'>+</a>&nbsp;</tt>""" %
                       (nodeid, [u"false", u"true"][int(expand)]))
         else:
@@ -376,15 +395,13 @@ font-weight: bold;
                       % (nodeid2html_link(notebook, rootpath, nodeid),
                          escape(node.get_title())))
 
-        if len(node.get_children()) > 0:
+        if node.has_children():
             out.write(u"<div id='%s' class='node%s'>" % 
                       (nodeid, [u"_collapsed", ""][int(expand)]))
+            parents.append(node)
 
-            for child in node.get_children():
-                walk(child)
-
-            out.write(u"</div>\n")
-    walk(node)
+    for parent in parents:
+        out.write(u"</div>\n")
 
     out.write(u"""</body></html>""")
     out.close()
@@ -413,11 +430,8 @@ def export_notebook(notebook, filename, task):
 
     # first count # of files
     nnodes = [0]
-    def walk(node):
+    for node in notebook.iter_subtree(prefetch=True):
         nnodes[0] += 1
-        for child in node.get_children():
-            walk(child)
-    walk(notebook)
 
     task.set_message(("text", "Exporting %d notes..." % nnodes[0]))
     nnodes2 = [0]
@@ -459,8 +473,10 @@ def export_notebook(notebook, filename, task):
         task.set_message(("detail", truncate_filename(path)))
         task.set_percent(nnodes2[0] / float(nnodes[0]))
 
-        skipfiles = set(child.get_basename()
-                        for child in node.get_children())
+        # child nodes are exported on their own
+        skipfiles = set(f for f in os.listdir(path)
+                        if os.path.exists(get_node_meta_file(
+                            os.path.join(path, f))))
 
         # make node directory
         os.mkdir(arcname)
@@ -480,13 +496,6 @@ def export_notebook(notebook, filename, task):
                 export_files(os.path.join(path, f),
                              os.path.join(arcname, f))
 
-        # recurse nodes
-        for child in node.get_children():
-            f = child.get_basename()
-            export_node(child,
-                        os.path.join(path, f),
-                        os.path.join(arcname, f))
-
     def export_files(path, arcname):
         # look for aborted export
         if task.aborted():
@@ -506,7 +515,14 @@ def export_notebook(notebook, filename, task):
                     export_files(os.path.join(path, f),
                                  os.path.join(arcname, f))
     
-    export_node(notebook, notebook.get_path(), filename, True)
+    rootpath = notebook.get_path()
+    export_node(notebook, rootpath, filename, True)
+    nodes = notebook.iter_subtree(prefetch=True)
+    next(nodes)
+    for node in nodes:
+        path = node.get_path()
+        export_node(node, path,
+                    os.path.join(filename, os.path.relpath(path, rootpath)))
 
     task.set_message(("text", "Closing export..."))
     task.set_message(("detail", ""))
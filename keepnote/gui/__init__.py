@@ -615,7 +615,12 @@ class KeepNote (keepnote.KeepNote):
             notebook.write_preferences()
 
     def save_notebooks(self, silent=False):
-        """Save all opened notebooks"""
+        """
+        Save all opened notebooks
+
+        Unless 'silent' (as for autosaves), wait until the notebooks are
+        written to disk.
+        """
 
         # clear all window and viewer info in notebooks
         for notebook in self._notebooks.itervalues():
@@ -628,7 +633,7 @@ class KeepNote (keepnote.KeepNote):
 
         # save all the notebooks
         for notebook in self._notebooks.itervalues():
-            notebook.save()
+            notebook.save(wait=not silent)
 
         # let windows know about completed save
         for window in self._windows:
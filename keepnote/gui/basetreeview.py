@@ -853,29 +853,31 @@ class KeepNoteBaseTreeView (gtk.TreeView):
         #nodes = [self._notebook.get_node_by_id(nodeid)
         #         for nodeid in nodeids]
 
-        if selection_data.target == MIME_NODE_CUT:
-            for node in nodes:
-                try:
-                    if node is not None:
-                        node.move(parent)
-                except:
-                    keepnote.log_error()
-
-        elif selection_data.target == MIME_TREE_COPY:
-            for node in nodes:
-                try:
-                    if node is not None:
-                        node.duplicate(parent, recurse=True)
-                except Exception:
-                    keepnote.log_error()
-
-        elif selection_data.target == MIME_NODE_COPY:
-            for node in nodes:
-                try:
-                    if node is not None:
-                        node.duplicate(parent)
-                except Exception:
-                    keepnote.log_error()
+        # deliver the changes of all pasted nodes at once
+        with self._notebook.batch_changes():
+            if selection_data.target == MIME_NODE_CUT:
+                for node in nodes:
+                    try:
+                        if node is not None:
+                            node.move(parent)
+                    except:
+                        keepnote.log_error()
+
+            elif selection_data.target == MIME_TREE_COPY:
+                for node in nodes:
+                    try:
+                        if node is not None:
+                            node.duplicate(parent, recurse=True)
+                    except Exception:
+                        keepnote.log_error()
+
+            elif selection_data.target == MIME_NODE_COPY:
+                for node in nodes:
+                    try:
+                        if node is not None:
+                            node.duplicate(parent)
+                    except Exception:
+                        keepnote.log_error()
 
     def _clear_selection_data(self, clipboard, data):
         """Callback for when Clipboard contents are reset"""
@@ -479,8 +479,8 @@ class RichTextEditor (KeepNoteEditor):
             results = []
 
             # TODO: clean up icon handling.
-            for nodeid, title in self._notebook.search_node_titles(text)[
-                    :self._maxlinks]:
+            for nodeid, title in self._notebook.search_node_titles(
+                    text, limit=self._maxlinks):
                 icon = self._notebook.get_attr_by_id(nodeid, "icon")
                 if icon is None:
                     icon = "note.png"
@@ -691,6 +691,13 @@ class RichTextEditor (KeepNoteEditor):
         # get image filename
         image_filename = menuitem.get_parent().get_child().get_filename()
         image_path = os.path.join(current_page.get_path(), image_filename)
+
+        # the editor may change the file in place
+        try:
+            current_page.unshare_file(image_filename)
+        except Exception, e:
+            self.emit("error", _("Could not edit image"), e)
+            return
         self._app.run_external_app("image_editor", image_path)
 
     def _on_resize_image(self, menuitem):
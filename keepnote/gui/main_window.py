@@ -651,6 +651,8 @@ class KeepNoteWindow (gtk.Window):
         # longer than usual.
         if notebook.index_needed():
             self.update_index(notebook)
+        elif notebook.start_refresh_index():
+            gobject.idle_add(notebook.refresh_index_step)
 
         return notebook
 
@@ -814,14 +816,15 @@ class KeepNoteWindow (gtk.Window):
             return
 
         def update(task):
-            # erase database first
-            # NOTE: I do this right now so that corrupt databases can be
-            # cleared out of the way.
+            # NOTE: a rebuild writes a fresh database, so that corrupt
+            # databases are cleared out of the way.
             if clear:
-                notebook.clear_index()
+                nodes = notebook.rebuild_index()
+            else:
+                nodes = notebook.index_all()
 
             try:
-                for node in notebook.index_all():
+                for node in nodes:
                     # terminate if search is canceled
                     if task.aborted():
                         break
@@ -1490,7 +1493,7 @@ class SearchBox (gtk.Entry):
         from threading import Lock
         from Queue import Queue
         queue = Queue()
-        lock = Lock()  # a mutex for the notebook (protect sqlite)
+        lock = Lock()  # a mutex for the notebook (protect node objects)
 
         # update gui with search result
         def search(task):
@@ -1535,11 +1538,28 @@ class SearchBox (gtk.Entry):
 
             # init search
             notebook = self._window.get_notebook()
+
+            def iter_ranked(text, page_size=50):
+                # fetch best matches first, one page at a time
+                offset = 0
+                while True:
+                    results = notebook.search_node_contents_ranked(
+                        text, limit=page_size, offset=offset)
+                    for node in notebook.get_nodes_by_id(
+                            [row[0] for row in results]):
+                        yield node
+                    if len(results) < page_size:
+                        break
+                    offset += page_size
+
             try:
-                nodes = (notebook.get_node_by_id(nodeid)
-                         for nodeid in
-                         notebook.search_node_contents(" ".join(words))
-                         if nodeid)
+                if notebook.has_fulltext_search():
+                    nodes = iter_ranked(" ".join(words))
+                else:
+                    nodes = (notebook.get_node_by_id(nodeid)
+                             for nodeid in notebook.search_node_contents(
+                                 " ".join(words))
+                             if nodeid)
             except:
                 keepnote.log_error()
 
@@ -1591,7 +1611,8 @@ class SearchBox (gtk.Entry):
 
         self.search_box_list.clear()
         if len(text) > 0:
-            results = self._window.get_notebook().search_node_titles(text)[:10]
+            results = self._window.get_notebook().search_node_titles(
+                text, limit=10)
             for nodeid, title in results:
                 self.search_box_list.append([title, nodeid])
 
@@ -398,8 +398,9 @@ class ThreePaneViewer (Viewer):
 
             # perform delete
             try:
-                for node in nodes:
-                    node.trash()
+                with self._notebook.batch_changes():
+                    for node in nodes:
+                        node.trash()
             except NoteBookError, e:
                 self.emit("error", e.msg, e)
 
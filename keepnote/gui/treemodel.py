@@ -357,7 +357,7 @@ class BaseTreeModel (gtk.GenericTreeModel):
         path = []
         node = rowref
         while node not in self._root_set:
-            path.append(node.get_attr("order"))
+            path.append(node.get_index())
             node = node.get_parent()
             if node is None:
                 raise Exception("treeiter is not part of model")
@@ -381,13 +381,13 @@ class BaseTreeModel (gtk.GenericTreeModel):
                 return self._roots[n+1]
 
         children = parent.get_children()
-        order = rowref.get_attr("order")
-        assert 0 <= order < len(children)
+        index = rowref.get_index()
+        assert 0 <= index < len(children)
 
-        if order == len(children) - 1:
+        if index == len(children) - 1:
             return None
         else:
-            return children[order+1]
+            return children[index+1]
 
     def on_iter_children(self, parent):
         """Returns the first child of a treeiter"""
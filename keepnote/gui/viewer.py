@@ -110,7 +110,7 @@ class Viewer (gtk.VBox):
             parent = self._notebook
 
         if pos == "sibling" and parent.get_parent() is not None:
-            index = parent.get_attr("order") + 1
+            index = parent.get_index() + 1
             parent = parent.get_parent()
         else:
             index = None
@@ -25,6 +25,10 @@
 #
 
 
+# python imports
+import time
+
+
 class Listeners (object):
     """Maintains a list of listeners (functions) that are called when the
        notify function is called.
@@ -69,3 +73,88 @@ class Listeners (object):
         else:
             for l in self._suppress:
                 self._suppress[l] -= 1
+
+
+class BatchListeners (Listeners):
+    """
+    Listeners whose notifications can be collected and delivered together
+
+    Between begin() and end() calls, notifications are collected, and the
+    outermost end() delivers them as one notification.  If a debounce
+    delay is set, notifications outside of begin() and end() are also
+    collected, until no more arrive for the delay.
+
+    merge -- function that is given a list of the argument tuples of
+             collected notifications and returns the argument tuple of
+             the notification to deliver
+    """
+
+    def __init__(self, merge):
+        Listeners.__init__(self)
+        self._merge = merge
+        self._depth = 0
+        self._pending = []
+        self._delay = 0
+        self._schedule = None
+        self._scheduled = False
+        self._last = 0
+
+    def begin(self):
+        """Begin collecting notifications"""
+        self._depth += 1
+
+    def end(self):
+        """End collecting notifications and deliver them if outermost"""
+        self._depth -= 1
+        if self._depth == 0:
+            self.flush()
+
+    def set_debounce(self, delay, schedule=None):
+        """
+        Set a delay in seconds for delivering notifications
+
+        schedule -- function schedule(delay, func) that calls func() once
+                    after 'delay' seconds, such as on the GUI main loop
+        A delay of 0 delivers notifications at once.
+        """
+        self._delay = delay if schedule else 0
+        self._schedule = schedule
+        if not self._delay and self._depth == 0:
+            self.flush()
+
+    def notify(self, *args):
+        """Notify listeners, or collect the notification"""
+        if self._depth == 0 and not self._delay:
+            Listeners.notify(self, *args)
+            return
+
+        self._pending.append(args)
+        if self._depth == 0:
+            self._last = time.time()
+            if not self._scheduled:
+                self._scheduled = True
+                self._schedule(self._delay, self._on_timeout)
+
+    def _on_timeout(self):
+        """Deliver notifications once none have arrived for the delay"""
+        self._scheduled = False
+        if not self._pending or self._depth > 0:
+            return False
+        wait = self._last + self._delay - time.time()
+        if wait > 0:
+            self._scheduled = True
+            self._schedule(wait, self._on_timeout)
+        else:
+            self.flush()
+        return False
+
+    def flush(self):
+        """Deliver any collected notifications at once"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        if len(pending) == 1:
+            args = pending[0]
+        else:
+            args = self._merge(pending)
+        Listeners.notify(self, *args)
@@ -25,17 +25,20 @@
 #
 
 # python imports
+import contextlib
 import mimetypes
 import os
 import sys
 import re
+import time
 import urlparse
 import urllib2
 import uuid
+import weakref
 import xml.etree.cElementTree as ET
 
 # keepnote imports
-from keepnote.listening import Listeners
+from keepnote.listening import Listeners, BatchListeners
 from keepnote.timestamp import get_timestamp
 from keepnote import trans
 from keepnote.notebook.connection import fs as connection_fs
@@ -93,6 +96,98 @@ NULL = object()
 # the node id of the implied root of all nodes everywhere
 UNIVERSAL_ROOT = u"b810760f-f246-4e42-aebb-50ce51c3d1ed"
 
+# spacing of the order keys of new siblings.  A node can be inserted
+# between two siblings without renumbering the others, as long as their
+# keys differ by more than one.
+ORDER_GAP = 1024
+
+# seconds of reindexing done by each NoteBook.refresh_index_step()
+REFRESH_STEP_TIME = .05
+
+
+#=============================================================================
+# node order keys
+
+
+def is_order(order):
+    """Returns True if 'order' is a usable order key"""
+    return (isinstance(order, (int, long)) and
+            not isinstance(order, bool) and
+            -sys.maxint < order < sys.maxint)
+
+
+def get_order_between(lower, upper):
+    """
+    Returns an order key between the keys 'lower' and 'upper'
+
+    Either key may be None for no bound.  Returns None if there is no
+    integer between the keys.
+    """
+    if lower is None and upper is None:
+        return 0
+    elif lower is None:
+        return upper - ORDER_GAP
+    elif upper is None:
+        return lower + ORDER_GAP
+    elif upper - lower > 1:
+        return (lower + upper) // 2
+    else:
+        return None
+
+
+#=============================================================================
+# node change notifications
+
+
+def coalesce_node_changes(actions):
+    """
+    Returns a minimal list of node change actions equivalent to 'actions'
+
+    Added and removed nodes become recursive changes of their parents,
+    since row positions reported during a batch are stale by the time
+    the batch is delivered.  Duplicate changes are merged, and changes
+    within a recursively changed node are dropped.
+    """
+    recurse = {}  # node -> True if changed recursively
+    order = []
+    for action in actions:
+        act = action[0]
+        if act == "changed":
+            node, rec = action[1], False
+        elif act == "changed-recurse":
+            node, rec = action[1], True
+        elif act == "added":
+            node, rec = action[1].get_parent(), True
+        elif act == "removed":
+            node, rec = action[1], True
+        else:
+            continue
+
+        if node is None or not node.is_valid():
+            continue
+        if node not in recurse:
+            recurse[node] = rec
+            order.append(node)
+        else:
+            recurse[node] = recurse[node] or rec
+
+    def subsumed(node):
+        parent = node.get_parent()
+        while parent is not None:
+            if recurse.get(parent):
+                return True
+            parent = parent.get_parent()
+        return False
+
+    return [("changed-recurse" if recurse[child] else "changed", child)
+            for child in order if not subsumed(child)]
+
+
+def merge_node_changes(pending):
+    """Merges several node_changed notifications into one"""
+    return (coalesce_node_changes(
+        [action for args in pending for action in args[0]]),)
+
 
 #=============================================================================
 # common filesystem functions
@@ -553,10 +648,38 @@ def iter_attr_tables(lst):
 
 BUILTIN_ATTR = ("nodeid", "parentids", "childrenids", "order")
 
+# attrs whose values are shared by many nodes
+INTERNED_ATTR = set(["content_type", "icon", "icon_open",
+                     "title_fgcolor", "title_bgcolor", "info_sort"])
+
+# (type, value) -> shared value
+_interned = {}
+
+
+def intern_attr(key, value=NULL):
+    """
+    Returns a shared copy of an attr key, or of its value if given
+
+    Only keys and the values of INTERNED_ATTR are shared, since there are
+    few distinct ones.  Other values are returned as is.
+    """
+    if value is NULL:
+        value = key
+    elif key not in INTERNED_ATTR:
+        return value
+    if not isinstance(value, basestring):
+        return value
+    return _interned.setdefault((type(value), value), value)
+
 
 class NoteBookNode (object):
     """A general base class for all nodes in a NoteBook"""
 
+    # many nodes may be loaded, so they have no __dict__
+    __slots__ = ["_notebook", "_conn", "_parent", "_children",
+                 "_has_children", "_index", "_valid", "_attr",
+                 "__weakref__"]
+
     def __init__(self, title=u"", parent=None, notebook=None,
                  content_type=CONTENT_TYPE_DIR, conn=None,
                  attr=None):
@@ -565,13 +688,22 @@ class NoteBookNode (object):
         self._parent = parent
         self._children = None
         self._has_children = None
+        self._index = None  # position among siblings, once they are loaded
         self._valid = True
 
         self._attr = {"version": NOTEBOOK_FORMAT_VERSION,
                       "title": title,
-                      "content_type": content_type}
+                      "content_type": intern_attr("content_type",
+                                                  content_type)}
         if attr:
-            self._attr.update(attr)
+            for key, value in attr.iteritems():
+                self._attr[intern_attr(key)] = intern_attr(key, value)
+
+            # share the nodeid of the parent
+            if parent is not None:
+                parentid = parent._attr.get("nodeid")
+                if self._attr.get("parentids") == [parentid]:
+                    self._attr["parentids"] = [parentid]
 
     def is_valid(self):
         """Returns True if node is valid (not deleted)"""
@@ -619,7 +751,7 @@ class NoteBookNode (object):
     def set_attr(self, name, value):
         """Set the value of an attribute"""
         oldvalue = self._attr.get(name, NULL)
-        self._attr[name] = value
+        self._attr[intern_attr(name)] = intern_attr(name, value)
         if value != oldvalue:
             self._set_dirty(True)
 
@@ -654,6 +786,14 @@ class NoteBookNode (object):
         """Returns the parent of the node"""
         return self._parent
 
+    def get_index(self):
+        """Returns the position of the node among its siblings"""
+        if self._parent is None:
+            return 0
+        if self._index is None:
+            self._parent.get_children()
+        return self._index
+
     def get_title(self):
         """Returns the display title of a node"""
         return self._attr.get("title", "")
@@ -704,7 +844,12 @@ class NoteBookNode (object):
 
     def create(self):
         """Initializes the node on disk (create required files/directories)"""
+        self._init_create_attr()
+        self._conn.create_node(self._attr["nodeid"], self._attr)
+        self._set_dirty(False)
 
+    def _init_create_attr(self):
+        """Initialize the attributes of a node that is about to be created"""
         if "nodeid" not in self._attr:
             self._attr["nodeid"] = new_nodeid()
         self._attr["parentids"] = [self._parent._attr["nodeid"]]
@@ -712,9 +857,7 @@ class NoteBookNode (object):
         self._attr.setdefault("order", sys.maxint)
 
         self._init_attr()
-
-        self._conn.create_node(self._attr["nodeid"], self._attr)
-        self._set_dirty(False)
+        self._notebook._nodes[self._attr["nodeid"]] = self
 
     def delete(self):
         """Deletes this node from the notebook"""
@@ -752,7 +895,7 @@ class NoteBookNode (object):
 
         # parent node notifies listeners of change
         self._notebook.node_changed.notify(
-            [("removed", self._parent, self._attr["order"])])
+            [("removed", self._parent, self._index)])
 
     def trash(self):
         """Places node in the notebook's trash folder"""
@@ -794,7 +937,7 @@ class NoteBookNode (object):
 
         assert self != parent
         old_parent = self._parent
-        #old_index = self._attr["order"]
+        #old_index = self._index
 
         # check whether move is allowed
         allowed, error = self._notebook.move_allowed(self, parent, index)
@@ -824,7 +967,7 @@ class NoteBookNode (object):
             self._parent = parent
             self._parent._add_child(self, index)
         else:
-            if self._attr["order"] < index:
+            if self._index < index:
                 index -= 1
             self._parent._add_child(self, index)
         self.save(True)
@@ -919,41 +1062,62 @@ class NoteBookNode (object):
         if skip is None:
             skip = set()
 
-        # create new node
-        node = parent._new_child(self.get_attr("content_type"),
-                                 self.get_attr("title", ""),
-                                 index=index)
-        skip.add(node)
+        # create new nodes in one batch
+        copies = []
+        node = self._duplicate(parent, index, recurse, skip, copies)
+        parent._conn.apply_batch([("create", copy._attr["nodeid"], copy._attr)
+                                  for orig, copy in copies])
+        for orig, copy in copies:
+            copy._set_dirty(False)
+
+        # copy files
+        for orig, copy in copies:
+            try:
+                sync.sync_files(orig._conn, orig._attr["nodeid"],
+                                copy._conn, copy._attr["nodeid"])
+            except:
+                keepnote.log_error()
+                # TODO: handle errors
+                pass
+
+        if notify:
+            parent.notify_change(True)
 
+        return node
+
+    def _duplicate(self, parent, index, recurse, skip, copies):
+        """
+        Make an uncreated copy of this node under a new parent
+
+        The pairs (original, copy) of this node and, if 'recurse' is True,
+        its descendants are appended to 'copies' in preorder.
+        """
         # copy attributes
+        attr = {}
         for key, value in self.iter_attr():
             if key not in ("nodeid", "order", "parentids", "childrenids"):
-                node._attr[key] = value
+                attr[key] = value
 
         # record the nodeid of the original node
-        node._attr["duplicate_of"] = self.get_attr("nodeid")
-
-        #node._conn.update_node(node._attr["nodeid"], node._attr)
-        node._write_attr(node._attr)
+        attr["duplicate_of"] = self.get_attr("nodeid")
 
-        # copy files
-        try:
-            sync.sync_files(self._conn, self._attr["nodeid"],
-                            node._conn, node._attr["nodeid"])
-        except:
-            keepnote.log_error()
-            # TODO: handle errors
-            pass
+        # make new node
+        parent.get_children()
+        node = NoteBookNode(self.get_attr("title", ""), parent=parent,
+                            notebook=parent._notebook,
+                            content_type=self.get_attr("content_type"),
+                            attr=attr)
+        node._children = []
+        parent._add_child(node, index)
+        node._init_create_attr()
+        skip.add(node)
+        copies.append((self, node))
 
         # TODO: prevent loops, copy paste within same tree.
         if recurse:
             for child in self.get_children():
                 if child not in skip:
-                    child.duplicate(node, recurse=True, notify=False,
-                                    skip=skip)
-
-        if notify:
-            parent.notify_change(True)
+                    child._duplicate(node, None, True, skip, copies)
 
         return node
 
@@ -998,6 +1162,36 @@ class NoteBookNode (object):
         self._children.sort(key=lambda x: x._attr.get("order", sys.maxint))
         self._set_child_order()
 
+    def _reload(self):
+        """Reread the attributes and children of a node changed on disk"""
+        self._attr.update(self._conn.read_node(self._attr["nodeid"]))
+        if self._children is None:
+            return
+
+        # keep the loaded children that still exist
+        old = dict((child._attr["nodeid"], child) for child in self._children)
+        children = []
+        for childid in self._attr["childrenids"]:
+            child = old.pop(childid, None)
+            if child is None:
+                try:
+                    child = self._notebook._read_node(childid, parent=self)
+                except:
+                    keepnote.log_error()
+                    continue
+            children.append(child)
+        self._children = children
+        self._children.sort(key=lambda x: x._attr.get("order", sys.maxint))
+        self._set_child_order()
+
+        # invalidate removed children
+        stack = old.values()
+        while stack:
+            node = stack.pop()
+            node._valid = False
+            if node._children is not None:
+                stack.extend(node._children)
+
     def _iter_children(self):
         """Iterate through children
            Returns temporary node objects
@@ -1010,10 +1204,41 @@ class NoteBookNode (object):
                 continue
 
     def _set_child_order(self):
-        """Ensures that child know their order in the children list"""
+        """
+        Ensures that children know their index, and that their order keys
+        increase along the children list
+
+        Children with missing or out of order keys are given keys between
+        those of their neighbours, so that the other children are not
+        changed.  If there is no room, all children are renumbered.
+        """
+        children = self._children
+        prev = None
+        for i, child in enumerate(children):
+            child._index = i
+            order = child._attr.get("order")
+            if is_order(order) and (prev is None or order > prev):
+                prev = order
+                continue
+
+            upper = (children[i+1]._attr.get("order")
+                     if i + 1 < len(children) else None)
+            if not is_order(upper) or (prev is not None and upper <= prev):
+                upper = None
+            order = get_order_between(prev, upper)
+            if order is None:
+                self._renumber_children()
+                return
+            child._attr["order"] = order
+            child._set_dirty(True)
+            prev = order
+
+    def _renumber_children(self):
+        """Give the children evenly spaced order keys"""
         for i, child in enumerate(self._children):
-            if child._attr.get("order") != i:
-                child._attr["order"] = i
+            child._index = i
+            if child._attr.get("order") != i * ORDER_GAP:
+                child._attr["order"] = i * ORDER_GAP
                 child._set_dirty(True)
 
     def _add_child(self, child, index=None):
@@ -1027,19 +1252,19 @@ class NoteBookNode (object):
         if self._children is None:
             self._get_children()
 
+        # the child gets a new order key between its neighbours
+        child._attr.pop("order", None)
         if index is not None:
             # insert child at index
             self._children.insert(index, child)
-            self._set_child_order()
         elif (self._notebook and len(self._children) > 0 and
               self._children[-1] == self._notebook.get_trash()):
             # append child before trash
             self._children.insert(len(self._children)-1, child)
-            self._set_child_order()
         else:
             # append child at end of list
-            child._attr["order"] = len(self._children)
             self._children.append(child)
+        self._set_child_order()
 
         child._set_dirty(True)
 
@@ -1091,6 +1316,13 @@ class NoteBookNode (object):
     def get_file(self, filename):
         return self._conn.get_file(self._attr["nodeid"], filename)
 
+    def unshare_file(self, filename=None):
+        """
+        Make a node file safe to change in place, such as by another
+        program (see NoteBookConnection.unshare_file)
+        """
+        return self._conn.unshare_file(self._attr["nodeid"], filename)
+
     def get_data_file(self):
         """
         Returns filename of data/text/html/etc
@@ -1201,6 +1433,8 @@ class NoteBook (NoteBookNode):
         self.pref = NoteBookPreferences()
         self._filename = None
         self._dirty = set()
+        self._nodes = weakref.WeakValueDictionary()  # nodeid -> loaded node
+        self._refresh = None  # iterator of a refresh in progress
         self._trash = None
         self.attr_defs = AttrDefs()
         self.attr_tables = AttrTables()
@@ -1213,7 +1447,7 @@ class NoteBook (NoteBookNode):
 
         # listeners
         self.listeners = {}
-        self.node_changed = Listeners()  # signature = (node, recurse)
+        self.node_changed = BatchListeners(merge_node_changes)  # (actions)
         self.closing_event = Listeners()
         self.close_event = Listeners()
 
@@ -1277,6 +1511,7 @@ class NoteBook (NoteBookNode):
 
         self._attr["nodeid"] = new_nodeid()
         self._init_attr()
+        self._nodes[self._attr["nodeid"]] = self
 
         self._conn.connect(filename)
         self._conn.create_node(self._attr["nodeid"],  self._attr)
@@ -1312,6 +1547,15 @@ class NoteBook (NoteBookNode):
                     if index_dir and os.path.exists(index_dir):
                         self._conn._set_index_file(
                             os.path.join(index_dir, notebook_index.INDEX_FILE))
+
+                    # write node attr in the background if requested
+                    if self.pref.get("write_behind", default=False):
+                        self._conn.set_write_behind(True)
+
+                    # durability level of written files
+                    durability = self.pref.get("durability", default=None)
+                    if durability:
+                        self._conn.set_durability(durability)
                 except:
                     pass
 
@@ -1328,6 +1572,7 @@ class NoteBook (NoteBookNode):
         attr = self._conn.read_node(self._conn.get_rootid())
         self._attr.update(attr)
         self._init_attr()
+        self._nodes[self._attr["nodeid"]] = self
 
         self._init_trash()
 
@@ -1337,8 +1582,13 @@ class NoteBook (NoteBookNode):
 
         self.notify_change(True)
 
-    def save(self, force=False):
-        """Recursively save any loaded nodes"""
+    def save(self, force=False, wait=False):
+        """
+        Recursively save any loaded nodes
+
+        wait -- if True, block until all saved nodes are written, even
+                when the connection writes them in the background
+        """
 
         # TODO: keepnote copy of old pref.  only save pref if its changed.
 
@@ -1356,17 +1606,85 @@ class NoteBook (NoteBookNode):
             for node in list(self._dirty):
                 node.save()
         self._conn.save()
+        if wait:
+            self._conn.sync()
 
         self._dirty.clear()
 
     def close(self, save=True):
         """Close notebook"""
         self.closing_event.notify(self, save)
+        self.stop_refresh_index()
         if save:
-            self.save()
+            self.save(wait=True)
         self._conn.close()
         self.close_event.notify(self)
 
+    def process_changes(self):
+        """
+        Reload nodes changed outside of KeepNote and notify listeners
+
+        Changes are collected by the connection, e.g. by the watcher of
+        NoteBookConnectionFS.start_watching().  Returns the loaded nodes
+        that were reloaded.
+        """
+        return self._reload_nodes(self._conn.process_changes())
+
+    def _reload_nodes(self, nodeids):
+        """
+        Reload the loaded nodes among 'nodeids' and notify listeners
+
+        Returns the nodes that were reloaded.
+        """
+        nodeids = set(nodeids)
+        if not nodeids:
+            return []
+
+        # find loaded nodes that changed, parents first
+        nodes = []
+        queue = [self]
+        for node in queue:
+            if node._attr.get("nodeid") in nodeids:
+                nodes.append(node)
+            if node._children is not None:
+                queue.extend(node._children)
+
+        reloaded = []
+        for node in nodes:
+            if not node._valid:
+                continue
+            try:
+                node._reload()
+            except connection.UnknownNode:
+                # node was removed, its parent drops it
+                continue
+            reloaded.append(node)
+
+        if reloaded:
+            self.node_changed.notify(
+                [("changed-recurse", node) for node in reloaded])
+        return reloaded
+
+    #===============================================
+    # batched change notifications
+
+    def begin_changes(self):
+        """Begin collecting node change notifications"""
+        self.node_changed.begin()
+
+    def end_changes(self):
+        """Deliver collected node change notifications as one"""
+        self.node_changed.end()
+
+    @contextlib.contextmanager
+    def batch_changes(self):
+        """Context in which node change notifications are delivered as one"""
+        self.begin_changes()
+        try:
+            yield
+        finally:
+            self.end_changes()
+
     def get_connection(self):
         """Returns the notebook connection"""
         return self._conn
@@ -1381,7 +1699,8 @@ class NoteBook (NoteBookNode):
         # conn.init_index(), so that the initial indexing properly
         # catches all the desired attr's
         self._conn.index_attr("icon", "TEXT")
-        self._conn.index_attr("title", "TEXT", index_value=True)
+        self._conn.index_attr("title", "TEXT", index_value=True,
+                              index_substring=True)
 
     #--------------------------------------
     # input/output
@@ -1437,13 +1756,41 @@ class NoteBook (NoteBookNode):
 
     def _read_node(self, nodeid, parent=None,
                    default_content_type=CONTENT_TYPE_DIR):
+        # a nodeid has only one loaded node
+        node = self._nodes.get(nodeid)
+        if node is not None and node._valid:
+            if parent is not None and node._parent is not parent:
+                self._reparent_node(node, parent)
+            return node
+
         attr = self._conn.read_node(nodeid)
+        return self._make_node(attr, parent, default_content_type)
+
+    def _reparent_node(self, node, parent):
+        """Attach a loaded node to the parent it was moved to on disk"""
+        nodeid = node._attr["nodeid"]
+        old_parent = node._parent
+        if old_parent is not None:
+            if nodeid in old_parent._attr["childrenids"]:
+                old_parent._attr["childrenids"].remove(nodeid)
+            old_parent._has_children = None
+            if (old_parent._children is not None and
+                    node in old_parent._children):
+                old_parent._children.remove(node)
+                old_parent._set_child_order()
+        node._parent = parent
+        node._attr.update(self._conn.read_node(nodeid))
+
+    def _make_node(self, attr, parent=None,
+                   default_content_type=CONTENT_TYPE_DIR):
+        """Returns a new node for attr read from the connection"""
         node = NoteBookNode(
             attr.get("title", DEFAULT_PAGE_NAME),
             parent=parent, notebook=self,
             content_type=attr.get("content_type", default_content_type),
             attr=attr)
         node._init_attr()
+        self._nodes[attr["nodeid"]] = node
 
         return node
 
@@ -1580,45 +1927,185 @@ class NoteBook (NoteBookNode):
             NOTEBOOK_META_DIR, NOTEBOOK_ICON_DIR, basename)
         self._conn.delete_file(self._attr["nodeid"], filename)
 
+    #================================================
+    # traversal
+
+    def iter_subtree(self, node=None, order="pre", prefetch=False):
+        """
+        Iterate through a node and all of its descendants
+
+        Unlike walking get_children(), nodes are not kept in the children
+        lists of their parents, so that a walk holds only the nodes on the
+        current path, and the attr of their unvisited children.  Nodes
+        whose children are already loaded are walked through those.
+
+        node     -- the root of the walk (default: the notebook)
+        order    -- "pre" to visit parents before their children, or
+                    "post" to visit them after
+        prefetch -- if True, the connection is asked to read ahead the
+                    nodes the walk will visit next
+        """
+        if order not in ("pre", "post"):
+            raise ValueError("unknown order '%s'" % order)
+        if node is None:
+            node = self
+
+        if order == "pre":
+            yield node
+        stack = [(node, self._iter_subtree_children(node, prefetch))]
+        while stack:
+            parent, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if order == "post":
+                    yield parent
+                continue
+
+            if order == "pre":
+                yield child
+            stack.append(
+                (child, self._iter_subtree_children(child, prefetch)))
+
+    def _iter_subtree_children(self, node, prefetch=False):
+        """Iterate through the children of a node for iter_subtree()"""
+        if node._children is not None:
+            for child in list(node._children):
+                yield child
+            return
+
+        # read the children that are not loaded in one batch
+        entries = [self._get_loaded_node(childid)
+                   for childid in node._attr["childrenids"]]
+        missing = [childid for childid, entry
+                   in zip(node._attr["childrenids"], entries)
+                   if entry is None]
+        if missing:
+            try:
+                attrs = iter(self._conn.read_nodes(missing))
+            except Exception:
+                attrs = None
+            for i, entry in enumerate(entries):
+                if entry is not None:
+                    continue
+                if attrs is not None:
+                    entries[i] = next(attrs)
+                    continue
+                # read the nodes one at a time to skip bad nodes
+                try:
+                    entries[i] = self._conn.read_node(
+                        node._attr["childrenids"][i])
+                except:
+                    keepnote.log_error()
+            entries = [entry for entry in entries if entry is not None]
+
+        def get_attr(entry):
+            return entry if isinstance(entry, dict) else entry._attr
+        entries.sort(key=lambda entry: get_attr(entry).get("order",
+                                                           sys.maxint))
+
+        if prefetch:
+            self._conn.prefetch_nodes(
+                [childid for entry in entries
+                 for childid in get_attr(entry).get("childrenids", ())])
+
+        # nodes are made as they are visited
+        entries.reverse()
+        while entries:
+            entry = entries.pop()
+            if isinstance(entry, dict):
+                entry = (self._get_loaded_node(entry["nodeid"]) or
+                         self._make_node(entry, parent=node))
+            yield entry
+
     #================================================
     # search
 
     def get_node_by_id(self, nodeid):
         """Lookup node by nodeid"""
+        node = self._get_loaded_node(nodeid)
+        if node is not None:
+            return node
+        return self._get_node_by_path(
+            nodeid, self._conn.get_node_path_by_id(nodeid))
 
-        # TODO: could make this more efficient by not loading all uncles
-        path = self._conn.get_node_path_by_id(nodeid)
-        if path is None:
-            keepnote.log_message("node %s not found\n" % nodeid)
-            return None
+    def get_nodes_by_id(self, nodeids):
+        """
+        Lookup many nodes by nodeid
 
-        def walk(node, path, i):
-            if i >= len(path):
-                return node
+        Paths are resolved with a single index query.  Returns a list of
+        nodes, with None for unknown nodeids.
+        """
+        nodes = [self._get_loaded_node(nodeid) for nodeid in nodeids]
+        missing = [nodeid for nodeid, node in zip(nodeids, nodes)
+                   if node is None]
+        if missing:
+            paths = self._conn.get_node_paths_by_id(missing)
+            for i, nodeid in enumerate(nodeids):
+                if nodes[i] is None:
+                    nodes[i] = self._get_node_by_path(
+                        nodeid, paths.get(nodeid))
+        return nodes
+
+    def _get_loaded_node(self, nodeid):
+        """Returns the loaded node of a nodeid or None"""
+        node = self._nodes.get(nodeid)
+        if node is not None and node._valid:
+            return node
+        return None
 
-            # search children
-            nodeid2 = path[i]
-            for child in node.get_children():
-                if child.get_attr("nodeid") == nodeid2:
-                    return walk(child, path, i+1)
+    def _get_node_by_path(self, nodeid, path):
+        """
+        Lookup node by its path of nodeids from the root
 
-            # node not found
-            keepnote.log_message("node %s not found\n" % str(path))
+        Only the node and its ancestors are loaded, not their siblings.
+        """
+        if path is None:
+            keepnote.log_message("node %s not found\n" % nodeid)
             return None
-        return walk(self._notebook, path[1:], 0)
+
+        node = self._notebook
+        for nodeid2 in path[1:]:
+            child = self._get_loaded_node(nodeid2)
+            if child is None and node._children is None and \
+                    nodeid2 in node._attr["childrenids"]:
+                # load the child alone.  If the children of the parent
+                # are loaded instead, they are all in the identity map.
+                try:
+                    child = self._read_node(nodeid2, parent=node)
+                except connection.UnknownNode:
+                    pass
+            if child is None:
+                keepnote.log_message("node %s not found\n" % str(path))
+                return None
+            node = child
+        return node
 
     def get_node_path_by_id(self, nodeid):
         """Lookup node path by nodeid"""
         return self._conn.get_node_path_by_id(nodeid)
 
-    def search_node_titles(self, text):
+    def get_node_paths_by_id(self, nodeids):
+        """Lookup the paths of many nodes at once"""
+        return self._conn.get_node_paths_by_id(nodeids)
+
+    def search_node_titles(self, text, limit=None):
         """Search nodes by title"""
-        return self._conn.search_node_titles(text)
+        return self._conn.search_node_titles(text, limit)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self._conn.search_node_contents(text)
 
+    def search_node_contents_ranked(self, text, limit=None, offset=0):
+        """
+        Search nodes by content and return ranked results
+
+        Returns a list of (nodeid, title, rank, snippet) ordered from best
+        to worst match.
+        """
+        return self._conn.search_node_contents_ranked(text, limit, offset)
+
     def has_fulltext_search(self):
         """Returns True if full text indexed search is availble"""
         return self._conn.index(["has_fulltext"])
@@ -1643,10 +2130,70 @@ class NoteBook (NoteBookNode):
     def clear_index(self):
         return self._conn.clear_index()
 
-    def index_all(self):
-        for node in self._conn.index_all():
+    def index_all(self, workers=0, processes=False):
+        for node in self._conn.index_all(workers=workers,
+                                         processes=processes):
             yield node
 
+    def rebuild_index(self):
+        for node in self._conn.rebuild_index():
+            yield node
+
+    def refresh_index(self):
+        for node in self._conn.refresh_index():
+            yield node
+
+    def start_refresh_index(self):
+        """
+        Start reindexing changes made to the notebook outside of KeepNote
+
+        The reindexing is done in slices by refresh_index_step(), which the
+        caller runs from its main loop, e.g. when idle.  Nodes read in the
+        meantime reindex their own changes.  Returns False if the notebook
+        needs a full reindex instead.
+        """
+        self.stop_refresh_index()
+        if (not isinstance(self._conn, connection_fs.NoteBookConnectionFS) or
+                self._conn.index_needed()):
+            return False
+        self._refresh = self._conn.refresh_index(steps=True)
+        return True
+
+    def refresh_index_step(self, timeout=REFRESH_STEP_TIME):
+        """
+        Reindex changes for about 'timeout' seconds
+
+        Loaded nodes that were reindexed are reloaded, and listeners are
+        notified.  Returns True if there is more to reindex.
+        """
+        if self._refresh is None:
+            return False
+
+        nodeids = []
+        more = True
+        end = time.time() + timeout
+        try:
+            # always make progress, even with no time left
+            nodeids.extend(self._refresh.next())
+            while time.time() < end:
+                nodeids.extend(self._refresh.next())
+        except StopIteration:
+            more = False
+        except Exception, e:
+            keepnote.log_error(e, sys.exc_info()[2])
+            more = False
+        if not more:
+            self._refresh = None
+
+        self._reload_nodes(nodeids)
+        return more
+
+    def stop_refresh_index(self):
+        """Stop any reindexing started by start_refresh_index()"""
+        refresh, self._refresh = self._refresh, None
+        if refresh is not None:
+            refresh.close()
+
     #===============================================
     # preferences
 
@@ -134,6 +134,18 @@ class NoteBookConnection (object):
         """Save any unsynced state"""
         pass
 
+    def sync(self):
+        """Wait until all saved state is written"""
+        pass
+
+    def process_changes(self):
+        """
+        Process changes made to the notebook outside of this connection
+
+        Returns the nodeids of changed nodes.
+        """
+        return []
+
     #======================
     # Node I/O API
 
@@ -149,6 +161,24 @@ class NoteBookConnection (object):
         """Read a node attr"""
         raise NotImplementedError("read_node")
 
+    def read_nodes(self, nodeids):
+        """
+        Read the attr of several nodes
+
+        Returns a list of attr in the order of 'nodeids'.  Raises errors as
+        read_node() does.  Connections may override this to read several
+        nodes faster than one call per node.
+        """
+        return [self.read_node(nodeid) for nodeid in nodeids]
+
+    def prefetch_nodes(self, nodeids):
+        """
+        Hint that nodes will be read soon
+
+        Connections may start reading them in the background.
+        """
+        pass
+
     def update_node(self, nodeid, attr):
         """Write node attr"""
         raise NotImplementedError("update_node")
@@ -161,6 +191,31 @@ class NoteBookConnection (object):
         """Returns True if node exists"""
         raise NotImplementedError("has_node")
 
+    def apply_batch(self, ops):
+        """
+        Apply a batch of node operations in order
+
+        ops -- list of (action, nodeid, attr), where action is "create",
+               "update", or "delete" (attr is ignored for "delete")
+
+        The batch stops at the first error.  Operations applied before it
+        are not undone.  Connections may override this to apply a batch
+        faster than one call per operation.
+        """
+        for action, nodeid, attr in ops:
+            self._apply_op(action, nodeid, attr)
+
+    def _apply_op(self, action, nodeid, attr):
+        """Apply one operation of a batch"""
+        if action == "create":
+            self.create_node(nodeid, attr)
+        elif action == "update":
+            self.update_node(nodeid, attr)
+        elif action == "delete":
+            self.delete_node(nodeid)
+        else:
+            raise ConnectionError("unknown batch action '%s'" % action)
+
     # TODO: can this be simplified with a search query?
     def get_rootid(self):
         """Returns nodeid of notebook root node"""
@@ -260,30 +315,41 @@ class NoteBookConnection (object):
         # TODO: make this plugable
 
         # built-in queries
-        # ["index_attr", key, (index_value)]
-        # ["search", "title", text]
+        # ["index_attr", key, (index_value), (index_substring)]
+        # ["search", "title", text, (limit)]
         # ["search_fulltext", text]
+        # ["search_fulltext_ranked", text, limit, offset]
         # ["has_fulltext"]
         # ["node_path", nodeid]
+        # ["node_paths", nodeids]
         # ["get_attr", nodeid, key]
 
         if query[0] == "index_attr":
-            index_value = query[3] if len(query) == 4 else False
-            return self.index_attr(query[1], query[2], index_value)
+            index_value = query[3] if len(query) >= 4 else False
+            index_substring = query[4] if len(query) >= 5 else False
+            return self.index_attr(query[1], query[2], index_value,
+                                   index_substring)
 
         elif query[0] == "search":
             assert query[1] == "title"
-            return self.search_node_titles(query[2])
+            limit = query[3] if len(query) >= 4 else None
+            return self.search_node_titles(query[2], limit)
 
         elif query[0] == "search_fulltext":
             return self.search_node_contents(query[1])
 
+        elif query[0] == "search_fulltext_ranked":
+            return self.search_node_contents_ranked(*query[1:])
+
         elif query[0] == "has_fulltext":
             return False
 
         elif query[0] == "node_path":
             return self.get_node_path_by_id(query[1])
 
+        elif query[0] == "node_paths":
+            return self.get_node_paths_by_id(query[1])
+
         elif query[0] == "get_attr":
             return self.get_attr_by_id(query[1], query[2])
 
@@ -300,26 +366,55 @@ class NoteBookConnection (object):
         elif query[0] == "index_all":
             return self.index_all()
 
+        elif query[0] == "rebuild":
+            return self.rebuild_index()
+
+        elif query[0] == "refresh":
+            return self.refresh_index()
+
     #---------------------------------
     # indexing/querying
     # TODO: perhaps deprecate this for generic index() calls
 
-    def index_attr(self, key, datatype, index_value=False):
+    def index_attr(self, key, datatype, index_value=False,
+                   index_substring=False):
         """Add indexing for an attribute"""
-        return self.index(["index_attr", key, datatype, index_value])
+        return self.index(["index_attr", key, datatype, index_value,
+                           index_substring])
 
-    def search_node_titles(self, text):
+    def search_node_titles(self, text, limit=None):
         """Search nodes by title"""
-        return self.index(["search", "title", text])
+        query = ["search", "title", text]
+        if limit is not None:
+            query.append(limit)
+        return self.index(query)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self.index(["search_fulltext", text])
 
+    def search_node_contents_ranked(self, text, limit=None, offset=0):
+        """
+        Search nodes by content and return ranked results
+
+        Returns a list of (nodeid, title, rank, snippet) ordered from best
+        to worst match.
+        """
+        return self.index(["search_fulltext_ranked", text, limit, offset])
+
     def get_node_path_by_id(self, nodeid):
         """Lookup node path by nodeid"""
         return self.index(["node_path", nodeid])
 
+    def get_node_paths_by_id(self, nodeids):
+        """
+        Lookup the paths of many nodes at once
+
+        Returns a dict mapping each nodeid to its path, or None if the node
+        is unknown.
+        """
+        return self.index(["node_paths", nodeids])
+
     def get_attr_by_id(self, nodeid, key):
         return self.index(["get_attr", nodeid, key])
 
@@ -337,9 +432,15 @@ class NoteBookConnection (object):
     def clear_index(self):
         return self.index(["clear_index"])
 
-    def index_all(self):
+    def index_all(self, workers=0, processes=False):
         return self.index(["index_all"])
 
+    def rebuild_index(self):
+        return self.index(["rebuild"])
+
+    def refresh_index(self):
+        return self.index(["refresh"])
+
     #================================
     # Filesystem-specific API (may not be supported by some connections)
 
@@ -356,6 +457,17 @@ class NoteBookConnection (object):
     def get_file(self, nodeid, filename, _path=None):
         raise NotImplementedError("get_file")
 
+    def unshare_file(self, nodeid, filename=None):
+        """
+        Make a node file safe to change in place, such as by another
+        program
+
+        Connections that store one copy of a file for several nodes give
+        the file its own copy.  If 'filename' is None, every file of the
+        node is unshared.
+        """
+        pass
+
 
 #=============================================================================
 # Connection registration
@@ -81,9 +81,13 @@ UPDATE: Perhaps at this time unmanaged changes to payload files are not
 
 
 # python imports
+import contextlib
+import errno
 import os
 import shutil
+import sys
 import re
+import threading
 from os.path import join
 
 # xml imports
@@ -98,12 +102,22 @@ import keepnote.notebook
 from keepnote.notebook.connection import ConnectionError
 from keepnote.notebook.connection import NodeExists
 from keepnote.notebook.connection import NoteBookConnection
+from keepnote.notebook.connection import UnknownFile
 from keepnote.notebook.connection import UnknownNode
+from keepnote.notebook.connection import path_join
 from keepnote.notebook.connection.fs import index as notebook_index
+from keepnote.notebook.connection.fs.attrcache import AttrCache
+from keepnote.notebook.connection.fs.attrcache import ATTR_CACHE_FILE
+from keepnote.notebook.connection.fs import blobstore
 from keepnote.notebook.connection.fs.file import FileFS
 from keepnote.notebook.connection.fs.file import get_node_filename
+from keepnote.notebook.connection.fs.namecache import NameCache
+from keepnote.notebook.connection.fs import watcher as notebook_watcher
 from keepnote.notebook.connection.fs.paths import get_node_meta_file
 from keepnote.notebook.connection.fs.paths import NODE_META_FILE
+from keepnote.notebook.connection.fs.readahead import ReadAhead
+from keepnote.notebook.connection.fs.statcache import StatCache
+from keepnote.notebook.connection.fs.writequeue import WriteQueue
 from keepnote.notebook.connection.index import AttrIndex
 
 
@@ -119,6 +133,11 @@ LOSTDIR = u"lost_found"
 ORPHANDIR = u"orphans"
 MAX_LEN_NODE_FILENAME = 40
 
+# indexed mtime of a node whose meta data file waits to be written.  It is
+# older than any directory, so that a write lost in a crash is reindexed
+# from disk when the notebook is next refreshed.
+PENDING_MTIME = 0.0
+
 
 #=============================================================================
 # filenaming scheme
@@ -202,6 +221,13 @@ def new_filename(conn, nodeid, new_filename, ext=u"", sep=u" ", number=2,
                  return_number=False, use_number=False, ensure_valid=True,
                  _path=None):
 
+    if isinstance(conn, NoteBookConnectionFS):
+        # use the connection's cache of directory names
+        return conn._new_filename(
+            nodeid, new_filename, ext=ext, sep=sep, number=number,
+            return_number=return_number, use_number=use_number,
+            ensure_valid=ensure_valid)
+
     filenames = list(conn.list_dir(nodeid,
                                    os.path.dirname(new_filename) + '/'))
     return new_filename_list(filenames, new_filename, ext=ext, sep=sep,
@@ -342,7 +368,7 @@ def read_attr(filename, set_extra=True):
     extra = {}
     for child in root:
         if child.tag == "dict":
-            attr = plist.load_etree(child)
+            attr = plist.load_element(child)
         elif child.tag == "version":
             extra['version'] = int(child.text)
         elif child.tag == "id":
@@ -359,15 +385,17 @@ def read_attr(filename, set_extra=True):
     return attr, extra
 
 
-def write_attr(filename, nodeid, attr):
+def write_attr(filename, nodeid, attr, durability=None):
     """
     Write a node meta file
 
-    filename -- a filename or stream
-    attr     -- attribute dict
+    filename   -- a filename or stream
+    attr       -- attribute dict
+    durability -- durability level of the written file (see safefile)
     """
     if isinstance(filename, basestring):
-        out = safefile.open(filename, "w", codec="utf-8")
+        out = safefile.open(filename, "w", codec="utf-8",
+                            durability=durability)
 
     # Ensure nodeid is consistent if given.
     nodeid2 = attr.get('nodeid')
@@ -390,165 +418,266 @@ def write_attr(filename, nodeid, attr):
 #=============================================================================
 # path cache
 
+class NodeFileStream (object):
+    """
+    A node file opened for writing
+
+    'on_close' is called once the file is closed, which is when the file
+    is renamed into the node's directory.
+    """
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def close(self):
+        self._stream.close()
+        if self._on_close:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+
 class PathCacheNode (object):
     """Cache information for a node"""
 
+    __slots__ = ["nodeid", "basename", "parent", "children",
+                 "children_complete", "path", "generation"]
+
     def __init__(self, nodeid, basename, parent):
         self.nodeid = nodeid
         self.basename = basename
         self.parent = parent
-        self.children = set()
+        self.children = None  # set of child nodes, created when needed
         self.children_complete = False
+        self.path = None  # memoized path, valid for 'generation'
+        self.generation = -1
+
+    def add_child(self, child):
+        if self.children is None:
+            self.children = set()
+        self.children.add(child)
+
+    def remove_child(self, child):
+        self.children.remove(child)
+
+    def iter_children(self):
+        return iter(self.children) if self.children else iter(())
 
 
 class PathCache (object):
     """
     An in-memory cache of filesystem paths for nodeids
+
+    Nodes memoize their paths.  Moving or renaming a node advances the
+    cache generation, which lazily invalidates all memoized paths.
+
+    The cache may be used by several threads.
     """
     def __init__(self, rootid=None, rootpath=u""):
         self._root_parent = object()
         self._nodes = {None: self._root_parent}
+        self._generation = 0
+        self._lock = threading.RLock()
 
         if rootid:
-            self.add(rootid, rootpath, self._root_parent)
+            self.add(rootid, rootpath, None)
 
     def clear(self):
         """Clears cache"""
-        self._nodes.clear()
-        self._nodes[None] = self._root_parent
+        with self._lock:
+            self._nodes.clear()
+            self._nodes[None] = self._root_parent
+            self._generation += 1
 
     def has_node(self, nodeid):
         """Returns True if node in cache"""
-        if nodeid is None:
-            return False
-        return nodeid in self._nodes
+        with self._lock:
+            if nodeid is None:
+                return False
+            return nodeid in self._nodes
 
     def get_path_list(self, nodeid):
         """
         Returns list representing a path for a nodeid
         Returns None if nodeid is not cached
         """
-        path_list = []
-        node = self._nodes.get(nodeid, None)
-
-        # node is not in cache
-        if node is None:
-            return None
+        with self._lock:
+            path_list = []
+            node = self._nodes.get(nodeid, None)
 
-        # node is in cache, return path list
-        while node is not self._root_parent:
+            # node is not in cache
             if node is None:
-                # path is not fully cached
                 return None
-            path_list.append(node.basename)
-            node = node.parent
-        path_list.reverse()
 
-        return path_list
+            # node is in cache, return path list
+            while node is not self._root_parent:
+                if node is None:
+                    # path is not fully cached
+                    return None
+                path_list.append(node.basename)
+                node = node.parent
+            path_list.reverse()
+
+            return path_list
 
     def get_path(self, nodeid):
         """
         Returns path for a nodeid
         Returns None if nodeid is not cached
         """
+        with self._lock:
+            node = self._nodes.get(nodeid, None)
 
-        path_list = []
-        node = self._nodes.get(nodeid, None)
-
-        # node is not in cache
-        if node is None:
-            return None
-
-        # node is in cache, return path list
-        while node is not self._root_parent:
+            # node is not in cache
             if node is None:
-                # path is not fully cached
                 return None
-            path_list.append(node.basename)
-            node = node.parent
-        path_list.reverse()
 
-        return os.path.join(*path_list)
+            generation = self._generation
+            if node.generation == generation:
+                return node.path
+
+            # find the closest ancestor with a current path
+            nodes = []
+            while node is not self._root_parent:
+                if node is None:
+                    # path is not fully cached
+                    return None
+                if node.generation == generation:
+                    break
+                nodes.append(node)
+                node = node.parent
+            path = None if node is self._root_parent else node.path
+
+            # memoize paths down to the node
+            for node in reversed(nodes):
+                if path is None:
+                    path = node.basename
+                else:
+                    path = os.path.join(path, node.basename)
+                node.path = path
+                node.generation = generation
+
+            return path
 
     def get_basename(self, nodeid):
         """
         Returns basename of path for a nodeid
         Returns None if nodeid is not cached
         """
-        node = self._nodes.get(nodeid, None)
-        if node:
-            return node.basename
-        else:
-            return None
+        with self._lock:
+            node = self._nodes.get(nodeid, None)
+            if node:
+                return node.basename
+            else:
+                return None
 
     def get_parentid(self, nodeid):
         """
         Returns parentid of a nodeid
         Returns None if nodeid is not cached
         """
-        node = self._nodes.get(nodeid, None)
-        if node and node.parent and node.parent is not self._root_parent:
-            return node.parent.nodeid
-        else:
-            return None
+        with self._lock:
+            node = self._nodes.get(nodeid, None)
+            if node and node.parent and node.parent is not self._root_parent:
+                return node.parent.nodeid
+            else:
+                return None
 
     def get_children(self, nodeid):
         """
-        Returns iterator of the child ids of a nodeid
+        Returns list of the child ids of a nodeid
         Returns None if nodeid is not cached or children have not been read
         """
-        node = self._nodes.get(nodeid)
-        if node and node.children_complete:
-            return (child.nodeid for child in node.children)
-        else:
-            return None
+        with self._lock:
+            node = self._nodes.get(nodeid)
+            if node and node.children_complete:
+                # copy the children, which other threads may change
+                return [child.nodeid for child in node.iter_children()]
+            else:
+                return None
 
     def set_children_complete(self, nodeid, complete):
-        node = self._nodes.get(nodeid, None)
-        if node:
-            node.children_complete = complete
+        with self._lock:
+            node = self._nodes.get(nodeid, None)
+            if node:
+                node.children_complete = complete
 
     def add(self, nodeid, basename, parentid):
         """Add a new nodeid, basename, and parentid to the cache"""
-
-        parent = self._nodes.get(parentid, None)
-        #if parent is 0:
-            # TODO: should I allow unknown parent?
-            #raise UnknownNode("unknown parent %s" %
-            #                  repr((basename, parentid, self._nodes)))
-        node = self._nodes.get(nodeid, None)
-        if node:
-            node.parent = parent
-            node.basename = basename
-        else:
-            node = self._nodes[nodeid] = PathCacheNode(
-                nodeid, basename, parent)
-        if parent and parent is not self._root_parent:
-            parent.children.add(node)
+        with self._lock:
+            parent = self._nodes.get(parentid, None)
+            #if parent is 0:
+                # TODO: should I allow unknown parent?
+                #raise UnknownNode("unknown parent %s" %
+                #                  repr((basename, parentid, self._nodes)))
+            node = self._nodes.get(nodeid, None)
+            if node:
+                if node.parent is not parent or node.basename != basename:
+                    if (node.parent and
+                            node.parent is not self._root_parent and
+                            node.parent is not parent):
+                        node.parent.remove_child(node)
+                    node.parent = parent
+                    node.basename = basename
+                    self._generation += 1
+            else:
+                node = self._nodes[nodeid] = PathCacheNode(
+                    nodeid, basename, parent)
+            if parent and parent is not self._root_parent:
+                parent.add_child(node)
 
     def remove(self, nodeid):
         """Remove a nodeid from the cache"""
-        if nodeid in self._nodes:
+        with self._lock:
+            if nodeid in self._nodes:
+                node = self._nodes.get(nodeid)
+                if node.parent and node.parent is not self._root_parent:
+                    node.parent.remove_child(node)
+                del self._nodes[nodeid]
+
+    def remove_subtree(self, nodeid):
+        """Remove a nodeid and all of its cached descendants"""
+        with self._lock:
             node = self._nodes.get(nodeid)
-            if node.parent and node.parent is not self._root_parent:
-                node.parent.children.remove(node)
-            del self._nodes[nodeid]
+            if node is None:
+                return
+            self.remove(nodeid)
+
+            stack = list(node.iter_children())
+            while len(stack) > 0:
+                node = stack.pop()
+                stack.extend(node.iter_children())
+                del self._nodes[node.nodeid]
 
     def move(self, nodeid, new_basename, parentid):
         """move nodeid to a new parent"""
-        node = self._nodes.get(nodeid, None)
-        parent = self._nodes.get(parentid, None)
+        with self._lock:
+            node = self._nodes.get(nodeid, None)
+            parent = self._nodes.get(parentid, None)
 
-        if node is not None:
-            if node.parent and node.parent is not self._root_parent:
-                node.parent.children.remove(node)
+            if node is not None:
+                if node.parent and node.parent is not self._root_parent:
+                    node.parent.remove_child(node)
 
-            node.parent = parent
-            node.basename = new_basename
+                node.parent = parent
+                node.basename = new_basename
+                self._generation += 1
 
-            if parent and parent is not self._root_parent:
-                # update cache
-                parent.children.add(node)
+                if parent and parent is not self._root_parent:
+                    # update cache
+                    parent.add_child(node)
 
 
 #=============================================================================
@@ -560,20 +689,34 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
     This base class enforces no attr schema.
     """
+
+    # whether the nodeid and version of node.xml are included in attr
+    _attr_set_extra = False
+
+    # whether parsed node.xml files are cached under NOTEBOOK_META_DIR
+    _attr_cache_enabled = True
+
     def __init__(self):
         NoteBookConnection.__init__(self)
 
         self._filename = None
         self._index = None
         self._path_cache = PathCache()
+        self._name_cache = NameCache()
+        self._stat_cache = StatCache()
         self._rootid = None
-        self._filefs = FileFS(self._get_node_path)
+        self._filefs = FileFS(self._get_node_path, self._stat_cache)
 
         self._index_file = None
+        self._attr_cache = None
+        self._write_queue = None
+        self._durability = None
+        self._watcher = None
+        self._read_ahead = ReadAhead()
+        self._local = threading.local()  # per-thread batch state
 
         # attributes to not write to disk, they can be derived
         self._attr_suppress = set(["parentids", "childrenids"])
-        self._attr_mask = maskdict.MaskDict({}, self._attr_suppress)
 
     #================================
     # Filesystem-specific API (may not be supported by some connections)
@@ -622,7 +765,7 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
     def _get_node_mtime(self, nodeid):
         """mtime (modification time) for nodeid"""
-        return os.stat(self._get_node_path(nodeid)).st_mtime
+        return self._stat_cache.get_mtime(self._get_node_path(nodeid))
 
     def _get_lostdir(self):
         return get_lostdir(self._filename)
@@ -654,15 +797,224 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         """Make a new connection"""
         self._filename = url
         self.init_index()
+        if self._attr_cache_enabled:
+            self._attr_cache = AttrCache(url, os.path.join(
+                url, NOTEBOOK_META_DIR, ATTR_CACHE_FILE),
+                stat=self._stat_cache.stat)
+        if os.path.isdir(self._get_blob_dir()) and blobstore.has_links():
+            self._filefs.blob_store = blobstore.BlobStore(
+                self._get_blob_dir())
 
     def close(self):
         """Close connection"""
+        self.stop_watching()
+        self._read_ahead.stop()
+        self.set_write_behind(False)
+        if self._durability == safefile.DURABILITY_RELAXED:
+            safefile.sync()
         self._index.close()
+        if self._attr_cache:
+            self._attr_cache.save()
+            self._attr_cache = None
+        self._name_cache.clear()
+        self._stat_cache.clear()
+        self._filefs.blob_store = None
         self._filename = None
 
     def save(self):
         """Save any unsynced state"""
         self._index.save()
+        if self._attr_cache:
+            self._attr_cache.save()
+
+    def sync(self):
+        """Wait until all saved state is written"""
+        if self._write_queue:
+            self._write_queue.flush()
+        if self._durability == safefile.DURABILITY_RELAXED:
+            safefile.sync()
+
+    def start_watching(self, on_change=None, polling=False,
+                       interval=notebook_watcher.POLL_INTERVAL):
+        """
+        Watch the notebook for changes made outside of KeepNote
+
+        Changes are collected in the background and applied by
+        process_changes().  inotify is used if available, otherwise (or if
+        'polling' is True) directory mtimes are scanned every 'interval'
+        seconds.
+
+        on_change -- if given, called from the watcher thread whenever
+                     changes are waiting to be processed
+        """
+        self.stop_watching()
+        self._watcher = notebook_watcher.make_watcher(
+            self._filename, self._index, self.get_rootid(),
+            on_change=on_change, polling=polling, interval=interval)
+        self._watcher.start()
+
+    def stop_watching(self):
+        """Stop watching the notebook for changes"""
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+
+    def get_watcher(self):
+        """Returns the current watcher or None"""
+        return self._watcher
+
+    def get_stat_cache(self):
+        """
+        Returns the cache of file stats
+
+        Its 'ttl' may be changed, and its 'count' and 'on_stat' hook
+        report the stats that reach the filesystem.
+        """
+        return self._stat_cache
+
+    def process_changes(self):
+        """
+        Reindex the node directories changed outside of KeepNote
+
+        Only the changed nodes and their added, removed, or renamed
+        children are reindexed.  Returns the nodeids of reindexed nodes.
+        """
+        if not self._watcher:
+            return []
+
+        # find the node directories containing the changes.  Parents are
+        # refreshed before their children.
+        paths = set()
+        for path in self._watcher.get_changes():
+            self._stat_cache.invalidate_tree(path)
+            while (not os.path.exists(get_node_meta_file(path)) and
+                   path.startswith(self._filename + os.path.sep)):
+                path = os.path.dirname(path)
+            paths.add(path)
+
+        reindexed = []
+        with self._index.writing():
+            for path in sorted(paths, key=lambda path: path.count(os.sep)):
+                try:
+                    self._refresh_path(path, reindexed)
+                except Exception, e:
+                    keepnote.log_error(e, sys.exc_info()[2])
+        return reindexed
+
+    def _refresh_path(self, path, reindexed):
+        """Reindex a node directory if it has changed on disk"""
+        metafile = get_node_meta_file(path)
+        if not os.path.exists(metafile):
+            # removed nodes are reindexed through their parents
+            return
+        attr, extra = self._read_attr(metafile)
+        nodeid = extra["nodeid"]
+
+        # determine parent
+        if path == self._filename:
+            parentid = None
+            basename = path
+        else:
+            parent_metafile = get_node_meta_file(os.path.dirname(path))
+            if not os.path.exists(parent_metafile):
+                return
+            parentid = self._read_attr(parent_metafile)[1]["nodeid"]
+            basename = os.path.basename(path)
+
+        mtime = max(get_path_mtime(path), get_path_mtime(metafile))
+        node = self._index.get_node(nodeid)
+        if node and mtime <= node["mtime"] and (
+                parentid is None or
+                (node["parentid"], node["basename"]) == (parentid, basename)):
+            # node is current, such as after changes made by KeepNote
+            return
+
+        self._path_cache.add(nodeid, basename, parentid)
+        self._path_cache.set_children_complete(nodeid, False)
+        children = self._index.refresh_node(
+            nodeid, parentid, path, attr, mtime, reindexed)
+        for childid, child_path in children:
+            self._path_cache.add(childid, os.path.basename(child_path), nodeid)
+
+    def set_durability(self, durability):
+        """
+        Set the durability level of written files
+
+        durability -- one of safefile.DURABILITY_LEVELS, or None for
+                      safefile's default
+        """
+        if (durability is not None and
+                durability not in safefile.DURABILITY_LEVELS):
+            raise ConnectionError("unknown durability level '%s'" %
+                                  durability)
+        self._durability = durability
+        self._filefs.durability = durability
+
+    def get_durability(self):
+        """Returns the durability level of written files"""
+        return self._durability
+
+    def set_write_behind(self, enabled=True):
+        """
+        Enable or disable write-behind of node attr
+
+        With write-behind, update_node() queues attr writes that only change
+        a node's meta data file.  A background thread writes them in batches.
+        Call sync() to wait for queued writes.
+        """
+        if enabled and self._write_queue is None:
+            self._write_queue = WriteQueue(self._write_attr_batch)
+        elif not enabled and self._write_queue is not None:
+            self._write_queue.close()
+            self._write_queue = None
+
+    def _get_blob_dir(self):
+        return os.path.join(self._filename, NOTEBOOK_META_DIR,
+                            blobstore.BLOB_DIR)
+
+    def set_blob_store(self, enabled=True):
+        """
+        Enable or disable the content-addressed store of node files
+
+        With the store, copied node files are hard links that share their
+        content, which costs no disk space and little time.  Files copied
+        from outside the notebook are stored once per distinct content.
+        The setting is kept with the notebook.  Disabling the store
+        removes the blobs and unshares the node files that are still
+        linked to each other, so every node file keeps its content.
+        Returns False if the platform has no hard links.
+        """
+        blob_dir = self._get_blob_dir()
+        if enabled:
+            if not blobstore.has_links():
+                return False
+            if not os.path.exists(blob_dir):
+                os.makedirs(blob_dir)
+            if self._filefs.blob_store is None:
+                self._filefs.blob_store = blobstore.BlobStore(blob_dir)
+        else:
+            self._filefs.blob_store = None
+            if os.path.exists(blob_dir):
+                # files linked only to their blob are no longer shared
+                shutil.rmtree(blob_dir)
+                blobstore.unshare_tree(self._filename)
+                self._stat_cache.clear()
+        return True
+
+    def get_blob_store(self):
+        """Returns the store of node files or None if it is disabled"""
+        return self._filefs.blob_store
+
+    def collect_garbage(self):
+        """
+        Remove the stored blobs that no node file refers to
+
+        Returns the number of blobs removed and the bytes they freed.
+        """
+        if self._filefs.blob_store is None:
+            return 0, 0
+        self.sync()
+        return self._filefs.blob_store.collect_garbage()
 
     #======================
     # Node I/O API
@@ -700,13 +1052,14 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         parentid = parentids[0] if parentids else None
 
         # Determine path.
+        parent_path = None
         if _path:
             path = _path
         elif parentid:
             # Make path using parent and title.
             parent_path = self._get_node_path(parentid)
             title = attr.get("title", _("New Page"))
-            path = get_valid_unique_filename(parent_path, title)
+            path = self._get_unique_filename(parent_path, title)
         else:
             # Use an orphandir since no parent exists.
             path = self._get_orphandir(nodeid)
@@ -716,8 +1069,22 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
         # Make directory and write attr
         try:
+            with self._keep_index_current(parentid):
+                if parent_path:
+                    try:
+                        self._make_node_dir(parent_path, path)
+                    except OSError, e:
+                        if e.errno != errno.EEXIST:
+                            raise
+                        # the name was taken since the directory was
+                        # listed, such as within the same mtime tick
+                        self._name_cache.discard(parent_path)
+                        path = self._get_unique_filename(parent_path, title)
+                        self._make_node_dir(parent_path, path)
+                else:
+                    os.makedirs(path)
+                self._stat_cache.invalidate_tree(path)
             attr_file = self._get_node_attr_file(nodeid, path)
-            os.makedirs(path)
             self._write_attr(attr_file, nodeid, attr)
 
         except OSError, e:
@@ -731,11 +1098,75 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         # Update cache and index.
         basename = os.path.basename(path) if parentid else path
         self._path_cache.add(nodeid, basename, parentid)
-        self._index.add_node(nodeid, parentid, basename, attr,
-                             mtime=get_path_mtime(path))
+        mtime = self._stat_cache.get_mtime(path, fresh=True)
+        self._index.add_node(nodeid, parentid, basename, attr, mtime=mtime)
 
         return nodeid
 
+    def _get_unique_filename(self, path, title):
+        """Returns a valid and unique path for a node within a directory"""
+        return self._name_cache.get_unique_filename(
+            path, get_valid_filename(title))
+
+    def _make_node_dir(self, parent_path, path):
+        """Make a node directory picked by _get_unique_filename()"""
+        with self._name_cache.changing(
+                parent_path, added=os.path.basename(path)):
+            os.makedirs(path)
+
+    def _move_node_dir(self, path, new_path):
+        """Move a node directory, keeping the cached names current"""
+        parent_path, old_basename = os.path.split(path)
+        new_parent_path, basename = os.path.split(new_path)
+        if parent_path == new_parent_path:
+            with self._name_cache.changing(
+                    parent_path, added=basename, removed=old_basename):
+                os.rename(path, new_path)
+        else:
+            with self._name_cache.changing(
+                    parent_path, removed=old_basename):
+                with self._name_cache.changing(
+                        new_parent_path, added=basename):
+                    os.rename(path, new_path)
+
+    def _new_filename(self, nodeid, filename, ext=u"", sep=u" ", number=2,
+                      return_number=False, use_number=False,
+                      ensure_valid=True):
+        """Returns a unique new filename within a node"""
+        if ext is None:
+            filename, ext = os.path.splitext(filename)
+        if ensure_valid:
+            filename = get_valid_filename(filename)
+
+        if "/" in filename:
+            dirname, basename = filename.rsplit("/", 1)
+        else:
+            dirname, basename = u"", filename
+        path = self._get_node_path(nodeid)
+        if dirname:
+            path = get_node_filename(path, dirname)
+
+        try:
+            fullname, number = self._name_cache.get_unique_filename(
+                path, basename, ext, sep, number,
+                return_number=True, use_number=use_number)
+        except OSError:
+            raise UnknownFile("cannot find directory '%s/' of node '%s'" %
+                              (dirname, nodeid))
+        fullname = path_join(dirname, os.path.basename(fullname))
+
+        if return_number:
+            return fullname, number
+        else:
+            return fullname
+
+    def _discard_names(self, nodeid, filename, path=None):
+        """Forget the cached names of the directory of a node file"""
+        if path is None:
+            path = self._get_node_path(nodeid)
+        filename = get_node_filename(path, filename.rstrip("/"))
+        self._name_cache.discard(os.path.dirname(filename))
+
     def _clean_attr(self, nodeid, attr):
         """
         Ensure attributes follow the notebook schema.
@@ -778,11 +1209,71 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         parentid = self._get_parentid(nodeid)
         return self._read_node(parentid, path, _force_index=_force_index)
 
+    def prefetch_nodes(self, nodeids):
+        """
+        Read the meta data files of nodes ahead on a background thread
+
+        Only nodes whose paths are cached are read ahead.
+        """
+        filenames = []
+        for nodeid in nodeids:
+            path = self._path_cache.get_path(nodeid)
+            if path is not None:
+                filenames.append(get_node_meta_file(path))
+        if filenames:
+            self._read_ahead.add(filenames)
+
     def has_node(self, nodeid):
         """Returns True if node exists"""
         return (self._path_cache.has_node(nodeid) or
                 (self._index and self._index.has_node(nodeid)))
 
+    def apply_batch(self, ops):
+        """
+        Apply a batch of node operations in order
+
+        The index is updated in one transaction, and the indexed mtimes of
+        changed node directories are updated once at the end of the batch.
+        """
+        if (self._index is None or
+                getattr(self._local, "mtimes", None) is not None):
+            # the batch creates the root, or is nested in another batch
+            return NoteBookConnection.apply_batch(self, ops)
+
+        # The batch holds the index transaction, which the write-behind
+        # thread needs to finish its writes.  Writes queued before the
+        # batch are flushed first, and the batch writes its own directly.
+        if self._write_queue:
+            self._write_queue.flush()
+
+        self._local.mtimes = {}
+        try:
+            with self._index.writing():
+                try:
+                    for action, nodeid, attr in ops:
+                        self._apply_op(action, nodeid, attr)
+                finally:
+                    self._update_deferred_mtimes()
+                    self._index.commit()
+        finally:
+            self._local.mtimes = None
+
+    def _update_deferred_mtimes(self):
+        """Update the indexed mtimes deferred by a batch"""
+        for nodeid, current in self._local.mtimes.iteritems():
+            if not current:
+                continue
+            try:
+                path = self._get_node_path(nodeid)
+            except UnknownNode:
+                # node was deleted in the batch
+                continue
+            try:
+                mtime = self._stat_cache.get_mtime(path, fresh=True)
+            except OSError:
+                continue
+            self._index.set_node_mtime(nodeid, mtime)
+
     def update_node(self, nodeid, attr):
         """Write node attr"""
 
@@ -790,10 +1281,7 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
         # Clean attributes.
         self._clean_attr(nodeid, attr)
-
-        # write attrs
         path = self._get_node_path(nodeid)
-        self._write_attr(get_node_meta_file(path), nodeid, attr)
 
         # Determine possible path changes due to node moves or title renaming.
 
@@ -812,26 +1300,48 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
         if parentid != parentid2:
             # Move to a new parent.
-            self._rename_node_dir(nodeid, attr, parentid, parentid2, path)
+            # Only the node's own row changes, since descendants refer to
+            # it by nodeid.  Its text only changes if it was also retitled.
+            self.sync()
+            self._write_attr(get_node_meta_file(path), nodeid, attr)
+            self._rename_node_dir(
+                nodeid, attr, parentid, parentid2, path,
+                fulltext=(title_index != attr.get("title", u"")))
         elif (parentid and title_index and
               title_index != attr.get("title", u"")):
             # Rename node directory, but
             # do not rename root node dir (parentid is None).
+            self.sync()
+            self._write_attr(get_node_meta_file(path), nodeid, attr)
             self._rename_node_dir(nodeid, attr, parentid, parentid2, path)
+        elif (self._write_queue and
+              getattr(self._local, "mtimes", None) is None):
+            # Update index now, and write attrs in the background.  The
+            # node is indexed as pending until its attrs are written.  The
+            # write is queued within the index transaction, so that the
+            # writer sees the pending node along with its write.
+            basename = os.path.basename(path)
+            with self._index.writing():
+                self._index.add_node(nodeid, parentid2, basename, attr,
+                                     mtime=PENDING_MTIME)
+                self._write_queue.put(nodeid, attr)
         else:
-            # Update index.
+            # Write attrs and update index.
+            self._write_attr(get_node_meta_file(path), nodeid, attr)
             basename = os.path.basename(path)
+            mtime = self._stat_cache.get_mtime(path, fresh=True)
             self._index.add_node(nodeid, parentid2, basename, attr,
-                                 mtime=get_path_mtime(path))
+                                 mtime=mtime)
 
-    def _rename_node_dir(self, nodeid, attr, parentid, new_parentid, path):
+    def _rename_node_dir(self, nodeid, attr, parentid, new_parentid, path,
+                         fulltext=True):
         """Renames a node directory to resemble attr['title']"""
 
         if new_parentid is not None:
             # try to pick a path that closely resembles the title
             title = attr.get("title", _("New Page"))
             new_parent_path = self._get_node_path(new_parentid)
-            new_path = get_valid_unique_filename(new_parent_path, title)
+            new_path = self._get_unique_filename(new_parent_path, title)
             basename = os.path.basename(new_path)
         else:
             # make orphan
@@ -839,42 +1349,65 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
             basename = new_path
 
         try:
-            os.rename(path, new_path)
+            # update parents too
+            with self._keep_index_current(parentid):
+                with self._keep_index_current(new_parentid):
+                    try:
+                        self._move_node_dir(path, new_path)
+                    except OSError, e:
+                        if (new_parentid is None or
+                                e.errno not in (errno.EEXIST,
+                                                errno.ENOTEMPTY)):
+                            raise
+                        # the name was taken since the directory was
+                        # listed, such as within the same mtime tick
+                        self._name_cache.discard(new_parent_path)
+                        new_path = self._get_unique_filename(
+                            new_parent_path, title)
+                        basename = os.path.basename(new_path)
+                        self._move_node_dir(path, new_path)
+                    self._stat_cache.invalidate_tree(path)
+                    self._stat_cache.invalidate_tree(new_path)
         except Exception, e:
             raise ConnectionError(
                 _(u"Cannot rename '%s' to '%s'" % (path, new_path)), e)
 
         # update index
+        if self._attr_cache:
+            self._attr_cache.move_tree(path, new_path)
+        self._name_cache.discard_tree(path)
         self._path_cache.move(nodeid, basename, new_parentid)
+        mtime = self._stat_cache.get_mtime(new_path, fresh=True)
         self._index.add_node(nodeid, new_parentid, basename, attr,
-                             mtime=get_path_mtime(new_path))
-
-        # update parent too
-        if parentid:
-            self._index.set_node_mtime(
-                parentid, get_path_mtime(os.path.dirname(path)))
-        if new_parentid and new_parentid != parentid:
-            self._index.set_node_mtime(
-                new_parentid, get_path_mtime(new_parent_path))
+                             mtime=mtime, fulltext=fulltext)
 
     def delete_node(self, nodeid):
         """Delete node"""
 
         # TODO: will need code that orphans any children of nodeid
         path = self._get_node_path(nodeid)
-        if not os.path.exists(path):
+        if not self._stat_cache.exists(path):
             raise UnknownNode()
+        parentid = self._get_parentid(nodeid)
+        self.sync()
 
         try:
-            shutil.rmtree(path)
+            # update parent too
+            with self._keep_index_current(parentid):
+                parent_path, basename = os.path.split(path)
+                with self._name_cache.changing(parent_path, removed=basename):
+                    self._stat_cache.invalidate_tree(path)
+                    shutil.rmtree(path)
         except Exception, e:
             raise ConnectionError(
                 _(u"Do not have permission to delete"), e)
 
-        # TODO: remove from index entire subtree
-
-        self._path_cache.remove(nodeid)
-        self._index.remove_node(nodeid)
+        # remove entire subtree from index
+        if self._attr_cache:
+            self._attr_cache.remove_tree(path)
+        self._name_cache.discard_tree(path)
+        self._path_cache.remove_subtree(nodeid)
+        self._index.remove_subtree(nodeid)
 
     def get_rootid(self):
         """Returns nodeid of notebook root node"""
@@ -906,7 +1439,7 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
         for filename in files:
             path2 = os.path.join(path, filename)
-            if os.path.exists(get_node_meta_file(path2)):
+            if self._stat_cache.exists(get_node_meta_file(path2)):
                 try:
                     yield self._read_node(nodeid, path2, _full=_full)
                 except ConnectionError, e:
@@ -924,21 +1457,19 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         if children is not None:
             return children
 
-        #path = self._get_node_path(nodeid)
-        #
-        # Disabled for now.  Don't rely on index for listing children
         # if node is unchanged on disk (same mtime),
         # use index to detect children
         # however we also require a fully updated index (not index_needed)
-        #if _index and self._index and not self._index.index_needed():
-        #    mtime = get_path_mtime(path)
-        #    index_mtime = self._index.get_node_mtime(nodeid)
-        #    if mtime <= index_mtime:
-        #        children = []
-        #        for row in self._index.list_children(nodeid):
-        #            self._path_cache.add(row[0], row[1], nodeid)
-        #            children.append(row[0])
-        #        return children
+        if _index and self._index and not self._index.index_needed():
+            path = self._get_node_path(nodeid) if _path is None else _path
+            current, mtime = self._node_index_current(nodeid, path)
+            if current:
+                children = []
+                for childid, basename in self._index.list_children(nodeid):
+                    self._path_cache.add(childid, basename, nodeid)
+                    children.append(childid)
+                self._path_cache.set_children_complete(nodeid, True)
+                return children
 
         # fallback to reading attrs of children
         return (attr["nodeid"]
@@ -946,7 +1477,18 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
                     nodeid, _path, _full=False))
 
     def _read_attr(self, metafile):
-        return read_attr(metafile, set_extra=False)
+        """Read a node meta data file, using the attr cache if possible"""
+        cached = self._attr_cache.get(metafile) if self._attr_cache else None
+        if cached is not None:
+            attr, extra = cached
+        else:
+            attr, extra = read_attr(metafile, set_extra=False)
+            if self._attr_cache:
+                self._attr_cache.set(metafile, attr, extra)
+
+        if self._attr_set_extra:
+            attr.update(extra)
+        return attr, extra
 
     def _read_node(self, parentid, path, _full=True, _force_index=False):
         """
@@ -958,6 +1500,10 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         metafile = get_node_meta_file(path)
         attr, extra = self._read_attr(metafile)
         nodeid = extra['nodeid']
+        if self._write_queue and self._write_queue.is_pending(nodeid):
+            # read the attr that were last saved
+            self.sync()
+            attr, extra = self._read_attr(metafile)
 
         # Clean attr and rewrite them if needed.
         if not self._clean_attr(nodeid, attr):
@@ -971,7 +1517,8 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         if _force_index:
             # reindex this node
             self._index.add_node(
-                nodeid, parentid, basename, attr, get_path_mtime(path))
+                nodeid, parentid, basename, attr,
+                self._stat_cache.get_mtime(path, fresh=True))
         else:
             # if node has changed on disk (newer mtime), then re-index it
             current, mtime = self._node_index_current(nodeid, path)
@@ -989,33 +1536,59 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
         return attr
 
-    def _node_index_current(self, nodeid, path, mtime=None):
+    def _node_index_current(self, nodeid, path, mtime=None, fresh=False):
         if mtime is None:
-            mtime = get_path_mtime(path)
+            mtime = self._stat_cache.get_mtime(path, fresh)
         index_mtime = self._index.get_node_mtime(nodeid)
         return mtime <= index_mtime, mtime
 
+    @contextlib.contextmanager
+    def _keep_index_current(self, nodeid, path=None):
+        """
+        Keep the indexed mtime of a node current while its directory is
+        changed within this context
+
+        The indexed mtime is only updated if it was current beforehand,
+        so that earlier unmanaged changes are still detected.
+        """
+        if nodeid is None or not self._index:
+            yield
+            return
+
+        if path is None:
+            path = self._get_node_path(nodeid)
+
+        mtimes = getattr(self._local, "mtimes", None)
+        if mtimes is not None:
+            # within a batch, check a node once and update it at the end
+            if nodeid not in mtimes:
+                mtimes[nodeid] = self._node_index_current(
+                    nodeid, path, fresh=True)[0]
+            try:
+                yield
+            finally:
+                self._stat_cache.invalidate(path)
+            return
+
+        current = self._node_index_current(nodeid, path, fresh=True)[0]
+        try:
+            yield
+        finally:
+            self._stat_cache.invalidate(path)
+        if current:
+            self._index.set_node_mtime(
+                nodeid, self._stat_cache.get_mtime(path, fresh=True))
+
     def _reindex_node(self, nodeid, parentid, path, attr, mtime, warn=True):
         """Reindex a node that has been tampered"""
         if warn:
             keepnote.log_message(
                 u"Unmanaged change detected. Reindexing '%s'\n" % path)
 
-        # TODO: to prevent a full recurse I could index children but
-        # use 0 for mtime, so that they will still trigger an index for them
-        # selves
-        # reindex all children in case their parentid's changed
-        #for path2 in iter_child_node_paths(path):
-        #    attr2 = self._read_node(nodeid, path2, _full=False,
-        #                            _force_index=True)
-            #self._index.add_node(
-            #    attr2["nodeid"], nodeid,
-            #    os.path.basename(path2), attr2,
-            #    get_path_mtime(path2))
-
-        # reindex this node
-        self._index.add_node(
-            nodeid, parentid, os.path.basename(path), attr, mtime)
+        # reindex this node and any children added, removed, or renamed
+        # in its directory.  The children check their own directories
+        # when they are read.
+        self._index.refresh_node(nodeid, parentid, path, attr, mtime)
 
     def _get_node_attr_file(self, nodeid, path=None):
         """Returns the meta file for the node"""
@@ -1023,36 +1596,88 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
     def _write_attr(self, filename, nodeid, attr):
         """Write a node meta data file"""
-        self._attr_mask.set_dict(attr)
+        if self._attr_cache:
+            self._attr_cache.remove(filename)
 
         try:
-            write_attr(filename, nodeid, self._attr_mask)
+            write_attr(filename, nodeid,
+                       maskdict.MaskDict(attr, self._attr_suppress),
+                       durability=self._durability)
         except Exception, e:
             raise
             raise ConnectionError(
                 _("Cannot write meta data" + " " + filename + ":" + str(e)), e)
+        finally:
+            # the file and its node directory have changed
+            self._stat_cache.invalidate(filename)
+
+    def _write_attr_batch(self, nodes):
+        """
+        Write the meta data files of many nodes
+
+        nodes -- list of (nodeid, attr)
+
+        This is called by the write-behind thread.  Written nodes that are
+        still indexed as pending, and not queued again, become current.
+        """
+        with self._index.writing():
+            for nodeid, attr in nodes:
+                try:
+                    path = self._get_node_path(nodeid)
+                    self._write_attr(get_node_meta_file(path), nodeid, attr)
+                    if (self._index.get_node_mtime(nodeid) == PENDING_MTIME
+                            and not self._write_queue.is_queued(nodeid)):
+                        self._index.set_node_mtime(
+                            nodeid,
+                            self._stat_cache.get_mtime(path, fresh=True))
+                except Exception, e:
+                    keepnote.log_error(e, sys.exc_info()[2])
 
     #===============
     # file API
 
     def open_file(self, nodeid, filename, mode="r", codec=None, _path=None):
         """Open a node file."""
-        path = self._filefs.get_node_path(nodeid)
+        if mode != "r":
+            self._discard_names(nodeid, filename, _path)
+        if mode == "r" or not self._index:
+            # reading does not change the node directory
+            return self._filefs.open_file(
+                nodeid, filename, mode=mode, codec=codec, _path=_path)
+
+        # writing changes the directory mtime once the file is closed.
+        # update the indexed mtime then, but only if it was previously
+        # consistent (before the open).
+        path = self._get_node_path(nodeid) if _path is None else _path
+        current = self._node_index_current(nodeid, path, fresh=True)[0]
         stream = self._filefs.open_file(
             nodeid, filename, mode=mode, codec=codec, _path=_path)
 
-        # TODO: this should check and update the mtime
-        # but only update if it was previously consistent (before the open)
-        # update mtime since file creation causes directory mtime to change
-        if self._index:
-            self._index.set_node_mtime(nodeid, os.stat(path).st_mtime)
+        def on_close():
+            self._stat_cache.invalidate(get_node_filename(path, filename))
+            self._stat_cache.invalidate(path)
+            if current and self._index:
+                self._index.set_node_mtime(
+                    nodeid, self._stat_cache.get_mtime(path, fresh=True))
+        return NodeFileStream(stream, on_close)
 
-        return stream
+    def unshare_file(self, nodeid, filename=None, _path=None):
+        """
+        Make a node file safe to change in place, such as by another
+        program, by copying it if it shares its content with other files
+
+        If 'filename' is None, every file under the node directory is
+        unshared.
+        """
+        with self._keep_index_current(nodeid, _path):
+            self._filefs.unshare_file(nodeid, filename, _path=_path)
 
     def delete_file(self, nodeid, filename, _path=None):
         """Delete a node file."""
-        self._filefs.delete_file(
-            nodeid, filename, _path=_path)
+        self._discard_names(nodeid, filename, _path)
+        with self._keep_index_current(nodeid, _path):
+            self._filefs.delete_file(
+                nodeid, filename, _path=_path)
 
     def list_dir(self, nodeid, filename="/", _path=None):
         """
@@ -1064,7 +1689,9 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
     def create_dir(self, nodeid, filename, _path=None):
         """Create directory within node."""
-        return self._filefs.create_dir(nodeid, filename, _path=_path)
+        self._discard_names(nodeid, filename, _path)
+        with self._keep_index_current(nodeid, _path):
+            return self._filefs.create_dir(nodeid, filename, _path=_path)
 
     def has_file(self, nodeid, filename, _path=None):
         """Return True is file exists."""
@@ -1073,8 +1700,13 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
     def move_file(self, nodeid1, filename1, nodeid2, filename2,
                   _path1=None, _path2=None):
         """Rename a node file."""
-        return self._filefs.move_file(nodeid1, filename1, nodeid2, filename2,
-                                      _path1=_path1, _path2=_path2)
+        self._discard_names(nodeid1, filename1, _path1)
+        self._discard_names(nodeid2, filename2, _path2)
+        with self._keep_index_current(nodeid1, _path1):
+            with self._keep_index_current(nodeid2, _path2):
+                return self._filefs.move_file(
+                    nodeid1, filename1, nodeid2, filename2,
+                    _path1=_path1, _path2=_path2)
 
     def copy_file(self, nodeid1, filename1, nodeid2, filename2,
                   _path1=None, _path2=None):
@@ -1083,8 +1715,11 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
 
         If nodeid is None, filename is assumed to be a local file.
         """
-        self._filefs.copy_file(nodeid1, filename1, nodeid2, filename2,
-                               _path1=_path1, _path2=_path2)
+        if nodeid2 is not None:
+            self._discard_names(nodeid2, filename2, _path2)
+        with self._keep_index_current(nodeid2, _path2):
+            self._filefs.copy_file(nodeid1, filename1, nodeid2, filename2,
+                                   _path1=_path1, _path2=_path2)
 
     #---------------------------------
     # index management
@@ -1102,7 +1737,7 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
     def clear_index(self):
         return self._index.clear()
 
-    def index_all(self):
+    def index_all(self, workers=0, processes=False):
 
         # clear memory cache too
         self._path_cache.clear()
@@ -1111,7 +1746,27 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         # TODO: index orphans
         # may need private method to iterate orphans
 
-        for node in self._index.index_all():
+        for node in self._index.index_all(workers=workers,
+                                          processes=processes):
+            yield node
+
+    def rebuild_index(self):
+
+        # clear memory cache too
+        self._path_cache.clear()
+        self._path_cache.add(self.get_rootid(), self._filename, None)
+
+        for node in self._index.rebuild():
+            yield node
+
+    def refresh_index(self, steps=False):
+        """
+        Reindex the nodes changed on disk outside of KeepNote
+
+        steps -- if True, yield a list of reindexed nodeids per directory
+                 checked, instead of each nodeid
+        """
+        for node in self._index.refresh(steps=steps):
             yield node
 
     def _get_index_file(self):
@@ -1143,7 +1798,8 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         else:
             return NoteBookConnection.index(self, query)
 
-    def index_attr(self, key, datatype, index_value=False):
+    def index_attr(self, key, datatype, index_value=False,
+                   index_substring=False):
 
         if isinstance(datatype, basestring):
             index_type = datatype
@@ -1157,16 +1813,21 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
             raise Exception("unknown attr datatype '%s'" % repr(datatype))
 
         self._index.add_attr(AttrIndex(key, index_type,
-                                       index_value=index_value))
+                                       index_value=index_value,
+                                       index_substring=index_substring))
 
-    def search_node_titles(self, text):
+    def search_node_titles(self, text, limit=None):
         """Search nodes by title"""
-        return self._index.search_titles(text)
+        return self._index.search_titles(text, limit)
 
     def search_node_contents(self, text):
         """Search nodes by content"""
         return self._index.search_contents(text)
 
+    def search_node_contents_ranked(self, text, limit=None, offset=0):
+        """Search nodes by content and return ranked results"""
+        return self._index.search_contents_ranked(text, limit, offset)
+
     def has_fulltext_search(self):
         return self._index.has_fulltext_search()
 
@@ -1177,6 +1838,10 @@ class BaseNoteBookConnectionFS (NoteBookConnection):
         """Lookup node by nodeid"""
         return self._index.get_node_path(nodeid)
 
+    def get_node_paths_by_id(self, nodeids):
+        """Lookup the paths of many nodes at once"""
+        return self._index.get_node_paths(nodeids)
+
     def get_attr_by_id(self, nodeid, key):
         return self._index.get_attr(nodeid, key)
 
@@ -1192,8 +1857,8 @@ class NoteBookConnectionFS (BaseNoteBookConnectionFS):
       - parentids
       - childrenids
     """
-    def _read_attr(self, metafile):
-        return read_attr(metafile, set_extra=True)
+
+    _attr_set_extra = True
 
     def _clean_attr(self, nodeid, attr):
         """
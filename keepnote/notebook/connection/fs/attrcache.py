@@ -0,0 +1,208 @@
+"""
+
+    KeepNote
+    Cache of parsed node attributes
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+import marshal
+import os
+import threading
+
+# keepnote imports
+import keepnote
+from keepnote import safefile
+from keepnote.orderdict import OrderDict
+
+
+# attr cache filename
+ATTR_CACHE_FILE = u"attr.cache"
+ATTR_CACHE_VERSION = 1
+
+# types that marshal stores as themselves
+_SIMPLE_TYPES = (basestring, bool, int, long, float, type(None))
+
+
+def encode_attr(value):
+    """
+    Encode attr values into values marshal can store
+
+    Dicts become tuples of (key, value) pairs, which keeps their key order.
+    Raises TypeError for values that cannot be stored.
+    """
+    if isinstance(value, _SIMPLE_TYPES):
+        return value
+    elif isinstance(value, dict):
+        return tuple((key, encode_attr(val))
+                     for key, val in value.iteritems())
+    elif isinstance(value, list):
+        return [encode_attr(item) for item in value]
+    else:
+        raise TypeError("cannot cache value of type %s" % type(value))
+
+
+def decode_attr(value):
+    """Decode attr values stored by encode_attr()"""
+    if isinstance(value, tuple):
+        return OrderDict(iter([(key, decode_attr(val))
+                               for key, val in value]))
+    elif isinstance(value, list):
+        return [decode_attr(item) for item in value]
+    else:
+        return value
+
+
+class AttrCache (object):
+    """
+    A cache of parsed node meta data files
+
+    Entries are keyed by the path of the meta data file relative to the
+    notebook and are valid only while the file keeps the same inode, size,
+    and mtime.  The entire cache is stored in a single marshal file.
+
+    The cache may be used by several threads.
+
+    stat -- the function used to stat meta data files
+    """
+
+    def __init__(self, rootpath, filename, stat=os.stat):
+        self._rootpath = rootpath
+        self._filename = filename
+        self._stat = stat
+        self._entries = None  # loaded lazily
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def _key(self, metafile):
+        """Returns the cache key of a meta data file"""
+        prefix = self._rootpath + os.path.sep
+        if metafile.startswith(prefix):
+            return metafile[len(prefix):]
+        return metafile
+
+    def _load(self):
+        """Load the cache file"""
+        self._entries = {}
+        self._dirty = False
+        if not os.path.exists(self._filename):
+            return
+
+        try:
+            with open(self._filename, "rb") as infile:
+                version, entries = marshal.load(infile)
+            if version == ATTR_CACHE_VERSION:
+                self._entries = entries
+        except Exception, e:
+            # a damaged cache is rebuilt from the meta data files
+            keepnote.log_message(u"discarding attr cache '%s': %s\n" %
+                                 (self._filename, e))
+
+    def get(self, metafile):
+        """
+        Returns (attr, extra) for a meta data file, or None if the file
+        is not cached or has changed
+        """
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            entry = self._entries.get(self._key(metafile))
+        if entry is None:
+            return None
+
+        try:
+            stat = self._stat(metafile)
+        except OSError:
+            return None
+        if entry[0] != (stat.st_ino, stat.st_size, stat.st_mtime):
+            return None
+
+        return decode_attr(entry[1]), decode_attr(entry[2])
+
+    def set(self, metafile, attr, extra):
+        """Store the parsed attr and extra of a meta data file"""
+        key = self._key(metafile)
+        try:
+            stat = self._stat(metafile)
+            entry = ((stat.st_ino, stat.st_size, stat.st_mtime),
+                     encode_attr(attr), encode_attr(extra))
+        except (OSError, TypeError):
+            entry = None
+
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            if entry is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = entry
+            self._dirty = True
+
+    def remove(self, metafile):
+        """Remove the entry of a meta data file"""
+        with self._lock:
+            if self._entries is not None:
+                if self._entries.pop(self._key(metafile), None) is not None:
+                    self._dirty = True
+
+    def remove_tree(self, path):
+        """Remove the entries of all meta data files under a directory"""
+        prefix = self._key(path) + os.path.sep
+        with self._lock:
+            if self._entries is None:
+                return
+            for key in self._entries.keys():
+                if key.startswith(prefix):
+                    del self._entries[key]
+                    self._dirty = True
+
+    def move_tree(self, path, new_path):
+        """Rename the entries of all meta data files under a directory"""
+        prefix = self._key(path) + os.path.sep
+        new_prefix = self._key(new_path) + os.path.sep
+        with self._lock:
+            if self._entries is None:
+                return
+            for key in self._entries.keys():
+                if key.startswith(prefix):
+                    self._entries[new_prefix + key[len(prefix):]] = \
+                        self._entries.pop(key)
+                    self._dirty = True
+
+    def save(self):
+        """Write the cache file if it has changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            if not os.path.exists(os.path.dirname(self._filename)):
+                return
+
+            try:
+                # the cache can always be rebuilt, so it need not be durable
+                out = safefile.open(self._filename, "wb",
+                                    durability=safefile.DURABILITY_RELAXED)
+                marshal.dump((ATTR_CACHE_VERSION, self._entries), out)
+                out.close()
+                self._dirty = False
+            except Exception, e:
+                keepnote.log_error(e)
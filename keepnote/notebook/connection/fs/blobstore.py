@@ -0,0 +1,269 @@
+"""
+
+    KeepNote
+    Content-addressed store of node files
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+import filecmp
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+
+
+# blob store directory, within the notebook meta data directory
+BLOB_DIR = u"blobs"
+
+# bytes hashed at a time
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def has_links():
+    """Returns True if the platform supports hard links"""
+    return hasattr(os, "link")
+
+
+def hash_file(filename):
+    """Returns the content digest of a file"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as infile:
+        while True:
+            data = infile.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def unshare(filename):
+    """
+    Replace a file linked to other files by a copy of its own
+
+    This is needed before a file is changed in place.  Returns True if
+    the file was copied.
+    """
+    st = os.stat(filename)
+    if st.st_nlink <= 1:
+        return False
+    fd, tmp = tempfile.mkstemp(".tmp", os.path.basename(filename) + "_",
+                               dir=os.path.dirname(filename))
+    os.close(fd)
+    try:
+        shutil.copyfile(filename, tmp)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.rename(tmp, filename)
+    except:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def unshare_tree(path):
+    """
+    Unshare every file under a directory
+
+    Returns the number of files copied.
+    """
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            if not os.path.islink(filename) and unshare(filename):
+                count += 1
+    return count
+
+
+class BlobStore (object):
+    """
+    A content-addressed store of node files
+
+    Files copied into the notebook from outside are stored once per
+    distinct content, as a blob named by its digest, and the node files
+    are hard links to their blob, so they remain ordinary files.  Files
+    copied within the notebook are linked to the original file, and so
+    share its blob, if any.  The reference count of a blob is its link
+    count, less the link of the blob itself.  Blobs that are no longer
+    referenced are removed by collect_garbage().
+
+    KeepNote replaces files when writing them, which leaves other links
+    unchanged.  Files are unshared (see unshare()) before they are
+    appended to, or handed to other programs that may edit them in place.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._inodes = None  # (device, inode) -> digest, loaded lazily
+
+    def get_path(self):
+        """Returns the path of the store"""
+        return self._path
+
+    def get_blob_path(self, digest):
+        """Returns the path of a blob"""
+        return os.path.join(self._path, digest[:2], digest)
+
+    def _iter_blobs(self):
+        """Iterate the digests and paths of all blobs"""
+        for dirname in os.listdir(self._path):
+            dirpath = os.path.join(self._path, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for digest in os.listdir(dirpath):
+                if not digest.endswith(".tmp"):
+                    yield digest, os.path.join(dirpath, digest)
+
+    def _get_inodes(self):
+        """Returns the map of blob inodes to digests"""
+        if self._inodes is None:
+            self._inodes = {}
+            for digest, path in self._iter_blobs():
+                st = os.stat(path)
+                self._inodes[(st.st_dev, st.st_ino)] = digest
+        return self._inodes
+
+    def get_digest(self, filename):
+        """
+        Returns the digest of the blob a file is linked to, or None
+        """
+        st = os.stat(filename)
+        key = (st.st_dev, st.st_ino)
+        digest = self._get_inodes().get(key)
+        if digest is not None:
+            try:
+                blob = os.stat(self.get_blob_path(digest))
+            except OSError:
+                blob = None
+            if blob is None or (blob.st_dev, blob.st_ino) != key:
+                # the blob was removed and its inode reused
+                del self._inodes[key]
+                digest = None
+        return digest
+
+    def get_refcount(self, digest):
+        """Returns the number of files linked to a blob"""
+        try:
+            return os.stat(self.get_blob_path(digest)).st_nlink - 1
+        except OSError:
+            return 0
+
+    def add(self, filename):
+        """
+        Add the content of a file to the store and return its digest
+
+        The blob is a copy of the file, so that later changes to the file
+        do not reach the store.
+        """
+        digest = self.get_digest(filename)
+        if digest is not None:
+            return digest
+
+        digest = hash_file(filename)
+        blob = self.get_blob_path(digest)
+        if os.path.exists(blob):
+            if filecmp.cmp(filename, blob, shallow=False):
+                return digest
+            # the blob was edited in place.  Its links keep their content.
+            os.remove(blob)
+
+        dirpath = os.path.dirname(blob)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        fd, tmp = tempfile.mkstemp(".tmp", dir=dirpath)
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmp)
+            os.rename(tmp, blob)
+        except:
+            os.remove(tmp)
+            raise
+
+        st = os.stat(blob)
+        self._get_inodes()[(st.st_dev, st.st_ino)] = digest
+        return digest
+
+    def link(self, filename1, filename2):
+        """Make 'filename2' a link to 'filename1', replacing any file"""
+        fd, tmp = tempfile.mkstemp(".tmp", os.path.basename(filename2) + "_",
+                                   dir=os.path.dirname(filename2))
+        os.close(fd)
+        os.remove(tmp)
+        os.link(filename1, tmp)
+        try:
+            os.rename(tmp, filename2)
+        except:
+            os.remove(tmp)
+            raise
+
+    def copy_file(self, filename1, filename2, local=False):
+        """
+        Copy a file by linking it
+
+        Files within the notebook are linked directly, which needs no
+        hashing.  Files from outside of the notebook are added to the
+        store, so that copies of the same content share one blob.
+
+        local -- True if 'filename1' is outside of the notebook
+        """
+        if local:
+            self.link(self.get_blob_path(self.add(filename1)), filename2)
+        else:
+            self.link(filename1, filename2)
+
+    def copy_tree(self, path1, path2, local=False):
+        """Copy a directory tree by copying each of its files"""
+        os.makedirs(path2)
+        for name in os.listdir(path1):
+            src = os.path.join(path1, name)
+            dest = os.path.join(path2, name)
+            if os.path.isdir(src):
+                self.copy_tree(src, dest, local)
+            else:
+                self.copy_file(src, dest, local)
+
+    def collect_garbage(self):
+        """
+        Remove the blobs that no file links to
+
+        Returns the number of blobs removed and the bytes they freed.
+        """
+        count = 0
+        size = 0
+        for digest, path in list(self._iter_blobs()):
+            st = os.stat(path)
+            if st.st_nlink <= 1:
+                os.remove(path)
+                if self._inodes is not None:
+                    self._inodes.pop((st.st_dev, st.st_ino), None)
+                count += 1
+                size += st.st_size
+
+        # remove empty directories
+        for dirname in os.listdir(self._path):
+            dirpath = os.path.join(self._path, dirname)
+            if os.path.isdir(dirpath) and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+
+        return count, size
@@ -5,6 +5,7 @@ from keepnote import safefile
 from keepnote.notebook.connection import FileError
 from keepnote.notebook.connection import path_join
 from keepnote.notebook.connection import UnknownFile
+from keepnote.notebook.connection.fs.blobstore import unshare, unshare_tree
 from keepnote.notebook.connection.fs.paths import get_node_meta_file
 from keepnote.notebook.connection.fs.paths import path_node2local
 from keepnote.notebook.connection.fs.paths import NODE_META_FILE
@@ -29,15 +30,46 @@ class FileFS(object):
     Implements the NoteBook File API using the file-system.
     """
 
-    def __init__(self, nodeid2path):
+    def __init__(self, nodeid2path, stat_cache=None):
         """
         nodeid2path: a function that returns a filesystem path for a nodeid.
+        stat_cache: an optional StatCache shared with the connection.
         """
         self._nodeid2path = nodeid2path
+        self._stat_cache = stat_cache
+
+        # durability level of written files (see safefile)
+        self.durability = None
+
+        # if set, a BlobStore through which files are copied
+        self.blob_store = None
 
     def get_node_path(self, nodeid):
         return self._nodeid2path(nodeid)
 
+    def _exists(self, path):
+        if self._stat_cache:
+            return self._stat_cache.exists(path)
+        return os.path.exists(path)
+
+    def _isfile(self, path):
+        if self._stat_cache:
+            return self._stat_cache.isfile(path)
+        return os.path.isfile(path)
+
+    def _isdir(self, path):
+        if self._stat_cache:
+            return self._stat_cache.isdir(path)
+        return os.path.isdir(path)
+
+    def _invalidate(self, path, tree=False):
+        """Forget the cached stats of a path that is being changed"""
+        if self._stat_cache:
+            if tree:
+                self._stat_cache.invalidate_tree(path)
+            else:
+                self._stat_cache.invalidate(path)
+
     def open_file(self, nodeid, filename, mode="r", codec=None, _path=None):
         """Open a node file"""
         if mode not in "rwa":
@@ -50,13 +82,21 @@ class FileFS(object):
         fullname = get_node_filename(path, filename)
         dirpath = os.path.dirname(fullname)
 
+        if mode != "r":
+            self._invalidate(fullname)
         try:
-            if not os.path.exists(dirpath):
+            if not self._exists(dirpath):
+                self._invalidate(dirpath)
                 os.makedirs(dirpath)
 
+            # appending changes the file in place
+            if mode == "a" and self._isfile(fullname):
+                unshare(fullname)
+
             # NOTE: always use binary mode to ensure no
             # Window-specific line ending conversion
-            stream = safefile.open(fullname, mode + "b", codec=codec)
+            stream = safefile.open(fullname, mode + "b", codec=codec,
+                                   durability=self.durability)
         except Exception, e:
             raise FileError(
                 "cannot open file '%s' '%s': %s" %
@@ -64,15 +104,37 @@ class FileFS(object):
 
         return stream
 
+    def unshare_file(self, nodeid, filename=None, _path=None):
+        """
+        Give a node file content of its own, if it is linked to other files
+
+        If 'filename' is None or a directory, every file under it is
+        unshared.
+        """
+        path = self.get_node_path(nodeid) if _path is None else _path
+        fullname = (get_node_filename(path, filename)
+                    if filename is not None else path)
+        self._invalidate(fullname, tree=True)
+        try:
+            if self._isdir(fullname):
+                unshare_tree(fullname)
+            elif self._isfile(fullname):
+                unshare(fullname)
+        except Exception, e:
+            raise FileError("cannot unshare file '%s' '%s'" %
+                            (nodeid, filename), e)
+
     def delete_file(self, nodeid, filename, _path=None):
         """Delete a node file"""
         path = self.get_node_path(nodeid) if _path is None else _path
         filepath = get_node_filename(path, filename)
 
         try:
-            if os.path.isfile(filepath):
+            if self._isfile(filepath):
+                self._invalidate(filepath)
                 os.remove(filepath)
-            elif filename.endswith('/') and os.path.isdir(filepath):
+            elif filename.endswith('/') and self._isdir(filepath):
+                self._invalidate(filepath, tree=True)
                 shutil.rmtree(filepath)
             else:
                 # filename may not exist, delete is successful by default
@@ -90,7 +152,8 @@ class FileFS(object):
         fullname = get_node_filename(path, filename)
 
         try:
-            if not os.path.isdir(fullname):
+            if not self._isdir(fullname):
+                self._invalidate(fullname, tree=True)
                 os.makedirs(fullname)
         except Exception, e:
             raise FileError(
@@ -116,9 +179,9 @@ class FileFS(object):
                     not name.startswith("__")):
                 fullname = os.path.join(path, name)
                 node_fullname = path_join(filename, name)
-                if not os.path.exists(get_node_meta_file(fullname)):
+                if not self._exists(get_node_meta_file(fullname)):
                     # ensure directory is not a node
-                    if os.path.isdir(fullname):
+                    if self._isdir(fullname):
                         yield node_fullname + "/"
                     else:
                         yield node_fullname
@@ -127,9 +190,9 @@ class FileFS(object):
         """Return True if file exists."""
         path = self.get_node_path(nodeid) if _path is None else _path
         if filename.endswith("/"):
-            return os.path.isdir(get_node_filename(path, filename))
+            return self._isdir(get_node_filename(path, filename))
         else:
-            return os.path.isfile(get_node_filename(path, filename))
+            return self._isfile(get_node_filename(path, filename))
 
     def move_file(self, nodeid1, filename1, nodeid2, filename2,
                   _path1=None, _path2=None):
@@ -138,6 +201,8 @@ class FileFS(object):
         path2 = self.get_node_path(nodeid2) if _path2 is None else _path2
         filepath1 = get_node_filename(path1, filename1)
         filepath2 = get_node_filename(path2, filename2)
+        self._invalidate(filepath1, tree=True)
+        self._invalidate(filepath2, tree=True)
         try:
             # remove files in the way
             if os.path.isfile(filepath2):
@@ -171,8 +236,12 @@ class FileFS(object):
             path2 = self.get_node_path(nodeid2) if not _path2 else _path2
             fullname2 = get_node_filename(path2, filename2)
 
+        self._invalidate(fullname2, tree=True)
         try:
-            if os.path.isfile(fullname1):
+            if self.blob_store and self._copy_blobs(
+                    fullname1, fullname2, local=(nodeid1 is None)):
+                pass
+            elif os.path.isfile(fullname1):
                 shutil.copy(fullname1, fullname2)
             elif os.path.isdir(fullname1):
                 # TODO: handle case where filename1 = "/" and
@@ -181,3 +250,26 @@ class FileFS(object):
         except Exception, e:
             raise FileError(
                 "unable to copy file '%s' '%s'" % (nodeid1, filename1), e)
+
+    def _copy_blobs(self, fullname1, fullname2, local=False):
+        """
+        Copy a file or directory through the blob store
+
+        Returns False if the files could not be linked, such as on
+        filesystems without hard links.
+        """
+        if os.path.isfile(fullname1):
+            try:
+                self.blob_store.copy_file(fullname1, fullname2, local)
+            except OSError:
+                return False
+        elif os.path.isdir(fullname1) and not os.path.exists(fullname2):
+            try:
+                self.blob_store.copy_tree(fullname1, fullname2, local)
+            except OSError:
+                if os.path.exists(fullname2):
+                    shutil.rmtree(fullname2)
+                return False
+        else:
+            return False
+        return True
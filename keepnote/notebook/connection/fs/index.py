@@ -26,8 +26,13 @@
 
 
 # python imports
+import contextlib
+from itertools import izip
+import multiprocessing
+import multiprocessing.pool
 import os
 import sys
+import threading
 import time
 
 # import sqlite
@@ -42,13 +47,81 @@ except Exception, e:
 # keepnote imports
 import keepnote
 import keepnote.notebook
+from keepnote import safefile
+from keepnote.notebook.connection import ConnectionError
+from keepnote.notebook.connection.fs.file import get_node_filename
+from keepnote.notebook.connection.fs.paths import get_node_meta_file
 from keepnote.notebook.connection.index import NodeIndex
+from keepnote.notebook.connection.index import NULL
 
 
 # index filename
 INDEX_FILE = u"index.sqlite"
 INDEX_VERSION = 3
 
+# suffix of the temporary file used while rebuilding the index
+REBUILD_SUFFIX = u"-rebuild"
+
+# number of nodes inserted per executemany() batch during a rebuild
+REBUILD_BATCH_SIZE = 1000
+
+# number of nodes written per batch by the index_all() pipeline
+PIPELINE_BATCH_SIZE = 200
+
+# number of nodes index_all() indexes between commits, so that other
+# threads may write in between
+INDEX_COMMIT_SIZE = 200
+
+# number of nodeids resolved per query by get_node_paths()
+PATH_BATCH_SIZE = 500
+
+# deepest path get_node_path() will follow before assuming a parent loop
+MAX_PATH_DEPTH = 1000
+
+# number of idle reader connections kept for reuse
+READER_POOL_SIZE = 4
+
+
+def read_path_as_plain_text(path):
+    """
+    Iterates over the lines of a node's data file as plain text
+
+    Unlike read_data_as_plain_text(), the node is located by its path, so
+    that reading does not touch the connection or index.
+    """
+    try:
+        infile = safefile.open(
+            get_node_filename(path, keepnote.notebook.PAGE_DATA_FILE), "rb")
+        for line in keepnote.notebook.read_data_as_plain_text(infile):
+            yield line
+        infile.close()
+    except:
+        pass
+
+
+def read_node_path(args):
+    """
+    Read everything needed to index the node at a path
+
+    args -- a tuple (path, set_extra)
+
+    Returns (attr, extra, mtime, text, child_paths, error).  This function
+    runs in the reader pool of index_all() and must not use the connection
+    or index.
+    """
+    path, set_extra = args
+    fs = keepnote.notebook.connection.fs
+    try:
+        attr, extra = fs.read_attr(get_node_meta_file(path),
+                                   set_extra=set_extra)
+        mtime = fs.get_path_mtime(path)
+        text = "".join(read_path_as_plain_text(path))
+        child_paths = list(fs.iter_child_node_paths(path))
+    except Exception, e:
+        return None, None, None, None, [], unicode(e)
+
+    return attr, extra, mtime, text, child_paths, None
+
 #=============================================================================
 
 
@@ -61,8 +134,27 @@ class NoteBookIndex (NodeIndex):
         NodeIndex.__init__(self, conn)
         self._index_file = index_file
         self._uniroot = keepnote.notebook.UNIVERSAL_ROOT
-        self.con = None     # sqlite connection
-        self.cur = None     # sqlite cursor
+        self.con = None     # sqlite connection for writing
+        self.cur = None     # sqlite cursor for writing
+
+        # All writes go through one writer connection.  The writes of a
+        # thread form a transaction until its next commit point: the end
+        # of a write made outside of writing(), the end of its outermost
+        # writing() context, or a call to commit().  Transactions of
+        # different threads take turns through a transaction lock, so that
+        # a thread never commits another's unfinished writes.  A thread
+        # with a transaction reads through the writer connection, so that
+        # it sees its own writes.  Other reads use pooled connections that
+        # see committed data only, so that they do not wait on the writer.
+        self._lock = threading.RLock()   # guards the writer connection
+        self._txn_lock = threading.Lock()  # held during a transaction
+        self._txn_thread = None  # thread with an open transaction
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()  # guards the reader pool
+        self._readers = set()  # open reader connections
+        self._idle = []  # reader connections free for reuse
+        self._writes = 0  # number of writes, for detecting concurrent ones
+        self._wal = False
 
         # index state/capabilities
         self._need_index = False
@@ -86,6 +178,10 @@ class NoteBookIndex (NodeIndex):
             self.cur = self.con.cursor()
             #self.con.execute(u"PRAGMA read_uncommitted = true;")
 
+            # rows replaced on conflict must fire delete triggers, which
+            # keep substring indexes up to date
+            self.con.execute(u"PRAGMA recursive_triggers = ON;")
+
             self.init_index(auto_clear=auto_clear)
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
@@ -93,6 +189,7 @@ class NoteBookIndex (NodeIndex):
 
     def close(self):
         """Close connection to index"""
+        self._close_readers()
         if self.con is not None:
             try:
                 self.con.commit()
@@ -102,18 +199,146 @@ class NoteBookIndex (NodeIndex):
                 pass
             self.con = None
             self.cur = None
+        self._end_transaction()
+
+    def _close_readers(self):
+        """Close all reader connections"""
+        with self._pool_lock:
+            readers = list(self._readers)
+            self._readers.clear()
+            del self._idle[:]
+        for con in readers:
+            try:
+                con.close()
+            except:
+                pass
+
+    def _use_reader(self):
+        """Returns True if the calling thread reads committed data only"""
+        return (self._wal and not getattr(self._local, "writing", False) and
+                self._txn_thread is not threading.current_thread())
+
+    def _get_reader(self):
+        """
+        Returns a reader connection from the pool, or None if the calling
+        thread should read through the writer connection
+
+        The connection must be given back with _put_reader().
+        """
+        if not self._use_reader():
+            return None
+
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop()
+        con = sqlite.connect(self._index_file, check_same_thread=False)
+        with self._pool_lock:
+            self._readers.add(con)
+        return con
+
+    def _put_reader(self, con):
+        """Give back a reader connection to the pool"""
+        with self._pool_lock:
+            # connections closed with the index are not reused
+            if con in self._readers:
+                if len(self._idle) < READER_POOL_SIZE:
+                    self._idle.append(con)
+                    return
+                self._readers.remove(con)
+        con.close()
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Context for a read-only query, yields a cursor"""
+        con = self._get_reader()
+        if con is not None:
+            cur = con.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+                self._put_reader(con)
+        else:
+            with self._lock:
+                yield self.cur
+
+    @contextlib.contextmanager
+    def writing(self):
+        """
+        Context for a series of writes by the calling thread
+
+        The writes form one transaction, which is committed when the
+        outermost context ends, unless the thread commits sooner.  Within
+        it, the thread reads through the writer connection.  Statements
+        still take the writer lock one at a time, so that other threads
+        may read in between.
+        """
+        local = self._local
+        writing = getattr(local, "writing", False)
+        local.writing = True
+        try:
+            yield
+        finally:
+            local.writing = writing
+            if not writing:
+                self.commit()
+
+    def _begin_write(self):
+        """
+        Start a transaction for the calling thread, unless it has one
+
+        This waits for the transaction of any other thread to end, so it
+        must not be called while holding the writer lock.
+        """
+        thread = threading.current_thread()
+        if self._txn_thread is not thread:
+            self._txn_lock.acquire()
+            self._txn_thread = thread
+
+    def _end_transaction(self):
+        """End the calling thread's transaction, if it has one"""
+        if self._txn_thread is threading.current_thread():
+            self._txn_thread = None
+            self._txn_lock.release()
+
+    @contextlib.contextmanager
+    def _write(self, commit=False):
+        """
+        Context for a write by the calling thread, yields the writer cursor
+
+        The write is committed at its end, if requested or if it is not
+        within writing().
+        """
+        self._begin_write()
+        try:
+            with self._lock:
+                yield self.cur
+        finally:
+            self._writes += 1
+            if commit or not getattr(self._local, "writing", False):
+                self.commit()
+
+    def commit(self):
+        """Commit the calling thread's pending writes"""
+        if self._txn_thread is not threading.current_thread():
+            return
+        try:
+            if self.con is not None:
+                with self._lock:
+                    self.con.commit()
+        except sqlite.DatabaseError, e:
+            self._on_corrupt(e, sys.exc_info()[2])
+        finally:
+            self._end_transaction()
 
     def save(self):
         """Save index"""
         try:
             mtime = time.time()
-            self.con.execute(
-                """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
-                (mtime, self._nconn.get_rootid()))
-            try:
-                self.con.commit()
-            except:
-                self.open()
+            with self._write() as cur:
+                cur.execute(
+                    """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
+                    (mtime, self._nconn.get_rootid()))
         except Exception, e:
             self._on_corrupt(e, sys.exc_info()[2])
 
@@ -149,6 +374,12 @@ class NoteBookIndex (NodeIndex):
         con = self.con
 
         try:
+            # write-ahead logging lets readers proceed during writes
+            mode = con.execute(u"PRAGMA journal_mode = WAL;").fetchone()
+            self._wal = (mode is not None and mode[0].lower() == u"wal")
+            if self._wal:
+                con.execute(u"PRAGMA synchronous = NORMAL;")
+
             # check database version
             version = self._get_version()
             if version is None or version != INDEX_VERSION:
@@ -159,18 +390,8 @@ class NoteBookIndex (NodeIndex):
                 self._need_index = True
 
             # init NodeGraph table
-            con.execute(u"""CREATE TABLE IF NOT EXISTS NodeGraph
-                           (nodeid TEXT,
-                            parentid TEXT,
-                            basename TEXT,
-                            mtime FLOAT,
-                            symlink BOOLEAN,
-                            UNIQUE(nodeid) ON CONFLICT REPLACE);
-                        """)
-            con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphNodeid
-                           ON NodeGraph (nodeid);""")
-            con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphParentid
-                           ON NodeGraph (parentid);""")
+            self._init_nodegraph_table(con)
+            self._init_nodegraph_indexes(con)
 
             # init attribute indexes
             self.init_attrs(self.cur)
@@ -188,6 +409,24 @@ class NoteBookIndex (NodeIndex):
                                  self._index_file)
             self.clear()
 
+    def _init_nodegraph_table(self, con):
+        """Create the NodeGraph table without its secondary indexes"""
+        con.execute(u"""CREATE TABLE IF NOT EXISTS NodeGraph
+                       (nodeid TEXT,
+                        parentid TEXT,
+                        basename TEXT,
+                        mtime FLOAT,
+                        symlink BOOLEAN,
+                        UNIQUE(nodeid) ON CONFLICT REPLACE);
+                    """)
+
+    def _init_nodegraph_indexes(self, con):
+        """Create the secondary indexes of the NodeGraph table"""
+        con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphNodeid
+                       ON NodeGraph (nodeid);""")
+        con.execute(u"""CREATE INDEX IF NOT EXISTS IdxNodeGraphParentid
+                       ON NodeGraph (parentid);""")
+
     def is_corrupt(self):
         """Return True if database appear corrupt"""
         return self._corrupt
@@ -236,32 +475,427 @@ class NoteBookIndex (NodeIndex):
     # TODO: prevent "unmanaged change detected" warning when doing index_all()
     # Also I think double indexing is occuring
 
-    def index_all(self, rootid=None):
+    def index_all(self, rootid=None, workers=0, processes=False):
         """
         Reindex all nodes under 'rootid'
 
+        workers   -- if non-zero, read nodes with a pool of this many workers
+                     while a single writer adds them to the index in batches
+        processes -- if True, the pool uses processes instead of threads
+
         This function returns an iterator which must be iterated to completion.
         """
         conn = self._nconn
         if rootid is None:
             rootid = conn.get_rootid()
 
-        def preorder(conn, nodeid):
-            """Iterate through nodes in pre-order traversal"""
-            queue = [nodeid]
-            while len(queue) > 0:
-                nodeid = queue.pop()
+        with self.writing():
+            if workers:
+                for nodeid in self._index_all_pipeline(rootid, workers,
+                                                       processes):
+                    yield nodeid
+                self._need_index = False
+                return
+
+            def preorder(conn, nodeid):
+                """Iterate through nodes in pre-order traversal"""
+                queue = [nodeid]
+                while len(queue) > 0:
+                    nodeid = queue.pop()
+                    yield nodeid
+                    queue.extend(
+                        conn._list_children_nodeids(nodeid, _index=False))
+
+            # perform indexing
+            # simply by walking through the tree, all nodes will index
+            # themselves
+            # the root is nobody's child, so read it directly
+            conn.read_node(rootid)
+            for i, nodeid in enumerate(preorder(conn, rootid)):
                 yield nodeid
-                queue.extend(
-                    conn._list_children_nodeids(nodeid, _index=False))
+                if (i + 1) % INDEX_COMMIT_SIZE == 0:
+                    self.commit()
 
-        # perform indexing
-        # simply by walking through the tree, all nodes will index themselves
-        for nodeid in preorder(conn, rootid):
-            yield nodeid
+            # record index complete
+            self._need_index = False
 
-        # record index complete
-        self._need_index = False
+    def _index_all_pipeline(self, rootid, workers, processes):
+        """
+        Reindex all nodes under 'rootid' using a pool of readers
+
+        Workers parse node.xml files and extract page text, while this
+        thread walks the tree level by level and writes results in batches.
+        """
+        conn = self._nconn
+        if processes:
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = multiprocessing.pool.ThreadPool(workers)
+
+        try:
+            nodes = []
+            level = [(conn._get_parentid(rootid), conn._get_node_path(rootid))]
+            while len(level) > 0:
+                results = pool.imap(
+                    read_node_path,
+                    [(path, conn._attr_set_extra) for parentid, path in level],
+                    max(1, len(level) // (workers * 4)))
+
+                next_level = []
+                for (parentid, path), result in izip(level, results):
+                    attr, extra, mtime, text, child_paths, error = result
+                    if error is not None:
+                        keepnote.log_error(u"error reading %s: %s" %
+                                           (path, error))
+                        continue
+
+                    nodeid, attr = self._load_path_attr(
+                        parentid, path, attr, extra)
+                    nodes.append((nodeid, parentid, os.path.basename(path),
+                                  attr, mtime, text))
+                    next_level.extend((nodeid, child_path)
+                                      for child_path in child_paths)
+
+                    if len(nodes) >= PIPELINE_BATCH_SIZE:
+                        self.add_nodes(nodes, commit=True)
+                        for node in nodes:
+                            yield node[0]
+                        del nodes[:]
+                level = next_level
+
+            self.add_nodes(nodes, commit=True)
+            for node in nodes:
+                yield node[0]
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def rebuild(self):
+        """
+        Rebuild the entire index into a fresh database file
+
+        Nodes are read directly from the filesystem and inserted in batches
+        within a single transaction.  Secondary indexes and the fulltext
+        table are created only after all rows are loaded.  When complete,
+        the new file atomically replaces the current index file, which
+        remains queryable for the whole rebuild.  Writes made to the current
+        index during the rebuild are not in the new file, so if there are
+        any, the index is marked as needing indexing.
+
+        This function returns an iterator which must be iterated to completion.
+        """
+        conn = self._nconn
+        fs = keepnote.notebook.connection.fs
+        rootid = conn.get_rootid()
+        tmpfile = self._index_file + REBUILD_SUFFIX
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        writes = self._writes
+
+        con = sqlite.connect(tmpfile, isolation_level=None)
+        complete = False
+        try:
+            cur = con.cursor()
+            cur.execute(u"PRAGMA journal_mode = OFF;")
+            cur.execute(u"BEGIN;")
+
+            # create tables without secondary indexes
+            cur.execute(u"""CREATE TABLE Version
+                            (version INTEGER, update_date DATE);""")
+            cur.execute(u"INSERT INTO Version VALUES (?, datetime('now'));",
+                        (INDEX_VERSION,))
+            self._init_nodegraph_table(cur)
+            for attrindex in self._attrs.itervalues():
+                attrindex.init_table(cur)
+            cur.execute(u"""CREATE TABLE FulltextLoad
+                            (nodeid TEXT, content TEXT);""")
+
+            # load rows in batches
+            nodes = []
+            attr_rows = dict((attrindex, [])
+                             for attrindex in self._attrs.itervalues())
+            texts = []
+
+            def flush():
+                cur.executemany(
+                    u"INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)", nodes)
+                for attrindex, rows in attr_rows.iteritems():
+                    attrindex.add_nodes(cur, rows)
+                    del rows[:]
+                cur.executemany(
+                    u"INSERT INTO FulltextLoad VALUES (?, ?)", texts)
+                del nodes[:]
+                del texts[:]
+
+            for nodeid, parentid, path, attr in self._iter_path_nodes(
+                    None, conn._get_node_path(rootid)):
+                if parentid is None:
+                    parentid = self._uniroot
+                    basename = u""
+                else:
+                    basename = os.path.basename(path)
+                nodes.append((nodeid, parentid, basename,
+                              fs.get_path_mtime(path), False))
+
+                for attrindex, rows in attr_rows.iteritems():
+                    val = attrindex.get_value(attr)
+                    if val is not NULL:
+                        rows.append((nodeid, val))
+
+                try:
+                    texts.append((nodeid, self._get_node_text(
+                        attr, read_path_as_plain_text(path))))
+                except Exception:
+                    keepnote.log_error("error reading text of node %s '%s'" %
+                                       (nodeid, attr.get("title", "")))
+
+                if len(nodes) >= REBUILD_BATCH_SIZE:
+                    flush()
+                yield nodeid
+            flush()
+
+            # create secondary indexes and fulltext table after data load
+            self._init_nodegraph_indexes(cur)
+            for attrindex in self._attrs.itervalues():
+                attrindex.init_indexes(cur)
+            if self.init_fulltext(cur):
+                cur.execute(u"""INSERT INTO fulltext (nodeid, content)
+                                SELECT nodeid, content FROM FulltextLoad;""")
+            cur.execute(u"DROP TABLE FulltextLoad;")
+
+            cur.execute(u"COMMIT;")
+            con.close()
+            complete = True
+
+        finally:
+            if not complete:
+                con.close()
+                os.remove(tmpfile)
+
+        self._replace_index_file(tmpfile, writes)
+
+    def _iter_path_nodes(self, parentid, path):
+        """
+        Iterate through (nodeid, parentid, path, attr) for the node at 'path'
+        and all of its descendants in pre-order by reading the filesystem
+        directly
+        """
+        fs = keepnote.notebook.connection.fs
+
+        queue = [(parentid, path)]
+        while len(queue) > 0:
+            parentid, path = queue.pop()
+            try:
+                nodeid, attr = self._read_path_attr(parentid, path)
+            except ConnectionError:
+                keepnote.log_error(u"error reading %s" % path)
+                continue
+
+            yield nodeid, parentid, path, attr
+
+            queue.extend((nodeid, child_path)
+                         for child_path in fs.iter_child_node_paths(path))
+
+    def _read_path_attr(self, parentid, path):
+        """
+        Read the attr of the node stored at 'path' without indexing it
+
+        Returns (nodeid, attr) and updates the connection's path cache.
+        """
+        attr, extra = self._nconn._read_attr(get_node_meta_file(path))
+        return self._load_path_attr(parentid, path, attr, extra)
+
+    def _load_path_attr(self, parentid, path, attr, extra):
+        """
+        Load attr read from the node stored at 'path'
+
+        Returns (nodeid, attr) and updates the connection's path cache.
+        """
+        conn = self._nconn
+        nodeid = extra["nodeid"]
+
+        # clean attr and rewrite them if needed
+        if not conn._clean_attr(nodeid, attr):
+            conn._write_attr(get_node_meta_file(path), nodeid, attr)
+
+        # update path cache
+        basename = os.path.basename(path) if parentid else path
+        conn._path_cache.add(nodeid, basename, parentid)
+
+        return nodeid, attr
+
+    def _replace_index_file(self, filename, writes=None):
+        """
+        Atomically replace the index file with a new database file
+
+        writes -- if given, the write count when the new file was started.
+                  Any later writes are lost with the current file.
+        """
+        # wait for other threads to finish their transactions
+        self._begin_write()
+        try:
+            with self._lock:
+                lost = writes is not None and self._writes != writes
+
+                # The write-ahead log is named after the index file, so
+                # every connection to the old file must close, and
+                # checkpoint its log, before the new file takes that name.
+                self.close()
+                if sys.platform.startswith("win"):
+                    # windows will not allow rename when destination exists
+                    if os.path.exists(self._index_file):
+                        os.remove(self._index_file)
+                os.rename(filename, self._index_file)
+                self.open()
+
+                # record index complete, unless writes were lost
+                self._need_index = lost
+        finally:
+            self._end_transaction()
+
+    def refresh(self, rootid=None, steps=False):
+        """
+        Incrementally reindex nodes under 'rootid' that changed on disk
+
+        The tree is walked top-down using the index.  Only directories
+        whose mtime is newer than the mtime recorded in NodeGraph are
+        listed on disk.  Their added, removed, and renamed children are
+        reindexed, and nodes new to a directory have their entire subtree
+        indexed.  Unchanged directories are descended using the index and
+        cost a single stat.
+
+        This function returns an iterator of reindexed nodeids.  If 'steps'
+        is True, it instead yields a list of the nodeids reindexed for each
+        directory checked, so that the caller may do other work in between.
+        Each directory is reindexed in its own transaction, so the
+        iteration may be stopped early.
+        """
+        conn = self._nconn
+        if rootid is None:
+            rootid = conn.get_rootid()
+
+        queue = [(rootid, conn._get_parentid(rootid),
+                  conn._get_node_path(rootid))]
+        while len(queue) > 0:
+            nodeid, parentid, path = queue.pop()
+            reindexed = []
+            with self.writing():
+                queue.extend(self._refresh_dir(nodeid, parentid, path,
+                                               reindexed))
+            if steps:
+                yield reindexed
+            else:
+                for nodeid2 in reindexed:
+                    yield nodeid2
+
+    def _refresh_dir(self, nodeid, parentid, path, reindexed):
+        """
+        Reindex a node directory for refresh() if it changed on disk
+
+        Returns a list of (childid, nodeid, path) of the children to check
+        next.
+        """
+        conn = self._nconn
+        fs = keepnote.notebook.connection.fs
+
+        try:
+            mtime = fs.get_path_mtime(path)
+        except OSError:
+            # directory is gone, removal is detected by its parent
+            return []
+
+        if mtime <= self.get_node_mtime(nodeid):
+            # directory entries are unchanged, descend using the index
+            children = []
+            for childid, basename in self.list_children(nodeid):
+                conn._path_cache.add(childid, basename, nodeid)
+                children.append(
+                    (childid, nodeid, os.path.join(path, basename)))
+            return children
+
+        # reindex changed node
+        try:
+            nodeid2, attr = self._read_path_attr(parentid, path)
+        except ConnectionError:
+            keepnote.log_error(u"error reading %s" % path)
+            return []
+        if nodeid2 != nodeid:
+            # directory now holds a different node
+            self.remove_subtree(nodeid)
+            conn._path_cache.remove_subtree(nodeid)
+            reindexed.append(nodeid)
+            nodeid = nodeid2
+
+        children = self.refresh_node(nodeid, parentid, path, attr, mtime,
+                                     reindexed)
+        return [(childid, nodeid, child_path)
+                for childid, child_path in children]
+
+    def refresh_node(self, nodeid, parentid, path, attr, mtime,
+                     reindexed=None):
+        """
+        Reindex a node whose directory changed on disk, along with its
+        added, removed, and renamed children
+
+        Returns a list of (childid, path) of the children whose own
+        directories still need to be checked.  The nodeids of reindexed
+        nodes are appended to the list 'reindexed' if given.
+        """
+        fs = keepnote.notebook.connection.fs
+        if reindexed is None:
+            reindexed = []
+
+        self.add_node(nodeid, parentid, os.path.basename(path), attr, mtime)
+        reindexed.append(nodeid)
+
+        # compare children on disk to indexed children.  Children whose
+        # basenames are unchanged check their own directories later.
+        children = []
+        indexed = dict(self.list_children(nodeid))
+        basenames = dict((basename, childid)
+                         for childid, basename in indexed.iteritems())
+        for child_path in fs.iter_child_node_paths(path):
+            basename = os.path.basename(child_path)
+            childid = basenames.get(basename)
+            if childid is not None:
+                del indexed[childid]
+                children.append((childid, child_path))
+                continue
+
+            try:
+                childid, child_attr = self._read_path_attr(nodeid, child_path)
+            except ConnectionError:
+                keepnote.log_error(u"error reading %s" % child_path)
+                continue
+
+            if childid in indexed:
+                # renamed node, keep its old mtime so that it is
+                # still checked for its own changes
+                del indexed[childid]
+                self.add_node(childid, nodeid, basename, child_attr,
+                              self.get_node_mtime(childid))
+                reindexed.append(childid)
+                children.append((childid, child_path))
+                continue
+
+            # new or moved node, index its entire subtree
+            self.add_node(childid, nodeid, basename, child_attr,
+                          fs.get_path_mtime(child_path))
+            reindexed.append(childid)
+            for path2 in fs.iter_child_node_paths(child_path):
+                for nodeid3, parentid3, path3, attr3 in \
+                        self._iter_path_nodes(childid, path2):
+                    self.add_node(nodeid3, parentid3, os.path.basename(path3),
+                                  attr3, fs.get_path_mtime(path3))
+                    reindexed.append(nodeid3)
+
+        # remove children no longer on disk
+        for childid in indexed:
+            self.remove_subtree(childid)
+            self._nconn._path_cache.remove_subtree(childid)
+            reindexed.append(childid)
+
+        return children
 
     def compact(self):
         """
@@ -271,12 +905,33 @@ class NoteBookIndex (NodeIndex):
         self.con.execute("VACUUM;")
         self.con.comment()
 
+    def get_node_text_fingerprint(self, nodeid):
+        """
+        Returns a string that changes whenever the node's data file changes
+
+        Data files are replaced by a rename when saved, so the inode changes
+        even if the size and mtime do not.
+        """
+        try:
+            path = self._nconn._get_node_path(nodeid)
+        except Exception:
+            return None
+
+        try:
+            stat = os.stat(get_node_filename(
+                path, keepnote.notebook.PAGE_DATA_FILE))
+        except OSError:
+            # node has no data file
+            return u"-"
+        return u"%d:%d:%r" % (stat.st_ino, stat.st_size, stat.st_mtime)
+
     def get_node_mtime(self, nodeid):
         """Get the last indexed mtime for a node"""
 
-        self.cur.execute(u"""SELECT mtime FROM NodeGraph
-                             WHERE nodeid=?""", (nodeid,))
-        row = self.cur.fetchone()
+        with self._reading() as cur:
+            cur.execute(u"""SELECT mtime FROM NodeGraph
+                           WHERE nodeid=?""", (nodeid,))
+            row = cur.fetchone()
         if row:
             return row[0]
         else:
@@ -287,147 +942,237 @@ class NoteBookIndex (NodeIndex):
         if mtime is None:
             mtime = time.time()
 
-        self.cur.execute(
-            """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
-            (mtime, nodeid))
-        if commit:
-            self.con.commit()
+        with self._write(commit) as cur:
+            cur.execute(
+                """UPDATE NodeGraph SET mtime = ? WHERE nodeid = ?;""",
+                (mtime, nodeid))
 
     def get_mtime(self):
         """Get last modification time of the index"""
         return os.stat(self._index_file).st_mtime
 
-    def add_node(self, nodeid, parentid, basename, attr, mtime, commit=False):
-        """Add a node to the index"""
+    def add_node(self, nodeid, parentid, basename, attr, mtime, commit=False,
+                 fulltext=True):
+        """
+        Add a node to the index
+
+        fulltext -- if False, the node's indexed text is left unchanged
+        """
         # TODO: remove single parent assumption
 
         if self.con is None:
             return
 
-        try:
-            # get info
-            if parentid is None:
-                parentid = self._uniroot
-                basename = u""
-            symlink = False
-
-            # update nodegraph
-            self.cur.execute(
-                u"""INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""",
-                (nodeid, parentid, basename, mtime, symlink))
+        with self._write(commit) as cur:
+            try:
+                # get info
+                if parentid is None:
+                    parentid = self._uniroot
+                    basename = u""
+                symlink = False
 
-            self.add_node_attr(self.cur, nodeid, attr)
+                # update nodegraph
+                cur.execute(
+                    u"""INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)""",
+                    (nodeid, parentid, basename, mtime, symlink))
 
-            if commit:
-                self.con.commit()
+                self.add_node_attr(cur, nodeid, attr, fulltext)
 
-        except Exception, e:
-            keepnote.log_error("error index node %s '%s'" %
-                               (nodeid, attr.get("title", "")))
-            self._on_corrupt(e, sys.exc_info()[2])
+            except Exception, e:
+                keepnote.log_error("error index node %s '%s'" %
+                                   (nodeid, attr.get("title", "")))
+                self._on_corrupt(e, sys.exc_info()[2])
 
-    def remove_node(self, nodeid, commit=False):
-        """Remove node from index using nodeid"""
+    def add_nodes(self, nodes, commit=False):
+        """
+        Add many nodes to the index at once
 
+        nodes -- list of (nodeid, parentid, basename, attr, mtime, text)
+                 where text is the plain text of the node's data
+        """
         if self.con is None:
             return
 
-        try:
-            # delete node
-            self.cur.execute(
-                u"DELETE FROM NodeGraph WHERE nodeid=?", (nodeid,))
-
-            self.remove_node_attr(self.cur, nodeid)
-
-            if commit:
-                self.con.commit()
+        rows = []
+        attr_rows = dict((attrindex, [])
+                         for attrindex in self._attrs.itervalues())
+        texts = []
+        for nodeid, parentid, basename, attr, mtime, text in nodes:
+            if parentid is None:
+                parentid = self._uniroot
+                basename = u""
+            rows.append((nodeid, parentid, basename, mtime, False))
 
-        except sqlite.DatabaseError, e:
-            self._on_corrupt(e, sys.exc_info()[2])
+            for attrindex, attr_row in attr_rows.iteritems():
+                val = attrindex.get_value(attr)
+                if val is not NULL:
+                    attr_row.append((nodeid, val))
 
-    #-------------------------
-    # queries
+            try:
+                texts.append((nodeid, self._get_node_text(attr, [text])))
+            except Exception:
+                keepnote.log_error("error index text of node %s '%s'" %
+                                   (nodeid, attr.get("title", "")))
 
-    def get_node_path(self, nodeid):
-        """Get node path for a nodeid"""
+        with self._write(commit) as cur:
+            try:
+                # only nodes already in the index can have stale text
+                indexed = []
+                for i in xrange(0, len(rows), 500):
+                    nodeids = [row[0] for row in rows[i:i+500]]
+                    indexed.extend(row[0] for row in cur.execute(
+                        u"SELECT nodeid FROM NodeGraph WHERE nodeid IN (%s)" %
+                        u",".join(u"?" * len(nodeids)), nodeids))
+
+                cur.executemany(
+                    u"INSERT INTO NodeGraph VALUES (?, ?, ?, ?, ?)", rows)
+                for attrindex, attr_row in attr_rows.iteritems():
+                    attrindex.add_nodes(cur, attr_row)
+                self._insert_texts(cur, texts, indexed)
+
+            except Exception, e:
+                keepnote.log_error("error indexing nodes")
+                self._on_corrupt(e, sys.exc_info()[2])
 
-        # TODO: handle multiple parents
+    def remove_node(self, nodeid, commit=False):
+        """Remove node from index using nodeid"""
 
-        visit = set([nodeid])
-        path = []
-        parentid = None
+        if self.con is None:
+            return
 
-        try:
-            while parentid != self._uniroot:
-                # continue to walk up parent
-                path.append(nodeid)
+        with self._write(commit) as cur:
+            try:
+                # delete node
+                cur.execute(
+                    u"DELETE FROM NodeGraph WHERE nodeid=?", (nodeid,))
 
-                self.cur.execute(u"""SELECT nodeid, parentid, basename
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
-                row = self.cur.fetchone()
+                self.remove_node_attr(cur, nodeid)
 
-                # nodeid is not index
-                if row is None:
-                    return None
+            except sqlite.DatabaseError, e:
+                self._on_corrupt(e, sys.exc_info()[2])
 
-                nodeid, parentid, basename = row
+    def remove_subtree(self, nodeid, commit=False):
+        """
+        Remove a node and all of its indexed descendants
 
-                # parent has unexpected loop
-                if parentid in visit:
-                    self._on_corrupt(Exception("unexpect parent path loop"))
-                    return None
+        The subtree is found with a recursive query, so the number of
+        statements does not depend on the size of the subtree.
+        """
+        if self.con is None:
+            return
 
-                # walk up
-                nodeid = parentid
+        # UNION, rather than UNION ALL, stops at parent loops
+        subtree = u"""WITH RECURSIVE Subtree(nodeid) AS (
+                          SELECT ?
+                        UNION
+                          SELECT n.nodeid FROM NodeGraph AS n
+                          JOIN Subtree AS s ON n.parentid = s.nodeid)
+                      SELECT nodeid FROM Subtree"""
 
-            path.reverse()
-            return path
+        with self._write(commit) as cur:
+            try:
+                # NodeGraph is needed to find the subtree, so it goes last
+                self.remove_nodes_attr(cur, subtree, (nodeid,))
+                cur.execute(
+                    u"DELETE FROM NodeGraph WHERE nodeid IN (%s)" % subtree,
+                    (nodeid,))
+
+            except sqlite.DatabaseError, e:
+                # The subtree may be partly removed.  Other writes pending
+                # on the writer connection are kept, and the index is
+                # scheduled for repair.
+                self._on_corrupt(e, sys.exc_info()[2])
+                raise
 
-        except sqlite.DatabaseError, e:
-            self._on_corrupt(e, sys.exc_info()[2])
-            raise
+    #-------------------------
+    # queries
 
-    def get_node_filepath(self, nodeid):
-        """Get node path for a nodeid"""
+    def _get_ancestors(self, nodeids):
+        """
+        Walk up the parents of many nodes with one query per batch
 
+        Returns a dict mapping each indexed nodeid to its list of
+        (nodeid, basename) ancestors, starting from the root.  Nodes whose
+        ancestors are not fully indexed are omitted.
+        """
         # TODO: handle multiple parents
 
-        visit = set([nodeid])
-        path = []
-        parentid = None
-
-        try:
-            while parentid != self._uniroot:
-                # continue to walk up parent
-
-                self.cur.execute(u"""SELECT nodeid, parentid, basename
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
-                row = self.cur.fetchone()
+        ancestors = {}
+        parents = {}
+        nodeids = list(nodeids)
 
-                # nodeid is not index
-                if row is None:
-                    return None
+        with self._reading() as cur:
+            try:
+                for i in xrange(0, len(nodeids), PATH_BATCH_SIZE):
+                    batch = nodeids[i:i+PATH_BATCH_SIZE]
+                    cur.execute(
+                        u"""WITH RECURSIVE Ancestors
+                            (startid, nodeid, parentid, basename, depth) AS (
+                              SELECT nodeid, nodeid, parentid, basename, 0
+                              FROM NodeGraph
+                              WHERE nodeid IN (%s)
+                            UNION ALL
+                              SELECT a.startid, n.nodeid, n.parentid,
+                                     n.basename, a.depth + 1
+                              FROM NodeGraph AS n
+                              JOIN Ancestors AS a ON n.nodeid = a.parentid
+                              WHERE a.parentid != ? AND a.depth < ?)
+                            SELECT startid, nodeid, parentid, basename
+                            FROM Ancestors
+                            ORDER BY startid, depth DESC""" %
+                        u",".join(u"?" * len(batch)),
+                        batch + [self._uniroot, MAX_PATH_DEPTH])
+
+                    for startid, nodeid, parentid, basename in cur:
+                        if startid not in ancestors:
+                            # first row is the highest ancestor found
+                            ancestors[startid] = []
+                            parents[startid] = parentid
+                        ancestors[startid].append((nodeid, basename))
+
+            except sqlite.DatabaseError, e:
+                self._on_corrupt(e, sys.exc_info()[2])
+                raise
+
+        for startid, parentid in parents.iteritems():
+            if parentid != self._uniroot:
+                if len(ancestors[startid]) > MAX_PATH_DEPTH:
+                    # parent has unexpected loop
+                    self._on_corrupt(Exception("unexpect parent path loop"))
+                # an ancestor is not indexed
+                del ancestors[startid]
 
-                nodeid, parentid, basename = row
-                if basename != "":
-                    path.append(basename)
+        return ancestors
 
-                # parent has unexpected loop
-                if parentid in visit:
-                    self._on_corrupt(Exception("unexpect parent path loop"))
-                    return None
+    def get_node_path(self, nodeid):
+        """Get node path for a nodeid"""
+        path = self._get_ancestors([nodeid]).get(nodeid)
+        if path is None:
+            return None
+        return [nodeid2 for nodeid2, basename in path]
 
-                # walk up
-                nodeid = parentid
+    def get_node_paths(self, nodeids):
+        """
+        Get node paths for many nodeids at once
 
-            path.reverse()
-            return path
+        Returns a dict mapping each nodeid to its path, or None if the node
+        is not indexed.
+        """
+        ancestors = self._get_ancestors(nodeids)
+        paths = {}
+        for nodeid in nodeids:
+            path = ancestors.get(nodeid)
+            if path is not None:
+                path = [nodeid2 for nodeid2, basename in path]
+            paths[nodeid] = path
+        return paths
 
-        except sqlite.DatabaseError, e:
-            self._on_corrupt(e, sys.exc_info()[2])
-            raise
+    def get_node_filepath(self, nodeid):
+        """Get node path for a nodeid"""
+        path = self._get_ancestors([nodeid]).get(nodeid)
+        if path is None:
+            return None
+        return [basename for nodeid2, basename in path if basename != ""]
 
     def get_node(self, nodeid):
         """Get node data for a nodeid"""
@@ -435,10 +1180,11 @@ class NoteBookIndex (NodeIndex):
         # TODO: handle multiple parents
 
         try:
-            self.cur.execute(u"""SELECT nodeid, parentid, basename, mtime
-                                FROM NodeGraph
-                                WHERE nodeid=?""", (nodeid,))
-            row = self.cur.fetchone()
+            with self._reading() as cur:
+                cur.execute(u"""SELECT nodeid, parentid, basename, mtime
+                               FROM NodeGraph
+                               WHERE nodeid=?""", (nodeid,))
+                row = cur.fetchone()
 
             # nodeid is not index
             if row is None:
@@ -455,23 +1201,39 @@ class NoteBookIndex (NodeIndex):
 
     def get_attr(self, nodeid, attr):
         """Return a nodes's attribute value"""
-        return self.get_node_attr(self.cur, nodeid, attr)
+        with self._reading() as cur:
+            return self.get_node_attr(cur, nodeid, attr)
 
     def has_node(self, nodeid):
         """Returns True if index has node"""
-        self.cur.execute(u"""SELECT nodeid, parentid, basename, mtime
-                             FROM NodeGraph
-                             WHERE nodeid=?""", (nodeid,))
-        return self.cur.fetchone() is not None
+        with self._reading() as cur:
+            cur.execute(u"""SELECT nodeid, parentid, basename, mtime
+                           FROM NodeGraph
+                           WHERE nodeid=?""", (nodeid,))
+            return cur.fetchone() is not None
+
+    def list_nodes(self):
+        """List (nodeid, parentid, basename, mtime) of all indexed nodes"""
+
+        try:
+            with self._reading() as cur:
+                cur.execute(u"""SELECT nodeid, parentid, basename, mtime
+                               FROM NodeGraph""")
+                return list(cur.fetchall())
+
+        except sqlite.DatabaseError, e:
+            self._on_corrupt(e, sys.exc_info()[2])
+            raise
 
     def list_children(self, nodeid):
         """List children indexed for node"""
 
         try:
-            self.cur.execute(u"""SELECT nodeid, basename
-                                FROM NodeGraph
-                                WHERE parentid=?""", (nodeid,))
-            return list(self.cur.fetchall())
+            with self._reading() as cur:
+                cur.execute(u"""SELECT nodeid, basename
+                               FROM NodeGraph
+                               WHERE parentid=?""", (nodeid,))
+                return list(cur.fetchall())
 
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
@@ -481,20 +1243,22 @@ class NoteBookIndex (NodeIndex):
         """Returns True if node has children"""
 
         try:
-            self.cur.execute(u"""SELECT nodeid
-                                FROM NodeGraph
-                                WHERE parentid=?""", (nodeid,))
-            return self.cur.fetchone() is not None
+            with self._reading() as cur:
+                cur.execute(u"""SELECT nodeid
+                               FROM NodeGraph
+                               WHERE parentid=?""", (nodeid,))
+                return cur.fetchone() is not None
 
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
 
-    def search_titles(self, title):
+    def search_titles(self, title, limit=None):
         """Search node titles"""
 
         try:
-            return self.search_node_titles(self.cur, title)
+            with self._reading() as cur:
+                return self.search_node_titles(cur, title, limit)
         except sqlite.DatabaseError, e:
             self._on_corrupt(e, sys.exc_info()[2])
             raise
@@ -502,7 +1266,24 @@ class NoteBookIndex (NodeIndex):
     def search_contents(self, text):
         """Search node contents"""
 
-        cur = self.con.cursor()
+        con = self._get_reader()
+        if con is None:
+            # read all results while holding the writer connection
+            with self._lock:
+                cur = self.con.cursor()
+                try:
+                    results = list(self.search_node_contents(cur, text))
+                except:
+                    keepnote.log_error(
+                        "SQLITE error while performing search")
+                    results = []
+                finally:
+                    cur.close()
+            for res in results:
+                yield res
+            return
+
+        cur = con.cursor()
         try:
             for res in self.search_node_contents(cur, text):
                 yield res
@@ -510,3 +1291,15 @@ class NoteBookIndex (NodeIndex):
             keepnote.log_error("SQLITE error while performing search")
         finally:
             cur.close()
+            self._put_reader(con)
+
+    def search_contents_ranked(self, text, limit=None, offset=0):
+        """Search node contents and return ranked results"""
+
+        with self._reading() as cur:
+            try:
+                return self.search_node_contents_ranked(
+                    cur, text, limit, offset)
+            except:
+                keepnote.log_error("SQLITE error while performing search")
+                return []
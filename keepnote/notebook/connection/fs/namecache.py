@@ -0,0 +1,142 @@
+"""
+
+    KeepNote
+    Cache of the names within directories
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+import contextlib
+import os
+
+
+class DirNames (object):
+    """The cached names of one directory"""
+
+    __slots__ = ["names", "mtime", "numbers"]
+
+    def __init__(self, names, mtime):
+        self.names = names    # set of lower case names
+        self.mtime = mtime    # directory mtime when names were current
+        self.numbers = {}     # name pattern -> first number not known taken
+
+
+class NameCache (object):
+    """
+    A cache of the names within directories, for picking unique filenames
+
+    A directory is listed once and its names are trusted while its mtime
+    is unchanged.  Changes made through changing() update the names
+    directly, so that they do not cause the directory to be listed again.
+
+    Names are compared case-insensitively, which is conservative on
+    case-sensitive filesystems.
+    """
+
+    def __init__(self):
+        self._dirs = {}
+
+    def clear(self):
+        """Clear the cache"""
+        self._dirs.clear()
+
+    def _get(self, path):
+        """Returns the current names of a directory"""
+        mtime = os.stat(path).st_mtime
+        entry = self._dirs.get(path)
+        if entry is None or entry.mtime != mtime:
+            names = set(name.lower() for name in os.listdir(path))
+            entry = self._dirs[path] = DirNames(names, mtime)
+        return entry
+
+    def get_unique_filename(self, path, filename, ext=u"", sep=u" ",
+                            number=2, return_number=False, use_number=False):
+        """
+        Returns a unique version of a filename for a given directory
+
+        Takes the same arguments as keepnote.notebook.get_unique_filename().
+        """
+        entry = self._get(path)
+        names = entry.names
+
+        # try the given filename
+        if not use_number:
+            newname = filename + ext
+            if newname.lower() not in names:
+                newname = os.path.join(path, newname)
+                return (newname, None) if return_number else newname
+
+        # try numbered suffixes, starting after those known to be taken
+        key = (filename.lower(), sep, ext.lower(), number)
+        i = entry.numbers.get(key, number)
+        while True:
+            newname = filename + sep + unicode(i) + ext
+            if newname.lower() not in names:
+                break
+            i += 1
+        entry.numbers[key] = i
+
+        newname = os.path.join(path, newname)
+        return (newname, i) if return_number else newname
+
+    @contextlib.contextmanager
+    def changing(self, path, added=None, removed=None):
+        """
+        Context for adding and/or removing a name in a directory
+
+        The cached names are updated only if they were current beforehand,
+        so that earlier unmanaged changes are still detected.
+        """
+        entry = self._dirs.get(path)
+        if entry is None:
+            yield
+            return
+
+        current = entry.mtime == os.stat(path).st_mtime
+        try:
+            yield
+        except:
+            self._dirs.pop(path, None)
+            raise
+
+        if not current:
+            self._dirs.pop(path, None)
+            return
+        if removed is not None:
+            entry.names.discard(removed.lower())
+            # freed names may be below the numbers known to be taken
+            entry.numbers.clear()
+        if added is not None:
+            entry.names.add(added.lower())
+        entry.mtime = os.stat(path).st_mtime
+
+    def discard(self, path):
+        """Forget the names of a directory"""
+        self._dirs.pop(path, None)
+
+    def discard_tree(self, path):
+        """Forget the names of a directory and all directories within it"""
+        prefix = path + os.path.sep
+        for dirpath in self._dirs.keys():
+            if dirpath == path or dirpath.startswith(prefix):
+                del self._dirs[dirpath]
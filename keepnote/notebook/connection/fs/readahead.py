@@ -0,0 +1,99 @@
+"""
+
+    KeepNote
+    Read-ahead of node meta data files
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+import Queue
+import sys
+import threading
+
+# keepnote imports
+import keepnote
+
+
+# files waiting to be read ahead, beyond which requests are dropped
+READ_AHEAD_SIZE = 1000
+
+# bytes read at a time
+READ_BLOCK_SIZE = 1 << 16
+
+
+class ReadAhead (object):
+    """
+    Reads files on a background thread, ahead of their use
+
+    Reading a file brings it into the operating system's cache, so that
+    it is read quickly when needed.  Requests are hints only; they are
+    dropped when too many are waiting, and missing files are ignored.
+    """
+
+    def __init__(self, size=READ_AHEAD_SIZE):
+        self._queue = Queue.Queue(size)
+        self._thread = None
+
+    def start(self):
+        """Start reading ahead"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="keepnote-readahead")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop reading ahead, dropping any waiting requests"""
+        if self._thread is None:
+            return
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def add(self, filenames):
+        """Request that files be read"""
+        self.start()
+        for filename in filenames:
+            try:
+                self._queue.put_nowait(filename)
+            except Queue.Full:
+                break
+
+    def _run(self):
+        while True:
+            filename = self._queue.get()
+            if filename is None:
+                break
+            try:
+                with open(filename, "rb") as infile:
+                    while infile.read(READ_BLOCK_SIZE):
+                        pass
+            except IOError:
+                pass
+            except Exception, e:
+                keepnote.log_error(e, sys.exc_info()[2])
@@ -0,0 +1,134 @@
+"""
+
+    KeepNote
+    Cache of file stats
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+import os
+import stat
+import threading
+import time
+
+
+# seconds a stat is trusted without asking the filesystem again
+STAT_TTL = 1.0
+
+
+class StatCache (object):
+    """
+    A cache of os.stat() results with a short time-to-live
+
+    Stats, including failed stats of missing paths, are reused for 'ttl'
+    seconds.  Changes made by the owner of the cache must be announced
+    with invalidate() or invalidate_tree(), so that they are seen at
+    once.  Changes made by others are seen once the TTL expires.  A 'ttl'
+    of 0 disables caching.  Stats that must be current, such as those
+    recorded in the index, should be made with 'fresh' set.
+
+    The cache may be used by several threads.
+
+    on_stat -- if given, called with the path of every stat that reaches
+               the filesystem.  'count' is the number of such stats.
+    """
+
+    def __init__(self, ttl=STAT_TTL, on_stat=None):
+        self.ttl = ttl
+        self.on_stat = on_stat
+        self.count = 0
+        self._entries = {}  # path -> (time of stat, stat or OSError)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Clear the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def stat(self, path, fresh=False):
+        """
+        Returns os.stat() of a path, raising OSError as os.stat() does
+
+        fresh -- if True, always ask the filesystem
+        """
+        now = time.time()
+        with self._lock:
+            entry = None if fresh else self._entries.get(path)
+        if entry is not None and now - entry[0] < self.ttl:
+            st = entry[1]
+        else:
+            self.count += 1
+            if self.on_stat:
+                self.on_stat(path)
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                st = e
+            if self.ttl > 0:
+                with self._lock:
+                    self._entries[path] = (now, st)
+
+        if isinstance(st, OSError):
+            raise st
+        return st
+
+    def get_mtime(self, path, fresh=False):
+        """Returns the mtime of a path"""
+        return self.stat(path, fresh).st_mtime
+
+    def exists(self, path):
+        """Returns True if a path exists"""
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def isfile(self, path):
+        """Returns True if a path is a regular file"""
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def isdir(self, path):
+        """Returns True if a path is a directory"""
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def invalidate(self, path):
+        """Forget the stat of a path and of its directory"""
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries.pop(os.path.dirname(path), None)
+
+    def invalidate_tree(self, path):
+        """Forget the stats of a path, its directory, and all paths within"""
+        self.invalidate(path)
+        prefix = path + os.path.sep
+        with self._lock:
+            for path2 in self._entries.keys():
+                if path2.startswith(prefix):
+                    del self._entries[path2]
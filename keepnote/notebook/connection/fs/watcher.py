@@ -0,0 +1,209 @@
+"""
+
+    KeepNote
+    Watchers for changes made to a notebook outside of KeepNote
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+from collections import defaultdict
+import os
+import sys
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# keepnote imports
+import keepnote
+from keepnote.notebook.connection.fs.paths import get_node_meta_file
+
+
+# seconds between scans of the polling watcher
+POLL_INTERVAL = 5.0
+
+
+class Watcher (object):
+    """
+    Base class for watchers of a notebook directory
+
+    Watchers run in a background thread and collect the paths of node
+    directories that may have changed.  They only detect changes; the
+    connection reindexes the collected paths on its own thread.
+
+    on_change -- if given, called from the watcher thread whenever new
+                 changes are collected
+    """
+
+    def __init__(self, path, on_change=None):
+        self._path = path
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._changes = set()
+
+    def start(self):
+        """Start watching"""
+        pass
+
+    def stop(self):
+        """Stop watching"""
+        pass
+
+    def add_changes(self, paths):
+        """Record paths of node directories that may have changed"""
+        with self._lock:
+            size = len(self._changes)
+            self._changes.update(paths)
+            added = len(self._changes) > size
+        if added and self._on_change:
+            self._on_change()
+
+    def get_changes(self):
+        """Returns and clears the collected paths"""
+        with self._lock:
+            changes, self._changes = self._changes, set()
+        return changes
+
+
+class PollingWatcher (Watcher):
+    """
+    Watches a notebook by periodically scanning directory mtimes
+
+    Each indexed node directory, and its meta data file, is compared
+    against the mtime last recorded in the index.
+    """
+
+    def __init__(self, path, index, rootid, on_change=None,
+                 interval=POLL_INTERVAL):
+        Watcher.__init__(self, path, on_change)
+        self._index = index
+        self._rootid = rootid
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching"""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="keepnote-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.check()
+            except Exception, e:
+                keepnote.log_error(e, sys.exc_info()[2])
+
+    def check(self):
+        """Scan the notebook once and record any changed node paths"""
+        children = defaultdict(list)
+        root = None
+        for nodeid, parentid, basename, mtime in self._index.list_nodes():
+            if nodeid == self._rootid:
+                root = (nodeid, self._path, mtime)
+            else:
+                children[parentid].append((nodeid, basename, mtime))
+        if root is None:
+            return
+
+        changes = []
+        stack = [root]
+        while stack:
+            nodeid, path, index_mtime = stack.pop()
+            try:
+                mtime = max(os.stat(path).st_mtime,
+                            os.stat(get_node_meta_file(path)).st_mtime)
+            except OSError:
+                # removed nodes are found through their parents
+                continue
+            if mtime > index_mtime:
+                changes.append(path)
+
+            for childid, basename, child_mtime in children[nodeid]:
+                stack.append((childid, os.path.join(path, basename),
+                              child_mtime))
+
+        if changes:
+            self.add_changes(changes)
+
+
+class InotifyWatcher (Watcher):
+    """Watches a notebook using inotify (requires pyinotify)"""
+
+    def __init__(self, path, on_change=None):
+        Watcher.__init__(self, path, on_change)
+        self._manager = pyinotify.WatchManager()
+        self._notifier = None
+
+    def start(self):
+        """Start watching"""
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB)
+        self._notifier = pyinotify.ThreadedNotifier(
+            self._manager, self._on_event)
+        self._notifier.daemon = True
+        self._notifier.start()
+        self._manager.add_watch(
+            self._path, mask, rec=True, auto_add=True,
+            exclude_filter=self._exclude)
+
+    def stop(self):
+        """Stop watching"""
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    def _exclude(self, path):
+        # skip special directories, such as the notebook meta data dir
+        relpath = os.path.relpath(path, self._path)
+        return any(part.startswith(u"__") for part in relpath.split(os.sep))
+
+    def _on_event(self, event):
+        # the changed directory, which contains the event's file
+        self.add_changes([event.path])
+
+
+def make_watcher(path, index, rootid, on_change=None, polling=False,
+                 interval=POLL_INTERVAL):
+    """
+    Returns a watcher for a notebook directory
+
+    An inotify watcher is used if available, unless 'polling' is True.
+    """
+    if pyinotify is not None and not polling:
+        return InotifyWatcher(path, on_change)
+    else:
+        return PollingWatcher(path, index, rootid, on_change, interval)
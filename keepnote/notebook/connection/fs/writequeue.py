@@ -0,0 +1,132 @@
+"""
+
+    KeepNote
+    Write-behind queue for node attributes
+
+"""
+
+#
+#  KeepNote
+#  Copyright (c) 2008-2011 Matt Rasmussen
+#  Author: Matt Rasmussen <rasmus@alum.mit.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+
+# python imports
+import copy
+import sys
+import threading
+import time
+
+# keepnote imports
+import keepnote
+
+
+# seconds the writer waits for more writes before starting a batch
+WRITE_DELAY = .05
+
+
+class WriteQueue (object):
+    """
+    A write-behind queue of node attr writes
+
+    Writes are coalesced per nodeid, so that only the latest attr of a
+    node is written.  A background thread passes queued writes in batches
+    to 'write_batch', which is called with a list of (nodeid, attr).
+    """
+
+    def __init__(self, write_batch, delay=WRITE_DELAY):
+        self._write_batch = write_batch
+        self._delay = delay
+        self._cond = threading.Condition()
+        self._pending = {}    # nodeid -> attr waiting to be written
+        self._writing = {}    # nodeid -> attr of the batch being written
+        self._urgent = False  # True when a caller waits on the queue
+        self._closed = False
+        self._thread = None
+
+    def put(self, nodeid, attr):
+        """Queue a write of a node's attr"""
+        # the caller may keep changing its attr
+        attr = copy.deepcopy(attr)
+
+        with self._cond:
+            if self._closed:
+                raise ValueError("write queue is closed")
+            self._pending[nodeid] = attr
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="keepnote-writer")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def is_pending(self, nodeid):
+        """Returns True if a write of the node has not finished"""
+        with self._cond:
+            return nodeid in self._pending or nodeid in self._writing
+
+    def is_queued(self, nodeid):
+        """Returns True if a write of the node waits for a later batch"""
+        with self._cond:
+            return nodeid in self._pending
+
+    def flush(self):
+        """Block until all queued writes are written"""
+        with self._cond:
+            while self._pending or self._writing:
+                self._urgent = True
+                self._cond.notify_all()
+                self._cond.wait()
+
+    def close(self):
+        """Write all queued writes and stop the background thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        """Write batches until the queue is closed"""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+
+                # let more writes join the batch, unless someone is waiting
+                deadline = time.time() + self._delay
+                while not self._urgent and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                self._writing, self._pending = self._pending, {}
+
+            try:
+                self._write_batch(self._writing.items())
+            except Exception, e:
+                keepnote.log_error(e, sys.exc_info()[2])
+
+            with self._cond:
+                self._writing = {}
+                if not self._pending:
+                    self._urgent = False
+                self._cond.notify_all()
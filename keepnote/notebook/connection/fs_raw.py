@@ -431,11 +431,13 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
         # also plug-ability will ensure safer fall back to unhandeled queries
 
         # built-in queries
-        # ["index_attr", key, (index_value)]
-        # ["search", "title", text]
+        # ["index_attr", key, (index_value), (index_substring)]
+        # ["search", "title", text, (limit)]
         # ["search_fulltext", text]
+        # ["search_fulltext_ranked", text, limit, offset]
         # ["has_fulltext"]
         # ["node_path", nodeid]
+        # ["node_paths", nodeids]
         # ["get_attr", nodeid, key]
 
         if query[0] == "index_attr":
@@ -443,15 +445,16 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
 
         elif query[0] == "search":
             assert query[1] == "title"
+            limit = query[3] if len(query) >= 4 else None
 
             return [
                 (nodeid, node["title"])
                 for nodeid, node in (
                     (nodeid, self.read_node(nodeid))
                     for nodeid in self._nodefs.iter_nodeids())
-                if query[2] in node.get("title", "")]
+                if query[2] in node.get("title", "")][:limit]
 
-        elif query[0] == "search_fulltext":
+        elif query[0] in ("search_fulltext", "search_fulltext_ranked"):
             # TODO: could implement brute-force backup
             return []
 
@@ -472,6 +475,10 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
             path.reverse()
             return path
 
+        elif query[0] == "node_paths":
+            return dict((nodeid, self.index(["node_path", nodeid]))
+                        for nodeid in query[1])
+
         elif query[0] == "get_attr":
             return self.read_node(query[1])[query[2]]
 
@@ -487,3 +494,9 @@ class NoteBookConnectionFSRaw (NoteBookConnection):
 
         elif query[0] == "index_all":
             return
+
+        elif query[0] == "rebuild":
+            return
+
+        elif query[0] == "refresh":
+            return
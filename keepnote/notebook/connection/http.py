@@ -37,6 +37,7 @@ import urlparse
 from keepnote import plist
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import NoteBookConnection
+from keepnote.notebook.connection.index import title_match_key
 
 
 XML_HEADER = u"""\
@@ -207,6 +208,30 @@ class NoteBookConnectionHttp (NoteBookConnection):
             raise connlib.ConnectionError()
         self._title_cache.remove(nodeid)
 
+    def apply_batch(self, ops):
+        """Apply a batch of node operations in one request"""
+        # POST /?batch
+        # ops encoded as a list of [action, nodeid, attr]
+        ops = [[action, nodeid, attr] for action, nodeid, attr in ops]
+        body_content = self.dumps_data(ops).encode("utf8")
+        self._request(
+            'POST', format_node_path(self._notebook_prefix) + "?batch",
+            body_content)
+        result = self._conn.getresponse()
+        result.read()
+        if result.status == httplib.FORBIDDEN:
+            raise connlib.NodeExists()
+        elif result.status == httplib.NOT_FOUND:
+            raise connlib.UnknownNode()
+        elif result.status != httplib.OK:
+            raise connlib.ConnectionError("unexpected error")
+
+        for action, nodeid, attr in ops:
+            if action == "delete":
+                self._title_cache.remove(nodeid)
+            else:
+                self._title_cache.update_attr(attr)
+
     def has_node(self, nodeid):
         """Returns True if node exists"""
 
@@ -381,12 +406,17 @@ class NoteBookConnectionHttp (NoteBookConnection):
 
         if len(query) > 2 and query[:2] == ["search", "title"]:
             if not self._title_cache.is_complete():
-                result = self.index_raw(["search", "title", "%"])
+                # every title contains the empty string
+                result = self.index_raw(["search", "title", ""])
                 for nodeid, title in result:
                     self._title_cache.add(nodeid, title)
                 self._title_cache.set_complete()
 
-            return list(self._title_cache.get(query[2]))
+            # order matches as the notebook index does
+            limit = query[3] if len(query) >= 4 else None
+            return sorted(self._title_cache.get(query[2]),
+                          key=lambda (nodeid, title):
+                          title_match_key(query[2], title))[:limit]
 
         elif len(query) == 3 and query[0] == "get_attr" and query[2] == "icon":
             # HACK: fetching icons is too slow right now
@@ -26,7 +26,11 @@
 
 
 # python imports
+import hashlib
 from itertools import chain
+from itertools import islice
+import re
+import struct
 
 #try:
 #    import pysqlite2.dbapi2 as sqlite
@@ -42,6 +46,12 @@ import keepnote.notebook
 
 NULL = object()
 
+# markup for search result snippets
+SNIPPET_START = u"<b>"
+SNIPPET_END = u"</b>"
+SNIPPET_ELLIPSIS = u"..."
+SNIPPET_TOKENS = 15
+
 #=============================================================================
 
 
@@ -76,6 +86,138 @@ def read_data_as_plain_text(conn, nodeid):
         pass
 
 
+def test_fts5(cur, tmpname="fts5test"):
+    """
+    Returns True if fts5 extension is available
+    """
+    try:
+        cur.execute(u"DROP TABLE IF EXISTS %s;" % tmpname)
+        cur.execute(
+            "CREATE VIRTUAL TABLE %s USING fts5(col);" % tmpname)
+        cur.execute("DROP TABLE %s;" % tmpname)
+        return True
+    except Exception:
+        return False
+
+
+def test_fts5_trigram(cur, tmpname="fts5trigramtest"):
+    """
+    Returns True if the fts5 trigram tokenizer is available
+    """
+    try:
+        cur.execute(u"DROP TABLE IF EXISTS %s;" % tmpname)
+        cur.execute(
+            "CREATE VIRTUAL TABLE %s USING fts5(col, tokenize='trigram');" %
+            tmpname)
+        cur.execute("DROP TABLE %s;" % tmpname)
+        return True
+    except Exception:
+        return False
+
+
+def escape_like(text, escape=u"\\"):
+    """Escape the wildcards of a LIKE pattern"""
+    return (text.replace(escape, escape + escape)
+            .replace(u"%", escape + u"%")
+            .replace(u"_", escape + u"_"))
+
+
+def title_match_key(query, title):
+    """
+    Returns a sort key for a title matching 'query'
+
+    Titles sort as in search_node_titles(): exact matches, then prefix
+    matches, then other matches, and then alphabetically.
+    """
+    query = query.lower()
+    lower = title.lower()
+    if lower == query:
+        rank = 0
+    elif lower.startswith(query):
+        rank = 1
+    else:
+        rank = 2
+    return rank, title
+
+
+def fts3_rank(matchinfo):
+    """
+    Rank a fts3 match from its matchinfo(fulltext, 'pcx') blob
+
+    Each phrase hit is weighted by how rare the phrase is across all
+    rows.  As with fts5's bm25(), better matches have lower ranks.
+    """
+    info = struct.unpack("@%dI" % (len(matchinfo) // 4), matchinfo)
+    nphrases, ncols = info[:2]
+    rank = 0.0
+    for i in xrange(nphrases * ncols):
+        hits, total_hits = info[2 + 3*i:4 + 3*i]
+        if hits:
+            rank -= float(hits) / total_hits
+    return rank
+
+
+# fts5 query tokens: an optional exclusion '-', then a quoted phrase (which
+# may be left unterminated) or a bare word, and an optional prefix '*'
+_FTS5_TOKEN = re.compile(r'(-?)(?:"([^"]*)"?|([^\s"]+))')
+
+
+def make_fts5_query(text):
+    """
+    Convert a fts3 style query into a fts5 query
+
+    fts5 rejects bare punctuation, so every term is quoted.  Quoted text
+    ("exact phrase") is kept as a single phrase and prefix terms ("foo*")
+    keep their prefix search.  The boolean operators, which fts3 also
+    accepts, are kept when they sit between two terms and dropped
+    otherwise.  Excluded terms ("-foo") are excluded from the rest of the
+    query with NOT, which fts5 only accepts between two expressions.
+
+    Returns None if the query has nothing to match, such as a query with
+    only excluded terms.
+    """
+    def quote(term):
+        return u'"%s"' % term.replace(u'"', u'""')
+
+    terms = []
+    excluded = []
+    op = None
+    for match in _FTS5_TOKEN.finditer(text):
+        exclude, phrase, word = match.groups()
+        if phrase is not None:
+            # a phrase may be followed by a prefix '*'
+            term = phrase.strip()
+            prefix = text.startswith(u"*", match.end())
+        elif word in ("AND", "OR", "NOT") and not exclude:
+            # only keep operators that follow a term
+            if terms:
+                op = word
+            continue
+        else:
+            prefix = word.endswith(u"*")
+            term = word.rstrip(u"*")
+        if not term:
+            continue
+
+        term = quote(term) + (u"*" if prefix else u"")
+        if exclude:
+            excluded.append(term)
+        else:
+            if op:
+                terms.append(op)
+            terms.append(term)
+        op = None
+
+    if not terms:
+        return None
+    query = u" ".join(terms)
+    if excluded:
+        if len(terms) > 1:
+            query = u"(%s)" % query
+        query = u" NOT ".join([query] + excluded)
+    return query
+
+
 def test_fts3(cur, tmpname="fts3test"):
     """
     Returns True if fts3 extension is available
@@ -98,13 +240,16 @@ def test_fts3(cur, tmpname="fts3test"):
 class AttrIndex (object):
     """Indexing information for an attribute"""
 
-    def __init__(self, name, type, index_value=False):
+    def __init__(self, name, type, index_value=False, index_substring=False):
         self._name = name
         self._type = type
         self._table_name = "Attr_" + name
         self._index_name = "IdxAttr_" + name + "_nodeid"
         self._index_value = index_value
         self._index_value_name = "IdxAttr_" + name + "_value"
+        self._index_substring = index_substring
+        self._substring_table_name = "Substr_" + name
+        self._has_substring = False
 
     def get_name(self):
         return self._name
@@ -112,14 +257,28 @@ class AttrIndex (object):
     def get_table_name(self):
         return self._table_name
 
+    def get_substring_table_name(self):
+        return self._substring_table_name
+
+    def has_substring_index(self):
+        """Returns True if values can be searched by substring"""
+        return self._has_substring
+
     def init(self, cur):
         """Initialize attribute index for database"""
+        self.init_table(cur)
+        self.init_indexes(cur)
 
+    def init_table(self, cur):
+        """Create the attribute table without its secondary indexes"""
         cur.execute(u"""CREATE TABLE IF NOT EXISTS %s
                            (nodeid TEXT,
                             value %s,
                             UNIQUE(nodeid) ON CONFLICT REPLACE);
                         """ % (self._table_name, self._type))
+
+    def init_indexes(self, cur):
+        """Create the secondary indexes of the attribute table"""
         cur.execute(u"""CREATE INDEX IF NOT EXISTS %s
                            ON %s (nodeid);""" % (self._index_name,
                                                  self._table_name))
@@ -129,19 +288,79 @@ class AttrIndex (object):
                            ON %s (value);""" % (self._index_value_name,
                                                 self._table_name))
 
+        if self._index_substring:
+            self._has_substring = self.init_substring_index(cur)
+
+    def init_substring_index(self, cur):
+        """
+        Create a trigram index of values for substring searches
+
+        The trigram table indexes the rows of the attribute table, and
+        is kept up to date by triggers.  Returns True if the trigram
+        tokenizer is available.
+        """
+        if list(cur.execute(u"SELECT 1 FROM sqlite_master WHERE name = ?",
+                            (self._substring_table_name,))):
+            return True
+        if not test_fts5_trigram(cur):
+            return False
+
+        names = {"table": self._table_name,
+                 "substr": self._substring_table_name}
+        cur.execute(u"""CREATE VIRTUAL TABLE %(substr)s USING
+                        fts5(value, content='%(table)s', content_rowid='rowid',
+                             tokenize='trigram');""" % names)
+        cur.execute(u"""CREATE TRIGGER %(substr)s_insert
+                        AFTER INSERT ON %(table)s BEGIN
+                          INSERT INTO %(substr)s(rowid, value)
+                          VALUES (new.rowid, new.value);
+                        END;""" % names)
+        cur.execute(u"""CREATE TRIGGER %(substr)s_delete
+                        AFTER DELETE ON %(table)s BEGIN
+                          INSERT INTO %(substr)s(%(substr)s, rowid, value)
+                          VALUES ('delete', old.rowid, old.value);
+                        END;""" % names)
+        cur.execute(u"""CREATE TRIGGER %(substr)s_update
+                        AFTER UPDATE ON %(table)s BEGIN
+                          INSERT INTO %(substr)s(%(substr)s, rowid, value)
+                          VALUES ('delete', old.rowid, old.value);
+                          INSERT INTO %(substr)s(rowid, value)
+                          VALUES (new.rowid, new.value);
+                        END;""" % names)
+
+        # index any existing values
+        cur.execute(u"INSERT INTO %(substr)s(%(substr)s) VALUES ('rebuild');"
+                    % names)
+        return True
+
     def drop(self, cur):
         cur.execute(u"DROP TABLE IF EXISTS %s" % self._table_name)
+        cur.execute(u"DROP TABLE IF EXISTS %s" % self._substring_table_name)
 
     def add_node(self, cur, nodeid, attr):
-        val = attr.get(self._name, NULL)
+        val = self.get_value(attr)
         if val is not NULL:
             self.set(cur, nodeid, val)
 
+    def add_nodes(self, cur, rows):
+        """Add many (nodeid, value) rows to the index at once"""
+        cur.executemany(
+            u"""INSERT INTO %s VALUES (?, ?)""" % self._table_name, rows)
+
+    def get_value(self, attr):
+        """Returns the value to index from an attr dict, or NULL"""
+        return attr.get(self._name, NULL)
+
     def remove_node(self, cur, nodeid):
         """Remove node from index"""
         cur.execute(u"DELETE FROM %s WHERE nodeid=?" % self._table_name,
                     (nodeid,))
 
+    def remove_nodes(self, cur, select, args=()):
+        """Remove the nodes whose nodeids are returned by a SELECT query"""
+        cur.execute(u"DELETE FROM %s WHERE nodeid IN (%s)" %
+                    (self._table_name, select), args)
+
     def get(self, cur, nodeid):
         """Get information for a node from the index"""
         cur.execute(u"""SELECT value FROM %s WHERE nodeid = ?""" %
@@ -171,9 +390,11 @@ class NodeIndex (object):
         self._nconn = conn  # notebook connection
         self._attrs = {}    # attr indexes
         self._has_fulltext = False
+        self._fulltext_version = None
         self._use_fulltext = True
         self._open_node_fulltext = \
             lambda nodeid: read_data_as_plain_text(self._nconn, nodeid)
+        self._text_extractions = 0  # number of times text was extracted
 
     def set_conn(self, nconn):
         """Set NoteBookConnection"""
@@ -188,6 +409,19 @@ class NodeIndex (object):
     def set_open_fulltext_func(self, func):
         self._open_node_fulltext = func
 
+    def get_text_extraction_count(self):
+        """Returns the number of times node text has been extracted"""
+        return self._text_extractions
+
+    def get_node_text_fingerprint(self, nodeid):
+        """
+        Returns a string that changes whenever the node's data changes
+
+        Returns None if the data cannot be fingerprinted, in which case its
+        text is extracted on every update.
+        """
+        return None
+
     #===============================
     # add/remove/get attr indexing
 
@@ -215,17 +449,7 @@ class NodeIndex (object):
     def init_attrs(self, cur):
 
         # full text table
-        if test_fts3(cur):
-            # create fulltext table if it does not already exist
-            if not list(cur.execute(u"""SELECT 1 FROM sqlite_master
-                               WHERE name == 'fulltext';""")):
-                cur.execute(u"""CREATE VIRTUAL TABLE
-                            fulltext USING
-                            fts3(nodeid TEXT, content TEXT,
-                                 tokenize=porter);""")
-            self._has_fulltext = True
-        else:
-            self._has_fulltext = False
+        self._has_fulltext = self.init_fulltext(cur)
 
         # TODO: make an Attr table
         # this will let me query whether an attribute is currently being
@@ -239,9 +463,57 @@ class NodeIndex (object):
         for attr in self._attrs.itervalues():
             attr.init(cur)
 
+    def init_fulltext(self, cur):
+        """
+        Create the fulltext table if it does not already exist
+
+        fts5 is used when available, otherwise fts3.  An existing table
+        keeps its version until the index is cleared.
+        Returns True if fulltext indexing is available.
+        """
+        rows = list(cur.execute(u"""SELECT sql FROM sqlite_master
+                           WHERE name == 'fulltext';"""))
+        if rows:
+            if "fts5" in rows[0][0].lower():
+                self._fulltext_version = 5
+            else:
+                self._fulltext_version = 3
+
+        elif test_fts5(cur):
+            cur.execute(u"""CREATE VIRTUAL TABLE
+                        fulltext USING
+                        fts5(nodeid UNINDEXED, content,
+                             tokenize=porter);""")
+            self._fulltext_version = 5
+
+        elif test_fts3(cur):
+            cur.execute(u"""CREATE VIRTUAL TABLE
+                        fulltext USING
+                        fts3(nodeid TEXT, content TEXT,
+                             tokenize=porter);""")
+            self._fulltext_version = 3
+
+        else:
+            self._fulltext_version = None
+            return False
+
+        # fingerprints of the data that the indexed text was extracted from
+        cur.execute(u"""CREATE TABLE IF NOT EXISTS FulltextFingerprint
+                       (nodeid TEXT PRIMARY KEY, fingerprint TEXT);""")
+        return True
+
     def drop_attrs(self, cur):
 
         cur.execute(u"DROP TABLE IF EXISTS fulltext;")
+        cur.execute(u"DROP TABLE IF EXISTS FulltextFingerprint;")
+
+        # drop substring tables, but not their shadow tables
+        table_names = [x for (x,) in cur.execute(
+            u"""SELECT name FROM sqlite_master WHERE name LIKE 'Substr_%'
+                AND sql LIKE 'CREATE VIRTUAL TABLE%'""")]
+
+        for table_name in table_names:
+            cur.execute(u"""DROP TABLE %s;""" % table_name)
 
         # drop attribute tables
         table_names = [x for (x,) in cur.execute(
@@ -259,10 +531,15 @@ class NodeIndex (object):
         for attrindex in self._attrs.itervalues():
             attrindex.add_node(cur, nodeid, attr)
 
-        # update fulltext
-        if fulltext:
-            infile = self._open_node_fulltext(nodeid)
-            self._index_node_text(cur, nodeid, attr, infile)
+        # update fulltext, unless the node's text is unchanged
+        if fulltext and self._has_fulltext:
+            fingerprint = self._get_text_fingerprint(nodeid, attr)
+            if (fingerprint is None or
+                    fingerprint != self._get_stored_fingerprint(cur, nodeid)):
+                infile = self._open_node_fulltext(nodeid)
+                self._text_extractions += 1
+                self._index_node_text(cur, nodeid, attr, infile)
+                self._set_stored_fingerprint(cur, nodeid, fingerprint)
 
     def remove_node_attr(self, cur, nodeid):
 
@@ -272,6 +549,21 @@ class NodeIndex (object):
 
         self._remove_text(cur, nodeid)
 
+    def remove_nodes_attr(self, cur, select, args=()):
+        """
+        Remove the attrs and text of many nodes at once
+
+        select -- a SELECT query returning the nodeids to remove
+        """
+        for attr in self._attrs.itervalues():
+            attr.remove_nodes(cur, select, args)
+
+        if self._has_fulltext:
+            cur.execute(u"DELETE FROM fulltext WHERE nodeid IN (%s)" %
+                        select, args)
+            cur.execute(u"""DELETE FROM FulltextFingerprint
+                            WHERE nodeid IN (%s)""" % select, args)
+
     def get_node_attr(self, cur, nodeid, key):
         """Query indexed attribute for a node"""
         attr = self._attrs.get(key, None)
@@ -285,20 +577,79 @@ class NodeIndex (object):
 
     def search_node_contents(self, cur, text):
 
-        # TODO: implement fully general fix
-        # crude cleaning
-        text = text.replace('"', "")
-
         # fallback if fts3 is not available
         if not self._has_fulltext or not self._use_fulltext:
+            text = text.replace('"', "")
             words = [x.lower() for x in text.strip().split()]
             return self.search_node_contents_manual(cur, words)
 
-        # search db with fts3
+        # search db with fts3/fts5
+        if self._fulltext_version == 5:
+            text = make_fts5_query(text)
+            if text is None:
+                return iter([])
+        else:
+            # TODO: implement fully general fix
+            # crude cleaning
+            text = text.replace('"', "")
         res = cur.execute("""SELECT nodeid FROM fulltext
-                             WHERE content MATCH ?;""", (text,))
+                             WHERE %s MATCH ?;""" % self._get_match_column(),
+                          (text,))
         return (row[0] for row in res)
 
+    def search_node_contents_ranked(self, cur, text, limit=None, offset=0):
+        """
+        Search node contents and return ranked results
+
+        Returns a list of (nodeid, title, rank, snippet) ordered from best
+        to worst match.  Lower ranks are better.  Use 'limit' and 'offset'
+        to page through the results.
+        """
+        # fallback if fulltext is not available
+        if not self._has_fulltext or not self._use_fulltext:
+            text = text.replace('"', "")
+            words = [x.lower() for x in text.strip().split()]
+            nodeids = (nodeid for nodeid in
+                       self.search_node_contents_manual(cur, words)
+                       if nodeid)
+            stop = None if limit is None else offset + limit
+            return [(nodeid, self._nconn.read_node(nodeid).get("title"),
+                     0.0, None)
+                    for nodeid in islice(nodeids, offset, stop)]
+
+        if self.has_attr("title"):
+            title_join = (
+                u"LEFT JOIN %s AS t ON t.nodeid = fulltext.nodeid" %
+                self.get_attr_index("title").get_table_name())
+            title_col = u"t.value"
+        else:
+            title_join = u""
+            title_col = u"NULL"
+
+        if self._fulltext_version == 5:
+            text = make_fts5_query(text)
+            if text is None:
+                return []
+            rank = u"bm25(fulltext)"
+            snippet = u"snippet(fulltext, 1, '%s', '%s', '%s', %d)"
+        else:
+            cur.connection.create_function("fts3_rank", 1, fts3_rank)
+            rank = u"fts3_rank(matchinfo(fulltext, 'pcx'))"
+            text = text.replace('"', "")
+            snippet = u"snippet(fulltext, '%s', '%s', '%s', 1, %d)"
+        snippet = snippet % (SNIPPET_START, SNIPPET_END, SNIPPET_ELLIPSIS,
+                             SNIPPET_TOKENS)
+
+        res = cur.execute(
+            u"""SELECT fulltext.nodeid, %s, %s AS rank, %s
+                FROM fulltext %s
+                WHERE fulltext.%s MATCH ?
+                ORDER BY rank
+                LIMIT ? OFFSET ?;""" % (title_col, rank, snippet, title_join,
+                                        self._get_match_column()),
+            (text, -1 if limit is None else limit, offset))
+        return list(res)
+
     def search_node_contents_manual(self, cur, words):
         """Recursively search nodes under node for occurrence of words"""
 
@@ -323,30 +674,87 @@ class NodeIndex (object):
             children = self._nconn._list_children_nodeids(nodeid)
             stack.extend(children)
 
-    def search_node_titles(self, cur, query):
-        """Return nodeids of nodes with matching titles"""
+    def search_node_titles(self, cur, query, limit=None):
+        """
+        Return (nodeid, title) of nodes with titles containing 'query'
+
+        Titles are ordered by exact matches, then prefix matches, then
+        other matches, and then alphabetically.
+        """
 
         # TODO: can this be generalized?
         # similar to get_node_attr(nodeid, attr)
 
         if not self.has_attr("title"):
             return []
-
-        # order titles by exact matches and then alphabetically
-        cur.execute(
-            u"""SELECT nodeid, value FROM %s WHERE value LIKE ?
-                           ORDER BY value != ?, value """ %
-            self.get_attr_index("title").get_table_name(),
-            (u"%" + query + u"%", query))
+        attrindex = self.get_attr_index("title")
+        table = attrindex.get_table_name()
+
+        order = u"""CASE WHEN value = ? COLLATE NOCASE THEN 0
+                         WHEN value LIKE ? ESCAPE '\\' THEN 1
+                         ELSE 2 END, value"""
+        args = [query, escape_like(query) + u"%"]
+        if limit is None:
+            limit = -1
+
+        # trigrams cannot match queries shorter than three characters
+        if attrindex.has_substring_index() and len(query) >= 3:
+            substr = attrindex.get_substring_table_name()
+            cur.execute(
+                u"""SELECT nodeid, value FROM %s
+                    WHERE rowid IN (SELECT rowid FROM %s WHERE %s MATCH ?)
+                    ORDER BY %s LIMIT ?""" %
+                (table, substr, substr, order),
+                [u'"%s"' % query.replace(u'"', u'""')] + args + [limit])
+        else:
+            cur.execute(
+                u"""SELECT nodeid, value FROM %s
+                    WHERE value LIKE ? ESCAPE '\\'
+                    ORDER BY %s LIMIT ?""" % (table, order),
+                [u"%" + escape_like(query) + u"%"] + args + [limit])
 
         return list(cur.fetchall())
 
     #=================================
     # helper functions
 
+    def _get_match_column(self):
+        # fts5 does not index nodeid, so the whole table can be matched
+        if self._fulltext_version == 5:
+            return u"fulltext"
+        else:
+            return u"content"
+
+    def _get_node_text(self, attr, infile):
+        return attr.get("title", "") + "\n" + "".join(infile)
+
+    def _get_text_fingerprint(self, nodeid, attr):
+        """Fingerprint of the node's data and title, or None"""
+        fingerprint = self.get_node_text_fingerprint(nodeid)
+        if fingerprint is None:
+            return None
+        title = attr.get("title", u"")
+        if isinstance(title, unicode):
+            title = title.encode("utf8")
+        return u"%s:%s" % (fingerprint, hashlib.md5(title).hexdigest())
+
+    def _get_stored_fingerprint(self, cur, nodeid):
+        cur.execute(u"""SELECT fingerprint FROM FulltextFingerprint
+                        WHERE nodeid = ?""", (nodeid,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def _set_stored_fingerprint(self, cur, nodeid, fingerprint):
+        if fingerprint is None:
+            cur.execute(u"DELETE FROM FulltextFingerprint WHERE nodeid = ?",
+                        (nodeid,))
+        else:
+            cur.execute(u"""INSERT OR REPLACE INTO FulltextFingerprint
+                            VALUES (?, ?)""", (nodeid, fingerprint))
+
     def _index_node_text(self, cur, nodeid, attr, infile):
 
-        text = attr.get("title", "") + "\n" + "".join(infile)
+        text = self._get_node_text(attr, infile)
         self._insert_text(cur, nodeid, text)
 
     def _insert_text(self, cur, nodeid, text):
@@ -362,9 +770,27 @@ class NodeIndex (object):
             cur.execute(u"INSERT INTO fulltext VALUES (?, ?);",
                         (nodeid, text))
 
+    def _insert_texts(self, cur, texts, replace=()):
+        """
+        Insert many (nodeid, text) rows into the fulltext index
+
+        replace -- nodeids whose existing text must be removed first
+        """
+        if not self._has_fulltext:
+            return
+
+        # nodeid is not indexed within fulltext, so each delete is a scan
+        cur.executemany(u"DELETE FROM fulltext WHERE nodeid = ?",
+                        ((nodeid,) for nodeid in replace))
+        cur.executemany(u"DELETE FROM FulltextFingerprint WHERE nodeid = ?",
+                        ((nodeid,) for nodeid in replace))
+        cur.executemany(u"INSERT INTO fulltext VALUES (?, ?);", texts)
+
     def _remove_text(self, cur, nodeid):
 
         if not self._has_fulltext:
             return
 
         cur.execute(u"DELETE FROM fulltext WHERE nodeid = ?", (nodeid,))
+        cur.execute(u"DELETE FROM FulltextFingerprint WHERE nodeid = ?",
+                    (nodeid,))
@@ -205,11 +205,13 @@ class NoteBookConnectionMem (NoteBookConnection):
         # also plug-ability will ensure safer fall back to unhandeled queries
 
         # built-in queries
-        # ["index_attr", key, (index_value)]
-        # ["search", "title", text]
+        # ["index_attr", key, (index_value), (index_substring)]
+        # ["search", "title", text, (limit)]
         # ["search_fulltext", text]
+        # ["search_fulltext_ranked", text, limit, offset]
         # ["has_fulltext"]
         # ["node_path", nodeid]
+        # ["node_paths", nodeids]
         # ["get_attr", nodeid, key]
 
         if query[0] == "index_attr":
@@ -217,11 +219,12 @@ class NoteBookConnectionMem (NoteBookConnection):
 
         elif query[0] == "search":
             assert query[1] == "title"
+            limit = query[3] if len(query) >= 4 else None
             return [(nodeid, node.attr["title"])
                     for nodeid, node in self._nodes.iteritems()
-                    if query[2] in node.attr.get("title", "")]
+                    if query[2] in node.attr.get("title", "")][:limit]
 
-        elif query[0] == "search_fulltext":
+        elif query[0] in ("search_fulltext", "search_fulltext_ranked"):
             # TODO: could implement brute-force backup
             return []
 
@@ -242,6 +245,10 @@ class NoteBookConnectionMem (NoteBookConnection):
             path.reverse()
             return path
 
+        elif query[0] == "node_paths":
+            return dict((nodeid, self.index(["node_path", nodeid]))
+                        for nodeid in query[1])
+
         elif query[0] == "get_attr":
             return self._nodes[query[1]][query[2]]
 
@@ -257,3 +264,9 @@ class NoteBookConnectionMem (NoteBookConnection):
 
         elif query[0] == "index_all":
             return
+
+        elif query[0] == "rebuild":
+            return
+
+        elif query[0] == "refresh":
+            return
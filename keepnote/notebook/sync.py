@@ -100,7 +100,9 @@ def sync_files(conn1, nodeid1, conn2, nodeid2, path1="/", path2="/"):
     # copy files from node1 to node2
     for f in files:
         file1 = f
-        file2 = path_join(path2, f[len(path1):])
+        # files listed under the root path "/" have no leading "/"
+        name = f[len(path1):] if f.startswith(path1) else f
+        file2 = path_join(path2, name)
 
         if f.endswith("/"):
             # recurse into directories
@@ -113,6 +115,11 @@ def sync_files(conn1, nodeid1, conn2, nodeid2, path1="/", path2="/"):
 def copy_file(conn1, nodeid1, file1, conn2, nodeid2, file2):
     """Copy a file from conn1.nodeid1.file1 to conn2.nodeid2.file2"""
 
+    if conn1 is conn2:
+        # let the connection copy the file, such as by linking it
+        conn1.copy_file(nodeid1, file1, nodeid2, file2)
+        return
+
     stream1 = conn1.open_file(nodeid1, file1, "r")
     stream2 = conn2.open_file(nodeid2, file2, "w")
 
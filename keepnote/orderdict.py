@@ -39,6 +39,10 @@ class OrderDict (dict):
             dict.__init__(self, *args, **kargs)
             self._order = dict.keys(self)
 
+    def __reduce__(self):
+        # items must be restored after __init__ has created the key order
+        return (self.__class__, (), None, None, self.iteritems())
+
     # The following methods keep names in sync with dictionary keys
     def __setitem__(self, key, value):
         if key not in self:
@@ -109,6 +109,49 @@ def load_etree(elm):
     return elm.text
 
 
+# unmarshallers for element text of simple types
+_text_unmarshallers = {
+    "key": lambda text: text or u"",
+    "string": lambda text: text or u"",
+    "data": lambda text: Data(base64.decodestring(text or u"")),
+    "date": lambda text: datetime.datetime(*map(int, re.findall("\d+", text))),
+    "true": lambda text: True,
+    "false": lambda text: False,
+    "real": float,
+    "integer": int,
+    "null": lambda text: None
+}
+
+
+def load_element(elm):
+    """
+    Returns the value of a plist element
+
+    Unlike load_etree(), the element is left unchanged and simple values
+    are converted without visiting their elements recursively.
+    """
+    unmarshal = _text_unmarshallers.get(elm.tag)
+    if unmarshal:
+        return unmarshal(elm.text)
+
+    children = list(elm)
+    if elm.tag == "dict":
+        items = []
+        for i in xrange(0, len(children), 2):
+            key, value = children[i], children[i+1]
+            unmarshal = _text_unmarshallers.get(value.tag)
+            items.append((key.text or u"",
+                          unmarshal(value.text) if unmarshal
+                          else load_element(value)))
+        return OrderDict(iter(items))
+
+    elif elm.tag == "array":
+        return [load_element(child) for child in children]
+
+    else:
+        raise IOError("unknown plist type: %r" % elm.tag)
+
+
 def dump(elm, out=sys.stdout, indent=0, depth=0, suppress=False):
 
     if indent and not suppress:
@@ -28,6 +28,7 @@ import codecs
 import os
 import sys
 import tempfile
+import threading
 
 
 # NOTE: bypass easy_install's monkey patching of file
@@ -37,17 +38,104 @@ if type(file) != type:
     file = type(sys.stdout)
 
 
-def open(filename, mode="r", tmp=None, codec=None):
+# durability levels of written files
+#   strict  -- fsync the file before the rename and its directory after
+#   default -- fsync the file before the rename
+#   relaxed -- rename only.  Files are fsynced by sync(), which also runs
+#              in the background RELAXED_SYNC_INTERVAL seconds after a
+#              relaxed file is written.
+DURABILITY_STRICT = "strict"
+DURABILITY_DEFAULT = "default"
+DURABILITY_RELAXED = "relaxed"
+DURABILITY_LEVELS = (DURABILITY_STRICT, DURABILITY_DEFAULT, DURABILITY_RELAXED)
+
+RELAXED_SYNC_INTERVAL = 5.0
+
+_durability = DURABILITY_DEFAULT
+_unsynced = set()       # files written with relaxed durability
+_unsynced_lock = threading.Lock()
+_sync_timer = None      # timer of the next background sync()
+
+
+def set_durability(durability):
+    """Set the durability level used when none is given to open()"""
+    global _durability
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError("unknown durability level '%s'" % durability)
+    _durability = durability
+
+
+def get_durability():
+    """Returns the durability level used when none is given to open()"""
+    return _durability
+
+
+def fsync_dir(path):
+    """Flush the entries of a directory to disk"""
+    if sys.platform.startswith("win"):
+        # directories cannot be opened on windows
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync():
+    """Flush files written with relaxed durability to disk"""
+    global _sync_timer
+
+    with _unsynced_lock:
+        filenames = list(_unsynced)
+        _unsynced.clear()
+        if _sync_timer is not None:
+            _sync_timer.cancel()
+            _sync_timer = None
+
+    dirs = set()
+    for filename in filenames:
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            dirs.add(os.path.dirname(filename) or ".")
+        except OSError:
+            # file has since been removed
+            pass
+    for path in dirs:
+        try:
+            fsync_dir(path)
+        except OSError:
+            pass
+
+
+def _add_unsynced(filename):
+    """Remember a file written with relaxed durability and schedule a sync"""
+    global _sync_timer
+
+    with _unsynced_lock:
+        _unsynced.add(filename)
+        if _sync_timer is None:
+            _sync_timer = threading.Timer(RELAXED_SYNC_INTERVAL, sync)
+            _sync_timer.daemon = True
+            _sync_timer.start()
+
+
+def open(filename, mode="r", tmp=None, codec=None, durability=None):
     """
     Opens a file that writes to a temp location and replaces existing file
     on close.
 
-    filename -- filename to open
-    mode     -- write mode (default: 'w')
-    tmp      -- specify tempfile
-    codec    -- preferred encoding
+    filename   -- filename to open
+    mode       -- write mode (default: 'w')
+    tmp        -- specify tempfile
+    codec      -- preferred encoding
+    durability -- durability level (default: get_durability())
     """
-    stream = SafeFile(filename, mode, tmp)
+    stream = SafeFile(filename, mode, tmp, durability)
 
     if "b" not in mode and codec:
         if "r" in mode:
@@ -60,20 +148,29 @@ def open(filename, mode="r", tmp=None, codec=None):
 
 class SafeFile (file):
 
-    def __init__(self, filename, mode="r", tmp=None):
+    def __init__(self, filename, mode="r", tmp=None, durability=None):
         """
-        filename -- filename to open
-        mode     -- write mode (default: 'w')
-        tmp      -- specify tempfile
+        filename   -- filename to open
+        mode       -- write mode (default: 'w')
+        tmp        -- specify tempfile
+        durability -- durability level (default: get_durability())
         """
+        if durability is None:
+            durability = _durability
+        elif durability not in DURABILITY_LEVELS:
+            raise ValueError("unknown durability level '%s'" % durability)
 
-        # set tempfile
+        # set tempfile next to the file, so that the rename stays
+        # within one filesystem
         if "w" in mode and tmp is None:
-            f, tmp = tempfile.mkstemp(".tmp", filename+"_", dir=".")
+            f, tmp = tempfile.mkstemp(
+                ".tmp", os.path.basename(filename) + "_",
+                dir=os.path.dirname(filename) or ".")
             os.close(f)
 
         self._tmp = tmp
         self._filename = filename
+        self._durability = durability
 
         # open file
         if self._tmp:
@@ -83,20 +180,36 @@ class SafeFile (file):
 
     def close(self):
         """Closes file and moves temp file to final location"""
+        if "r" in self.mode and "+" not in self.mode:
+            # nothing was written
+            file.close(self)
+            return
+
         try:
             self.flush()
-            os.fsync(self.fileno())
+            if self._durability != DURABILITY_RELAXED:
+                os.fsync(self.fileno())
         except:
             pass
         file.close(self)
 
-        if self._tmp:
-            # NOTE: windows will not allow rename when destination file exists
-            if sys.platform.startswith("win"):
-                if os.path.exists(self._filename):
-                    os.remove(self._filename)
-            os.rename(self._tmp, self._filename)
-            self._tmp = None
+        if not self._tmp:
+            return
+
+        # NOTE: windows will not allow rename when destination file exists
+        if sys.platform.startswith("win"):
+            if os.path.exists(self._filename):
+                os.remove(self._filename)
+        os.rename(self._tmp, self._filename)
+        self._tmp = None
+
+        if self._durability == DURABILITY_STRICT:
+            try:
+                fsync_dir(os.path.dirname(self._filename) or ".")
+            except OSError:
+                pass
+        elif self._durability == DURABILITY_RELAXED:
+            _add_unsynced(os.path.abspath(self._filename))
 
     def discard(self):
         """
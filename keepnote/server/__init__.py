@@ -207,6 +207,26 @@ class BaseNoteBookHttpServer(object):
 
             return self.json_response(result)
 
+        elif 'batch' in request.query:
+            # Apply a batch of node operations.
+            data = request.body.read()
+            ops = json.loads(data)
+            self.apply_batch(ops)
+            return self.json_response(None)
+
+    def apply_batch(self, ops):
+        """
+        Apply a batch of node operations.
+        """
+        try:
+            self.conn.apply_batch(ops)
+        except connlib.NodeExists, e:
+            keepnote.log_error()
+            abort(FORBIDDEN, 'node already exists.' + str(e))
+        except connlib.UnknownNode, e:
+            keepnote.log_error()
+            abort(NOT_FOUND, 'node not found ' + str(e))
+
     def read_root_view(self):
         """
         Return notebook root nodeid.
@@ -408,6 +428,17 @@ class BaseNoteBookHttpServer(object):
 
 class NoteBookHttpServer(BaseNoteBookHttpServer):
 
+    def apply_batch(self, ops):
+        """
+        Apply a batch of node operations.
+        """
+        # Enforce notebook scheme, nodeid is required.
+        for action, nodeid, attr in ops:
+            if action == "create":
+                attr['nodeid'] = nodeid
+
+        BaseNoteBookHttpServer.apply_batch(self, ops)
+
     def create_node_view(self, nodeid=None):
         """
         Create new notebook node.
@@ -32,6 +32,7 @@ class TestConnBase (unittest.TestCase):
         self._test_update_node(conn)
         self._test_delete_node(conn)
         self._test_unknown_node(conn)
+        self._test_batch(conn)
 
     def _test_create_read_node(self, conn):
 
@@ -70,6 +71,11 @@ class TestConnBase (unittest.TestCase):
             attr2 = conn.read_node(nodeid)
             self.assertEqual(attr, attr2)
 
+        # Read several nodes at once.
+        nodeids = ['create%d' % i for i in reversed(range(len(attrs)))]
+        self.assertEqual(conn.read_nodes(nodeids), list(reversed(attrs)))
+        conn.prefetch_nodes(nodeids)
+
         # Double create should fail.
         conn.create_node('double_create', {})
         self.assertRaises(connlib.NodeExists,
@@ -121,6 +127,27 @@ class TestConnBase (unittest.TestCase):
         self.assertRaises(connlib.UnknownNode,
                           lambda: conn.delete_node('unknown_node'))
 
+    def _test_batch(self, conn):
+        conn.create_node('batch_delete', {})
+        conn.apply_batch([
+            ('create', 'batch1', {'key1': 1}),
+            ('create', 'batch2', {'key1': 2}),
+            ('update', 'batch1', {'key1': 3}),
+            ('delete', 'batch_delete', None),
+        ])
+        self.assertEqual(conn.read_node('batch1'), {'key1': 3})
+        self.assertEqual(conn.read_node('batch2'), {'key1': 2})
+        self.assertFalse(conn.has_node('batch_delete'))
+
+        # A batch stops at the first error.
+        self.assertRaises(connlib.NodeExists, lambda: conn.apply_batch([
+            ('create', 'batch3', {}),
+            ('create', 'batch1', {}),
+            ('create', 'batch4', {}),
+        ]))
+        self.assertTrue(conn.has_node('batch3'))
+        self.assertFalse(conn.has_node('batch4'))
+
     def _test_files(self, conn):
 
         # Create empty node.
@@ -1,19 +1,42 @@
 
 # python imports
 import os
+import shutil
+import threading
+import time
+import xml.etree.cElementTree as ET
 
 # keepnote imports
+from keepnote import notebook
+from keepnote import plist
 from keepnote.notebook import NOTEBOOK_FORMAT_VERSION
 import keepnote.notebook.connection as connlib
 from keepnote.notebook.connection import fs
+from keepnote.notebook import sync
 
 from .test_notebook_conn import TestConnBase
 from . import clean_dir
+from . import DATA_DIR
 from . import TMP_DIR
 
 _tmpdir = TMP_DIR + '/notebook_conn/'
 
 
+def iter_meta_files(path):
+    """Iterate through the node.xml files under a path."""
+    for dirpath, dirnames, filenames in os.walk(path):
+        if 'node.xml' in filenames:
+            yield os.path.join(dirpath, 'node.xml')
+
+
+def read_attr_etree(filename):
+    """Read node attr by loading the whole element tree."""
+    root = ET.ElementTree(file=filename).getroot()
+    for child in root:
+        if child.tag == 'dict':
+            return plist.load_etree(child)
+
+
 class TestConnFS (TestConnBase):
 
     def test_api(self):
@@ -52,6 +75,133 @@ class TestConnFS (TestConnBase):
         self.assertEqual(fs.get_orphandir('path', 'a'),
                          'path/__NOTEBOOK__/orphans/a')
 
+    def test_read_attr(self):
+        """read_attr() matches loading the whole element tree."""
+        filenames = list(iter_meta_files(DATA_DIR + '/notebook-v6'))
+        self.assertTrue(len(filenames) > 0)
+
+        for filename in filenames:
+            expected = read_attr_etree(filename)
+            attr, extra = fs.read_attr(filename, set_extra=False)
+            self.assertEqual(attr, expected)
+            self.assertEqual(attr.keys(), expected.keys())
+            self.assertEqual([type(value) for value in attr.values()],
+                             [type(value) for value in expected.values()])
+            self.assertEqual(extra['nodeid'], attr['nodeid'])
+
+    def _test_read_attr_speed(self):
+        """Benchmark read_attr() on many copies of a notebook."""
+        copies = 200
+        path = _tmpdir + '/notebook_read_attr'
+        clean_dir(path)
+        os.makedirs(path)
+        for i in xrange(copies):
+            shutil.copytree(DATA_DIR + '/notebook-v6', '%s/%d' % (path, i))
+        filenames = list(iter_meta_files(path))
+
+        start = time.time()
+        for filename in filenames:
+            read_attr_etree(filename)
+        etree_time = time.time() - start
+
+        start = time.time()
+        for filename in filenames:
+            fs.read_attr(filename)
+        fast_time = time.time() - start
+
+        print
+        print 'files', len(filenames)
+        print 'etree read_attr', etree_time
+        print 'fast read_attr', fast_time
+        clean_dir(path)
+
+    def test_path_cache(self):
+        """Test memoized paths of PathCache."""
+        cache = fs.PathCache('root', 'r')
+        cache.add('a', 'a', 'root')
+        cache.add('b', 'b', 'a')
+        cache.add('c', 'c', 'b')
+        self.assertEqual(cache.get_path('c'), os.path.join('r', 'a', 'b', 'c'))
+        self.assertEqual(cache.get_path('b'), os.path.join('r', 'a', 'b'))
+
+        # Renaming invalidates the paths of descendants.
+        cache.move('a', 'a2', 'root')
+        self.assertEqual(cache.get_path('c'),
+                         os.path.join('r', 'a2', 'b', 'c'))
+
+        # Moving a node.
+        cache.add('d', 'd', 'root')
+        cache.move('b', 'b', 'd')
+        self.assertEqual(cache.get_path('c'), os.path.join('r', 'd', 'b', 'c'))
+        self.assertEqual(cache.get_parentid('b'), 'd')
+
+        # Re-adding a node under a new name.
+        cache.add('b', 'b2', 'd')
+        self.assertEqual(cache.get_path('c'),
+                         os.path.join('r', 'd', 'b2', 'c'))
+
+        # Paths of nodes with unknown ancestors are not cached.
+        cache.add('e', 'e', 'unknown')
+        self.assertEqual(cache.get_path('e'), None)
+
+        # Removing a subtree.
+        cache.remove_subtree('d')
+        self.assertFalse(cache.has_node('c'))
+        self.assertEqual(cache.get_path('c'), None)
+        self.assertEqual(cache.get_path('a'), os.path.join('r', 'a2'))
+
+        # Children.
+        cache.set_children_complete('a', True)
+        self.assertEqual(list(cache.get_children('a')), [])
+
+    def _test_path_cache_memory(self):
+        """Benchmark memory and lookups of PathCache on many nodes."""
+        import sys
+
+        class OldPathCacheNode (object):
+            def __init__(self, nodeid, basename, parent):
+                self.nodeid = nodeid
+                self.basename = basename
+                self.parent = parent
+                self.children = set()
+                self.children_complete = False
+
+        def node_size(node):
+            size = sys.getsizeof(node)
+            if hasattr(node, '__dict__'):
+                size += sys.getsizeof(node.__dict__)
+            if node.children is not None:
+                size += sys.getsizeof(node.children)
+            return size
+
+        nnodes = 100000
+        cache = fs.PathCache('root', 'r')
+        for i in xrange(nnodes):
+            parentid = 'n%d' % (i // 10) if i >= 10 else 'root'
+            cache.add('n%d' % i, 'n%d' % i, parentid)
+        nodes = [cache._nodes['n%d' % i] for i in xrange(nnodes)]
+        old_nodes = [OldPathCacheNode(node.nodeid, node.basename, None)
+                     for node in nodes]
+        for i, node in enumerate(old_nodes[10:], 10):
+            old_nodes[i // 10].children.add(node)
+
+        start = time.time()
+        for i in xrange(nnodes):
+            cache.get_path('n%d' % i)
+        first_time = time.time() - start
+
+        start = time.time()
+        for i in xrange(nnodes):
+            cache.get_path('n%d' % i)
+        memo_time = time.time() - start
+
+        print
+        print 'nodes', nnodes
+        print 'old node bytes', sum(node_size(node) for node in old_nodes)
+        print 'new node bytes', sum(node_size(node) for node in nodes)
+        print 'get_path first', first_time
+        print 'get_path memoized', memo_time
+
     def test_fs_schema(self):
         """Test NoteBook-specific schema behavior."""
         notebook_file = _tmpdir + '/notebook_nodes'
@@ -197,3 +347,499 @@ class TestConnFS (TestConnBase):
 
         # Clean up.
         conn.close()
+
+    def test_attr_cache(self):
+        """Read node attr from the attr cache."""
+        notebook_file = _tmpdir + '/notebook_attr_cache'
+        clean_dir(notebook_file)
+
+        # Create nodes.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        conn.create_node('root', {'parentids': [], 'title': 'Root'})
+        conn.create_node('a', {'parentids': ['root'], 'title': 'A',
+                               'tags': ['x', 'y'],
+                               'info': {'width': 10, 'height': 2.5}})
+        conn.create_node('b', {'parentids': ['root'], 'title': 'B'})
+        expected = {'root': conn.read_node('root'),
+                    'a': conn.read_node('a'),
+                    'b': conn.read_node('b')}
+        conn.close()
+        cache_file = os.path.join(notebook_file, fs.NOTEBOOK_META_DIR,
+                                  fs.ATTR_CACHE_FILE)
+        self.assertTrue(os.path.exists(cache_file))
+
+        # Count node.xml parses.
+        reads = []
+        read_attr = fs.read_attr
+
+        def counting_read_attr(filename, *args, **kargs):
+            reads.append(filename)
+            return read_attr(filename, *args, **kargs)
+        fs.read_attr = counting_read_attr
+
+        try:
+            # Cached attr are identical and need no parsing.
+            conn = fs.NoteBookConnectionFS()
+            conn.connect(notebook_file)
+            for nodeid in ['root', 'a', 'b']:
+                # Children may be listed in another order.
+                attr = conn.read_node(nodeid)
+                self.assertEqual(sorted(attr.pop('childrenids')),
+                                 sorted(expected[nodeid].pop('childrenids')))
+                self.assertEqual(attr, expected[nodeid])
+                self.assertEqual(attr.keys(), expected[nodeid].keys())
+            self.assertEqual(reads, [])
+
+            # An edited node.xml is parsed again.
+            attr = conn.read_node('b')
+            path = conn.get_node_path('b')
+            time.sleep(.01)
+            fs.write_attr(os.path.join(path, 'node.xml'), 'b',
+                          dict(attr, title='B2'))
+            # Outside changes are seen once the stat cache expires.
+            conn.get_stat_cache().clear()
+            self.assertEqual(conn.read_node('b')['title'], 'B2')
+            self.assertEqual(len(reads), 1)
+            self.assertEqual(conn.read_node('b')['title'], 'B2')
+            self.assertEqual(len(reads), 1)
+            conn.close()
+
+            # A damaged cache file is discarded.
+            with open(cache_file, 'wb') as out:
+                out.write('garbage')
+            del reads[:]
+            conn = fs.NoteBookConnectionFS()
+            conn.connect(notebook_file)
+            attr = conn.read_node('a')
+            del attr['childrenids']
+            self.assertEqual(attr, expected['a'])
+            self.assertTrue(len(reads) > 0)
+            conn.close()
+        finally:
+            fs.read_attr = read_attr
+
+    def test_name_cache(self):
+        """Pick unique node and file names from cached directory names."""
+        notebook_file = _tmpdir + '/notebook_name_cache'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        conn.create_node('root', {'parentids': [], 'title': 'Root'})
+
+        # Count directory listings.
+        listings = []
+        listdir = os.listdir
+
+        def counting_listdir(path):
+            listings.append(path)
+            return listdir(path)
+        os.listdir = counting_listdir
+
+        try:
+            for i in range(20):
+                conn.create_node('n%d' % i, {'parentids': ['root'],
+                                             'title': 'Page'})
+            self.assertEqual(listings.count(notebook_file), 1)
+        finally:
+            os.listdir = listdir
+
+        self.assertEqual(
+            [conn.get_node_basename('n%d' % i) for i in range(20)],
+            ['page'] + ['page %d' % i for i in range(2, 21)])
+
+        # Unmanaged changes are detected.
+        os.mkdir(os.path.join(notebook_file, 'page 21'))
+        conn.create_node('n20', {'parentids': ['root'], 'title': 'Page'})
+        self.assertEqual(conn.get_node_basename('n20'), 'page 22')
+
+        # Names of deleted and moved nodes are reused.
+        conn.delete_node('n1')
+        conn.create_node('n21', {'parentids': ['root'], 'title': 'Page'})
+        self.assertEqual(conn.get_node_basename('n21'), 'page 2')
+        attr = conn.read_node('n2')
+        attr['parentids'] = ['n0']
+        conn.update_node('n2', attr)
+        self.assertEqual(conn.get_node_basename('n2'), 'page')
+        conn.create_node('n22', {'parentids': ['root'], 'title': 'Page'})
+        self.assertEqual(conn.get_node_basename('n22'), 'page 3')
+
+        # Names taken within the same mtime are retried.
+        def take_name(path, name):
+            # list the directory at a whole second mtime, which utime()
+            # can restore exactly
+            mtime = int(os.stat(path).st_mtime)
+            os.utime(path, (mtime, mtime))
+            conn._name_cache.discard(path)
+            conn._name_cache.get_unique_filename(path, 'x')
+            os.mkdir(os.path.join(path, name))
+            open(os.path.join(path, name, 'file.txt'), 'w').close()
+            os.utime(path, (mtime, mtime))
+        take_name(notebook_file, 'new')
+        conn.create_node('n23', {'parentids': ['root'], 'title': 'New'})
+        self.assertEqual(conn.get_node_basename('n23'), 'new 2')
+        take_name(conn.get_node_path('n0'), 'new')
+        attr = conn.read_node('n23')
+        attr['parentids'] = ['n0']
+        conn.update_node('n23', attr)
+        self.assertEqual(conn.get_node_basename('n23'), 'new 2')
+        self.assertEqual(conn.read_node('n23')['parentids'], ['n0'])
+
+        # File names.
+        conn.open_file('n0', 'file.txt', 'w').close()
+        self.assertEqual(fs.new_filename(conn, 'n0', 'file.txt', None),
+                         'file 2.txt')
+        conn.create_dir('n0', 'dir/')
+        conn.open_file('n0', 'dir/file.txt', 'w').close()
+        self.assertEqual(
+            fs.new_filename(conn, 'n0', 'dir/file', '.txt',
+                            ensure_valid=False),
+            'dir/file 2.txt')
+        conn.close()
+
+    def test_stat_cache(self):
+        """Reuse file stats while expanding the tree."""
+        notebook_file = _tmpdir + '/notebook_stat_cache'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        conn.create_node('root', {'parentids': [], 'title': 'Root'})
+        conn.create_node('a', {'parentids': ['root'], 'title': 'A'})
+        for i in range(10):
+            conn.create_node('c%d' % i, {'parentids': ['a'],
+                                         'title': 'C%d' % i})
+            conn.create_node('d%d' % i, {'parentids': ['c%d' % i],
+                                         'title': 'D'})
+        conn.close()
+
+        def expand(ttl):
+            conn = fs.NoteBookConnectionFS()
+            conn.connect(notebook_file)
+            conn.read_node('root')
+            stats = []
+            cache = conn.get_stat_cache()
+            cache.ttl = ttl
+            cache.on_stat = stats.append
+            cache.count = 0
+            for childid in conn.read_node('a')['childrenids']:
+                conn.read_node(childid)
+            self.assertEqual(cache.count, len(stats))
+            conn.close()
+            return stats
+
+        # Without caching, each node directory is stat'd twice, once when
+        # its node is read and once when its children are listed.
+        stats = expand(0)
+        self.assertEqual(len(stats), 33)
+        path = os.path.join(notebook_file, 'a', 'c0')
+        self.assertEqual(stats.count(path), 2)
+
+        # With caching, once.
+        stats = expand(60)
+        self.assertEqual(len(stats), 22)
+        self.assertEqual(stats.count(path), 1)
+
+        # Writes through the connection are seen at once.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        cache = conn.get_stat_cache()
+        cache.ttl = 60
+        path = conn.get_node_path('c0')
+        self.assertFalse(conn.has_file('c0', 'file.txt'))
+        out = conn.open_file('c0', 'file.txt', 'w')
+        out.write('hello')
+        out.close()
+        self.assertTrue(conn.has_file('c0', 'file.txt'))
+        self.assertEqual(cache.get_mtime(path), os.stat(path).st_mtime)
+        conn.delete_file('c0', 'file.txt')
+        self.assertFalse(conn.has_file('c0', 'file.txt'))
+        conn.create_dir('c0', 'dir/')
+        self.assertTrue(conn.has_file('c0', 'dir/'))
+        attr = conn.read_node('c0')
+        attr['parentids'] = ['c1']
+        conn.update_node('c0', attr)
+        self.assertFalse(cache.exists(path))
+        self.assertEqual(conn.read_node('d0')['title'], 'D')
+        self.assertFalse(conn.index_needed())
+
+        # Outside changes are seen once the TTL expires.
+        cache.ttl = .05
+        self.assertFalse(conn.has_file('c1', 'outside.txt'))
+        open(os.path.join(conn.get_node_path('c1'), 'outside.txt'),
+             'w').close()
+        self.assertFalse(conn.has_file('c1', 'outside.txt'))
+        time.sleep(.1)
+        self.assertTrue(conn.has_file('c1', 'outside.txt'))
+
+        # An outside change hidden by the cache is not recorded as indexed
+        # by a later write.
+        cache.ttl = 60
+        path = conn.get_node_path('c1')
+        conn.read_node('c1')
+        mtime = cache.get_mtime(path)
+        self.assertEqual(mtime, conn._index.get_node_mtime('c1'))
+        os.remove(os.path.join(path, 'outside.txt'))
+        os.utime(path, (mtime + 5, mtime + 5))
+        self.assertEqual(cache.get_mtime(path), mtime)
+        out = conn.open_file('c1', 'file.txt', 'w')
+        out.close()
+        self.assertEqual(conn._index.get_node_mtime('c1'), mtime)
+        conn.close()
+
+    def test_blob_store(self):
+        """Copy node files by linking them to stored blobs."""
+        notebook_file = _tmpdir + '/notebook_blob_store'
+        clean_dir(notebook_file)
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        conn.create_node('root', {'parentids': [], 'title': 'Root'})
+        for nodeid in ['a', 'b', 'c', 'd']:
+            conn.create_node(nodeid, {'parentids': ['root'],
+                                      'title': nodeid})
+        self.assertTrue(conn.set_blob_store(True))
+        store = conn.get_blob_store()
+
+        def write(nodeid, filename, data, mode='w'):
+            out = conn.open_file(nodeid, filename, mode)
+            out.write(data)
+            out.close()
+
+        def read(nodeid, filename):
+            return conn.open_file(nodeid, filename).read()
+
+        def inode(nodeid, filename):
+            return os.stat(conn.get_file(nodeid, filename)).st_ino
+
+        # Local files are added to the store.
+        local_file = os.path.join(_tmpdir, 'blob_local.txt')
+        with open(local_file, 'w') as out:
+            out.write('hello')
+        conn.copy_file(None, local_file, 'a', 'file.txt')
+        self.assertEqual(read('a', 'file.txt'), 'hello')
+        digest = store.get_digest(conn.get_file('a', 'file.txt'))
+        self.assertEqual(store.get_refcount(digest), 1)
+
+        # Copies within the notebook are links.
+        conn.copy_file('a', 'file.txt', 'b', 'file.txt')
+        self.assertEqual(inode('a', 'file.txt'), inode('b', 'file.txt'))
+        self.assertEqual(store.get_refcount(digest), 2)
+
+        # Local files with the same content are deduplicated.
+        conn.copy_file(None, local_file, 'c', 'local.txt')
+        self.assertEqual(inode('a', 'file.txt'), inode('c', 'local.txt'))
+        self.assertEqual(store.get_refcount(digest), 3)
+
+        # Node files synced within the notebook are linked.
+        conn.create_dir('a', 'dir/')
+        write('a', 'dir/x.txt', 'x')
+        sync.sync_files(conn, 'a', conn, 'd')
+        self.assertEqual(inode('a', 'file.txt'), inode('d', 'file.txt'))
+        self.assertEqual(inode('a', 'dir/x.txt'), inode('d', 'dir/x.txt'))
+        self.assertEqual(read('d', 'dir/x.txt'), 'x')
+        self.assertEqual(store.get_refcount(digest), 4)
+
+        # Written files no longer share their content.
+        write('b', 'file.txt', 'bye')
+        write('c', 'local.txt', '!', mode='a')
+        self.assertEqual(read('a', 'file.txt'), 'hello')
+        self.assertEqual(read('b', 'file.txt'), 'bye')
+        self.assertEqual(read('c', 'local.txt'), 'hello!')
+        self.assertEqual(read('d', 'file.txt'), 'hello')
+        self.assertEqual(store.get_refcount(digest), 2)
+
+        # Unreferenced blobs are removed.
+        self.assertEqual(conn.collect_garbage(), (0, 0))
+        conn.delete_node('a')
+        conn.delete_node('d')
+        self.assertEqual(store.get_refcount(digest), 0)
+        self.assertEqual(conn.collect_garbage(), (1, len('hello')))
+        self.assertFalse(os.path.exists(store.get_blob_path(digest)))
+
+        # Files handed to other programs are unshared first.
+        def nlink(nodeid, filename):
+            return os.stat(conn.get_file(nodeid, filename)).st_nlink
+        conn.copy_file('c', 'local.txt', 'b', 'shared.txt')
+        conn.create_dir('b', 'dir/')
+        conn.copy_file('c', 'local.txt', 'b', 'dir/y.txt')
+        conn.unshare_file('b', 'shared.txt')
+        self.assertNotEqual(inode('b', 'shared.txt'), inode('c', 'local.txt'))
+        self.assertEqual(read('b', 'shared.txt'), 'hello!')
+        self.assertEqual(nlink('b', 'dir/y.txt'), 2)
+        conn.unshare_file('b')
+        self.assertEqual(nlink('b', 'dir/y.txt'), 1)
+        self.assertEqual(nlink('c', 'local.txt'), 1)
+        self.assertEqual(read('b', 'dir/y.txt'), 'hello!')
+        conn.close()
+
+        # The store is kept with the notebook.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(notebook_file)
+        self.assertTrue(conn.get_blob_store() is not None)
+        conn.copy_file(None, local_file, 'b', 'x.txt')
+        conn.copy_file('b', 'x.txt', 'c', 'x.txt')
+        self.assertEqual(inode('b', 'x.txt'), inode('c', 'x.txt'))
+
+        # Disabling the store unshares every node file.
+        conn.set_blob_store(False)
+        self.assertTrue(conn.get_blob_store() is None)
+        self.assertEqual(read('c', 'local.txt'), 'hello!')
+        self.assertEqual(nlink('b', 'x.txt'), 1)
+        self.assertEqual(nlink('c', 'x.txt'), 1)
+        self.assertEqual(read('c', 'x.txt'), 'hello')
+        write('c', 'x.txt', '!', mode='a')
+        self.assertEqual(read('b', 'x.txt'), 'hello')
+        conn.close()
+
+    def test_write_behind(self):
+        """Queue attr writes and write them in the background."""
+        notebook_file = _tmpdir + '/notebook_write_behind'
+        clean_dir(notebook_file)
+
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        parent = notebook.new_page(book, 'Parent')
+        children = [notebook.new_page(parent, 'Child %d' % i)
+                    for i in range(20)]
+        book.save()
+
+        conn = book.get_connection()
+        writes = []
+        write_attr = conn._write_attr_batch
+
+        def counting_write_attr_batch(nodes):
+            writes.append(len(nodes))
+            write_attr(nodes)
+        conn._write_attr_batch = counting_write_attr_batch
+        conn.set_write_behind(True)
+
+        # Hold writes until they are waited for.
+        conn._write_queue._delay = 60
+
+        # Move the last child first, and change every child.
+        children[-1].move(parent, 0)
+        for child in children:
+            child.set_attr('expanded', True)
+        for i in range(3):
+            children[0].set_attr('icon', 'note%d.png' % i)
+            book.save()
+
+        # Pending writes are visible to reads.
+        nodeid = children[0].get_attr('nodeid')
+        self.assertEqual(conn.read_node(nodeid)['icon'], 'note2.png')
+
+        # Writes are batched, and repeated writes of a node coalesce.
+        book.save(wait=True)
+        self.assertEqual(writes, [len(children)])
+
+        # Written files are current in the index.
+        for child in children:
+            path = conn.get_node_path(child.get_attr('nodeid'))
+            self.assertTrue(conn._node_index_current(
+                child.get_attr('nodeid'), path)[0])
+        book.close()
+
+        # Reopen and check order.
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        parent = book.get_children()[0]
+        self.assertEqual(
+            [child.get_title() for child in parent.get_children()],
+            ['Child 19'] + ['Child %d' % i for i in range(19)])
+        self.assertEqual(parent.get_children()[1].get_attr('icon'),
+                         'note2.png')
+
+        # Queued nodes are indexed as pending until they are written.
+        conn = book.get_connection()
+        conn._write_attr_batch = lambda nodes: None
+        conn.set_write_behind(True)
+        child = parent.get_children()[1]
+        nodeid = child.get_attr('nodeid')
+        child.set_attr('icon', 'lost.png')
+        book.save()
+        self.assertEqual(conn._index.get_node_mtime(nodeid),
+                         fs.PENDING_MTIME)
+
+        # A lost write is reindexed from disk.
+        book.close()
+        book = notebook.NoteBook()
+        book.load(notebook_file)
+        self.assertTrue(nodeid in book.get_connection().refresh_index())
+        self.assertEqual(book.get_node_by_id(nodeid).get_attr('icon'),
+                         'note2.png')
+        book.close()
+
+    def test_watcher(self):
+        """Reindex nodes changed outside of the connection."""
+        notebook_file = _tmpdir + '/notebook_watcher'
+        clean_dir(notebook_file)
+
+        book = notebook.NoteBook()
+        book.create(notebook_file)
+        a = notebook.new_page(book, 'A')
+        b = notebook.new_page(book, 'B')
+        notebook.new_page(b, 'B1')
+        book.save()
+        conn = book.get_connection()
+
+        events = []
+        book.node_changed.add(lambda actions: events.extend(actions))
+
+        # Use a polling watcher that is checked by hand.
+        conn.start_watching(polling=True, interval=1000)
+        watcher = conn.get_watcher()
+        watcher.check()
+        self.assertEqual(book.process_changes(), [])
+
+        # Changes made through the connection are not reported.
+        a.rename('A2')
+        notebook.new_page(a, 'A1')
+        watcher.check()
+        self.assertEqual(book.process_changes(), [])
+
+        # Change a title and add a node outside of the connection.
+        attr = dict(a._attr)
+        attr['title'] = 'A3'
+        fs.write_attr(os.path.join(a.get_path(), 'node.xml'),
+                      attr['nodeid'], attr)
+        new_path = os.path.join(b.get_path(), 'b2')
+        os.mkdir(new_path)
+        fs.write_attr(os.path.join(new_path, 'node.xml'), 'b2',
+                      {'nodeid': 'b2', 'title': 'B2', 'order': 1})
+
+        del events[:]
+        watcher.check()
+        self.assertEqual(set(book.process_changes()), set([a, b]))
+        self.assertEqual(set(events), set([('changed-recurse', a),
+                                           ('changed-recurse', b)]))
+        self.assertEqual(a.get_title(), 'A3')
+        self.assertEqual([child.get_title() for child in b.get_children()],
+                         ['B1', 'B2'])
+        self.assertEqual(conn.get_node_path('b2'), new_path)
+        self.assertEqual(conn.search_node_titles('A3')[0][0],
+                         a.get_attr('nodeid'))
+
+        # Nothing else changed.
+        watcher.check()
+        self.assertEqual(book.process_changes(), [])
+
+        # Remove a node.
+        b2 = b.get_children()[1]
+        shutil.rmtree(new_path)
+        watcher.check()
+        self.assertEqual(book.process_changes(), [b])
+        self.assertEqual([child.get_title() for child in b.get_children()],
+                         ['B1'])
+        self.assertFalse(b2.is_valid())
+        self.assertFalse(conn.has_node('b2'))
+
+        # The watcher thread finds changes by itself.
+        changed = threading.Event()
+        conn.start_watching(on_change=changed.set, polling=True,
+                            interval=.01)
+        os.mkdir(new_path)
+        fs.write_attr(os.path.join(new_path, 'node.xml'), 'b3',
+                      {'nodeid': 'b3', 'title': 'B3'})
+        self.assertTrue(changed.wait(10))
+        self.assertEqual(book.process_changes(), [b])
+        book.close()
+        self.assertEqual(conn.get_watcher(), None)
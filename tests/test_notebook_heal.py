@@ -2,6 +2,7 @@
 # python imports
 import unittest
 import os
+import shutil
 import time
 
 # keepnote imports
@@ -141,3 +142,230 @@ class Heal (unittest.TestCase):
         book = notebook.NoteBook()
         book.load(_tmpdir + "/notebook_tamper/n1")
         book.close()
+
+    def test_refresh(self):
+        """Incrementally reindex external changes."""
+
+        struct = [["a", ["a1"], ["a2"], ["a3"]],
+                  ["b", ["b1"], ["b2",
+                                 ["c1"], ["c2"]]]]
+
+        def make_notebook(node, children):
+            for child in children:
+                name = child[0]
+                node2 = notebook.new_page(node, name)
+                make_notebook(node2, child[1:])
+
+        def touch(path):
+            # ensure mtime is newer than the index regardless of
+            # filesystem timestamp resolution
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+        make_clean_dir(_tmpdir)
+        book = notebook.NoteBook()
+        book.create(_tmpdir + "/n1")
+        make_notebook(book, struct)
+        book.close()
+
+        # Bring index up to date.
+        book = notebook.NoteBook()
+        book.load(_tmpdir + "/n1")
+        book.close()
+
+        book = notebook.NoteBook()
+        book.create(_tmpdir + "/n2")
+        make_notebook(book, [["d", ["d1"]]])
+        book.close()
+
+        # Make external changes.
+        path = _tmpdir + "/n1"
+        os.rename(path + "/a/a1", path + "/a/a1 renamed")
+        shutil.rmtree(path + "/a/a2")
+        touch(path + "/a")
+        shutil.move(_tmpdir + "/n2/d", path + "/b/b2/d")
+        touch(path + "/b/b2")
+
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(path)
+        conn.index_attr("title", "TEXT", index_value=True)
+
+        # The root is unchanged, so its children are listed from the index
+        # and are left for refresh.
+        rootid = conn.get_rootid()
+
+        def get_nodeid(title):
+            results = conn.search_node_titles(title)
+            return results[0][0] if results else None
+
+        c1 = get_nodeid("c1")
+        a2 = get_nodeid("a2")
+
+        # Only changed directories should have their children read.
+        reads = []
+        read_attr = conn._read_attr
+
+        def count_read_attr(metafile):
+            reads.append(metafile)
+            return read_attr(metafile)
+        conn._read_attr = count_read_attr
+
+        nodeids = list(conn.refresh_index())
+        self.assertEqual(len(reads), 5)
+        titles = set(conn.get_attr_by_id(nodeid, "title")
+                     for nodeid in nodeids)
+        self.assertEqual(titles, set(["a", "a1", "b2", "d", "d1", None]))
+
+        # Index reflects the changes.
+        self.assertFalse(conn.has_node(a2))
+        self.assertEqual(
+            conn.get_node_path(get_nodeid("a1")), path + "/a/a1 renamed")
+        d1 = get_nodeid("d1")
+        self.assertEqual(
+            conn.get_node_path_by_id(d1),
+            [rootid, get_nodeid("b"), get_nodeid("b2"), get_nodeid("d"), d1])
+        self.assertEqual(conn.get_node_path(c1), path + "/b/b2/c1")
+
+        # Nothing left to refresh.
+        self.assertEqual(list(conn.refresh_index()), [])
+
+        conn.close()
+
+    def test_refresh_background(self):
+        """Loading leaves external changes to a background refresh."""
+        make_clean_dir(_tmpdir)
+        book = notebook.NoteBook()
+        book.create(_tmpdir + "/n1")
+        notebook.new_page(notebook.new_page(notebook.new_page(book, "a"),
+                                            "a1"), "a2")
+        book.close()
+
+        book = notebook.NoteBook()
+        book.create(_tmpdir + "/n2")
+        notebook.new_page(book, "d")
+        book.close()
+
+        # Move a node into "a2" outside of KeepNote.
+        path = _tmpdir + "/n1"
+        shutil.move(_tmpdir + "/n2/d", path + "/a/a1/a2/d")
+        stat = os.stat(path + "/a/a1/a2")
+        os.utime(path + "/a/a1/a2", (stat.st_atime, stat.st_mtime + 10))
+
+        def search(book, title):
+            return [nodeid for nodeid, title2
+                    in book.search_node_titles(title) if title2 == title]
+
+        # Loading does not walk the notebook.
+        book = notebook.NoteBook()
+        book.load(path)
+        self.assertEqual(search(book, "d"), [])
+
+        # Refresh in steps.
+        self.assertTrue(book.start_refresh_index())
+        steps = 1
+        while book.refresh_index_step(timeout=0):
+            steps += 1
+        self.assertTrue(steps > 1)
+        self.assertEqual(len(search(book, "d")), 1)
+        self.assertFalse(book.refresh_index_step())
+
+        # Loaded nodes changed on disk are reloaded.
+        a2 = book.get_children()[0].get_children()[0].get_children()[0]
+        self.assertEqual([child.get_title() for child in a2.get_children()],
+                         ["d"])
+        book2 = notebook.NoteBook()
+        book2.create(_tmpdir + "/n3")
+        notebook.new_page(book2, "e")
+        book2.close()
+        shutil.move(_tmpdir + "/n3/e", path + "/a/a1/a2/e")
+        stat = os.stat(path + "/a/a1/a2")
+        os.utime(path + "/a/a1/a2", (stat.st_atime, stat.st_mtime + 20))
+
+        changes = []
+
+        def on_changed(actions):
+            changes.extend(actions)
+        book.node_changed.add(on_changed)
+        self.assertTrue(book.start_refresh_index())
+        while book.refresh_index_step():
+            pass
+        self.assertEqual(
+            sorted(child.get_title() for child in a2.get_children()),
+            ["d", "e"])
+        self.assertTrue(("changed-recurse", a2) in changes)
+
+        # Closing stops a refresh.
+        self.assertTrue(book.start_refresh_index())
+        book.close()
+        self.assertTrue(book._refresh is None)
+
+    def test_list_children_index(self):
+        """List unchanged children from the index."""
+
+        make_clean_dir(_tmpdir)
+        path = _tmpdir + "/n1"
+        book = notebook.NoteBook()
+        book.create(path)
+        folder = notebook.new_page(book, "folder")
+        for i in range(20):
+            page = notebook.new_page(folder, "page%d" % i)
+            notebook.new_page(page, "child")
+            with page.open_file(notebook.PAGE_DATA_FILE, "w") as out:
+                out.write(notebook.NOTE_HEADER)
+                out.write("text %d" % i)
+                out.write(notebook.NOTE_FOOTER)
+            page.save(True)
+
+        # Writing files keeps the index current.
+        conn = book._conn
+        for page in folder.get_children():
+            self.assertTrue(conn._node_index_current(
+                page.get_attr("nodeid"), page.get_path())[0])
+        folderid = folder.get_attr("nodeid")
+        book.close()
+
+        def count_reads(conn):
+            reads = []
+            read_attr = conn._read_attr
+
+            def count_read_attr(metafile):
+                reads.append(metafile)
+                return read_attr(metafile)
+            conn._read_attr = count_read_attr
+            return reads
+
+        # Expanding the folder only reads its children, not grandchildren.
+        book = notebook.NoteBook()
+        book.load(path)
+        folder = book.get_node_by_id(folderid)
+        reads = count_reads(book._conn)
+        children = folder.get_children()
+        self.assertEqual(len(children), 20)
+        self.assertEqual(len(reads), 20)
+        self.assertTrue(all(child.has_children() for child in children))
+        book.close()
+
+        # Fall back to reading from disk when the index is not trusted.
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(path)
+        conn.get_rootid()
+        conn._index.set_index_needed(True)
+        reads = count_reads(conn)
+        self.assertEqual(len(list(conn._list_children_nodeids(folderid))), 20)
+        self.assertEqual(len(reads), 20)
+        conn.close()
+
+        # External changes to the folder are detected.
+        folder_path = path + "/folder"
+        shutil.copytree(folder_path + "/page0", folder_path + "/copy")
+        os.remove(folder_path + "/copy/" + fs.NODE_META_FILE)
+        fs.write_attr(folder_path + "/copy/" + fs.NODE_META_FILE,
+                      notebook.new_nodeid(), {"title": u"copy"})
+        stat = os.stat(folder_path)
+        os.utime(folder_path, (stat.st_atime, stat.st_mtime + 10))
+
+        conn = fs.NoteBookConnectionFS()
+        conn.connect(path)
+        conn.get_rootid()
+        self.assertEqual(len(list(conn._list_children_nodeids(folderid))), 21)
+        conn.close()
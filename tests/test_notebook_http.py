@@ -88,3 +88,22 @@ class TestHttp(TestConnBase):
 
         # Close server.
         server.shutdown()
+
+    def test_search_titles(self):
+        """
+        Cached title matches should be ordered like the notebook index.
+        """
+        conn = NoteBookConnectionHttp()
+        for nodeid, title in enumerate(
+                [u'big page', u'page two', u'Page', u'a page', u'page']):
+            conn._title_cache.add(nodeid, title)
+        conn._title_cache.set_complete()
+
+        self.assertEqual(
+            [title for nodeid, title
+             in conn.index(['search', 'title', 'page'])],
+            [u'Page', u'page', u'page two', u'a page', u'big page'])
+        self.assertEqual(
+            [title for nodeid, title
+             in conn.index(['search', 'title', 'page', 3])],
+            [u'Page', u'page', u'page two'])
@@ -11,6 +11,8 @@ import traceback
 
 # keepnote imports
 from keepnote import notebook
+from keepnote.notebook.connection import index as notebook_index
+from keepnote.notebook.connection.fs import index as fs_index
 
 from . import clean_dir, TMP_DIR
 
@@ -123,6 +125,40 @@ class Index (unittest.TestCase):
         self.assertEqual(node.get_title(), 'Page X')
         book.close()
 
+    def test_get_node_paths(self):
+        """Resolve node paths from the index."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        pagex = book.get_node_by_id(self._pagex_nodeid)
+        pageb = pagex.get_parent()
+        page1 = pageb.get_parent()
+        expected = [book.get_attr('nodeid'), page1.get_attr('nodeid'),
+                    pageb.get_attr('nodeid'), self._pagex_nodeid]
+        self.assertEqual(book.get_node_path_by_id(self._pagex_nodeid),
+                         expected)
+        self.assertEqual(index.get_node_filepath(self._pagex_nodeid),
+                         ['page 1', 'page b', 'page x'])
+        self.assertEqual(index.get_node_filepath(book.get_attr('nodeid')),
+                         [])
+        self.assertEqual(book.get_node_path_by_id('unknown'), None)
+
+        # Resolve many paths at once.
+        paths = book.get_node_paths_by_id(
+            [self._pagex_nodeid, pageb.get_attr('nodeid'), 'unknown'])
+        self.assertEqual(paths, {
+            self._pagex_nodeid: expected,
+            pageb.get_attr('nodeid'): expected[:3],
+            'unknown': None,
+        })
+        self.assertEqual(
+            [node.get_title() if node else None for node in
+             book.get_nodes_by_id([self._pagex_nodeid, 'unknown'])],
+            ['Page X', None])
+
+        book.close()
+
     def test_notebook_search_titles(self):
         """Search notebook titles."""
         book = notebook.NoteBook()
@@ -137,6 +173,61 @@ class Index (unittest.TestCase):
 
         book.close()
 
+    def test_search_titles_substring(self):
+        """Search titles by substring with ranking and limits."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+        self.assertTrue(index.get_attr_index('title').has_substring_index())
+
+        pages = [notebook.new_page(book, title) for title in
+                 ['Zebra crossing', 'Crossing', 'crossings', 'A 100% title']]
+
+        results = book.search_node_titles('crossing')
+        self.assertEqual([title for nodeid, title in results],
+                         ['Crossing', 'crossings', 'Zebra crossing'])
+        self.assertEqual(book.search_node_titles('crossing', limit=2),
+                         results[:2])
+
+        # Wildcards are matched literally.
+        self.assertEqual([title for nodeid, title in
+                          book.search_node_titles('0% t')],
+                         ['A 100% title'])
+        self.assertEqual(book.search_node_titles('%'), [
+            (pages[3].get_attr('nodeid'), 'A 100% title')])
+
+        # Short queries still match, without the trigram index.
+        self.assertEqual(len(book.search_node_titles('ra', limit=1)), 1)
+
+        # Renamed and deleted titles are updated.
+        pages[0].set_attr('title', 'Zebra')
+        pages[0].save(True)
+        self.assertEqual(len(book.search_node_titles('crossing')), 2)
+        for page in pages:
+            page.delete()
+        self.assertEqual(book.search_node_titles('crossing'), [])
+
+        book.close()
+
+    def _test_search_titles_speed(self):
+        """Time title searches over 100k titles."""
+        from keepnote.notebook.connection.index import AttrIndex, NodeIndex
+
+        con = sqlite.connect(":memory:")
+        cur = con.cursor()
+        index = NodeIndex(None)
+        index.cur = cur
+        attrindex = index.add_attr(AttrIndex(
+            "title", "TEXT", index_value=True, index_substring=True))
+        attrindex.add_nodes(cur, ((str(i), u"page %d about topic %d" %
+                                   (i, i % 1000))
+                                  for i in xrange(100000)))
+
+        for query in ['topic 99', 'page 12345', 'pa']:
+            t = time.time()
+            results = index.search_node_titles(cur, query, limit=10)
+            print query, len(results), time.time() - t
+
     def test_index_all(self):
         """Reindex all nodes in notebook."""
         book = notebook.NoteBook()
@@ -147,6 +238,354 @@ class Index (unittest.TestCase):
 
         book.close()
 
+    def test_rebuild(self):
+        """Rebuild index into a fresh database file."""
+        self.maxDiff = None
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        def dump(index):
+            tables = ['NodeGraph', 'Attr_title', 'Attr_icon', 'fulltext']
+            return dict(
+                (table, sorted(index.con.execute(
+                    'SELECT * FROM %s' % table).fetchall()))
+                for table in tables)
+
+        # Rebuilding should match indexing every node.
+        for nodeid in book.index_all():
+            book._conn.read_node(nodeid, _force_index=True)
+        expected = dump(index)
+
+        nodeids = list(book.rebuild_index())
+        self.assertEqual(len(nodeids), len(expected['NodeGraph']))
+        self.assertEqual(dump(index), expected)
+        self.assertFalse(book.index_needed())
+        self.assertFalse(os.path.exists(
+            index._index_file + fs_index.REBUILD_SUFFIX))
+
+        # Rebuilt index should be queryable.
+        results = list(book.search_node_contents('hello'))
+        self.assertEqual(len(results), 2)
+        node = book.get_node_by_id(self._pagex_nodeid)
+        self.assertEqual(node.get_title(), 'Page X')
+
+        book.close()
+
+    def test_rebuild_abort(self):
+        """Abort an index rebuild."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        # Live index should remain usable during and after an aborted rebuild.
+        nodes = book.rebuild_index()
+        nodes.next()
+        self.assertTrue(os.path.exists(
+            index._index_file + fs_index.REBUILD_SUFFIX))
+        results = list(book.search_node_contents('hello'))
+        self.assertEqual(len(results), 2)
+
+        nodes.close()
+        self.assertFalse(os.path.exists(
+            index._index_file + fs_index.REBUILD_SUFFIX))
+        results = list(book.search_node_contents('hello'))
+        self.assertEqual(len(results), 2)
+
+        book.close()
+
+    def test_rebuild_concurrent_write(self):
+        """Writes made during a rebuild mark the index as needed."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+
+        nodes = book.rebuild_index()
+        nodes.next()
+        node = book.get_node_by_id(self._pagex_nodeid)
+        node.set_attr("title", "Page X2")
+        book.save()
+        list(nodes)
+        self.assertTrue(book.index_needed())
+
+        node.set_attr("title", "Page X")
+        book.save()
+        list(book.rebuild_index())
+        self.assertFalse(book.index_needed())
+
+        book.close()
+
+    def test_index_all_pipeline(self):
+        """Index all nodes with a pool of readers."""
+        self.maxDiff = None
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        def dump(index):
+            tables = ['NodeGraph', 'Attr_title', 'Attr_icon', 'fulltext']
+            return dict(
+                (table, sorted(index.con.execute(
+                    'SELECT * FROM %s' % table).fetchall()))
+                for table in tables)
+
+        # Build the expected index serially.
+        book.clear_index()
+        list(book.index_all())
+        expected = dump(index)
+
+        for workers, processes in [(4, False), (2, True)]:
+            book.clear_index()
+            nodeids = list(book.index_all(workers=workers,
+                                          processes=processes))
+            self.assertEqual(len(nodeids), len(expected['NodeGraph']))
+            self.assertEqual(dump(index), expected)
+            self.assertFalse(book.index_needed())
+
+        results = list(book.search_node_contents('hello'))
+        self.assertEqual(len(results), 2)
+
+        book.close()
+
+    def _test_index_all_speed(self):
+        """Time indexing a large notebook with and without a reader pool."""
+        from keepnote.notebook.connection import fs
+
+        filename = os.path.join(TMP_DIR, "notebook-large")
+        clean_dir(filename)
+        book = notebook.NoteBook()
+        book.create(filename)
+        book.close()
+
+        # Write 200 folders of 100 pages directly to disk.
+        for i in xrange(200):
+            folder = os.path.join(filename, "folder%d" % i)
+            os.mkdir(folder)
+            fs.write_attr(os.path.join(folder, fs.NODE_META_FILE),
+                          notebook.new_nodeid(),
+                          {"title": u"folder%d" % i,
+                           "content_type": notebook.CONTENT_TYPE_DIR})
+            for j in xrange(100):
+                page = os.path.join(folder, "page%d" % j)
+                os.mkdir(page)
+                fs.write_attr(os.path.join(page, fs.NODE_META_FILE),
+                              notebook.new_nodeid(),
+                              {"title": u"page%d" % j,
+                               "content_type": notebook.CONTENT_TYPE_PAGE})
+                with open(os.path.join(page, notebook.PAGE_DATA_FILE),
+                          "w") as out:
+                    out.write(notebook.NOTE_HEADER)
+                    out.write("page %d of folder %d\n" % (j, i) * 20)
+                    out.write(notebook.NOTE_FOOTER)
+
+        book = notebook.NoteBook()
+        book.load(filename)
+        for workers, processes in [(0, False), (4, False), (4, True)]:
+            book.clear_index()
+            t = time.time()
+            nodeids = list(book.index_all(workers=workers,
+                                          processes=processes))
+            print workers, processes, len(nodeids), time.time() - t
+        book.close()
+
+    def test_search_ranked(self):
+        """Search contents with ranked results."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        def check(version):
+            self.assertEqual(index._fulltext_version, version)
+
+            results = book.search_node_contents_ranked('world')
+            titles = [title for nodeid, title, rank, snippet in results]
+            if version == 5:
+                # bm25 prefers the shorter page.
+                self.assertEqual(titles, ['Page A', 'Page C'])
+            else:
+                self.assertEqual(sorted(titles), ['Page A', 'Page C'])
+            self.assertTrue(results[0][2] <= results[1][2])
+            self.assertTrue('<b>world</b>' in results[0][3])
+
+            # Page through results.
+            self.assertEqual(
+                book.search_node_contents_ranked('world', limit=1, offset=1),
+                results[1:])
+            self.assertEqual(
+                book.search_node_contents_ranked('world', limit=1),
+                results[:1])
+
+            # Punctuation should not break the query.
+            self.assertEqual(
+                len(book.search_node_contents_ranked('hello, world')), 1)
+            self.assertEqual(len(list(book.search_node_contents('hello'))), 2)
+
+            # Prefix and exclusion queries.
+            def titles(query):
+                return sorted(title for nodeid, title, rank, snippet
+                              in book.search_node_contents_ranked(query))
+            self.assertEqual(titles('wor*'), ['Page A', 'Page C'])
+            if version == 5:
+                # fts3 only excludes terms with its standard query syntax
+                self.assertEqual(titles('world -brand'), ['Page A'])
+                self.assertEqual(titles('-brand world'), ['Page A'])
+                self.assertEqual(titles('hel* -world'), ['Page B'])
+
+                # Exclusions alone match nothing.
+                self.assertEqual(titles('-brand'), [])
+                self.assertEqual(titles('-brand -"new world"'), [])
+                self.assertEqual(list(book.search_node_contents('-brand')),
+                                 [])
+
+                # Operators next to an exclusion or without a term are
+                # dropped.
+                self.assertEqual(titles('world OR -brand'), ['Page A'])
+                self.assertEqual(titles('OR'), [])
+                self.assertEqual(titles('NOT'), [])
+                self.assertEqual(titles('world AND'), ['Page A', 'Page C'])
+                self.assertEqual(titles('AND hello OR'), ['Page A', 'Page B'])
+
+                # Quoted text is searched as a phrase.
+                self.assertEqual(titles('"new world"'), ['Page C'])
+                self.assertEqual(titles('"world new"'), [])
+                self.assertEqual(titles('"hello world'), ['Page A'])
+                self.assertEqual(titles('world -"brand new"'), ['Page A'])
+                self.assertEqual(
+                    list(book.search_node_contents('"world hello"')), [])
+
+        check(5)
+
+        # Fall back to fts3 when fts5 is not available.
+        test_fts5 = notebook_index.test_fts5
+        notebook_index.test_fts5 = lambda cur: False
+        try:
+            book.clear_index()
+            list(book.index_all())
+            check(3)
+        finally:
+            notebook_index.test_fts5 = test_fts5
+            book.clear_index()
+            list(book.index_all())
+
+        book.close()
+
+    def test_fts5_query(self):
+        """Convert search queries to fts5 queries."""
+        make_query = notebook_index.make_fts5_query
+        self.assertEqual(make_query(u'hello, world'), u'"hello," "world"')
+        self.assertEqual(make_query(u'wor* -"a b"'), u'"wor"* NOT "a b"')
+        self.assertEqual(make_query(u'a OR -b'), u'"a" NOT "b"')
+        self.assertEqual(make_query(u'a OR b -c'), u'("a" OR "b") NOT "c"')
+        self.assertEqual(make_query(u'"exact phrase"'), u'"exact phrase"')
+        self.assertEqual(make_query(u'say "hi'), u'"say" "hi"')
+        self.assertEqual(make_query(u'NOT a AND OR b NOT'), u'"a" OR "b"')
+        for query in (u'', u'-foo', u'-"a b" -c', u'OR', u'NOT', u'AND',
+                      u'""', u'*'):
+            self.assertEqual(make_query(query), None)
+
+    def test_delete_subtree(self):
+        """Delete a subtree from the index."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        # Build a small subtree.
+        top = notebook.new_page(book, 'Subtree')
+        nodeids = [top.get_attr('nodeid')]
+        for i in range(3):
+            child = notebook.new_page(top, 'Child %d' % i)
+            write_content(child, 'subtree text')
+            grandchild = notebook.new_page(child, 'Grandchild %d' % i)
+            nodeids.extend([child.get_attr('nodeid'),
+                            grandchild.get_attr('nodeid')])
+
+        def count_rows(table):
+            return index.con.execute(
+                'SELECT count(*) FROM %s WHERE nodeid IN (%s)' %
+                (table, ','.join('?' * len(nodeids))), nodeids).fetchone()[0]
+
+        self.assertEqual(count_rows('NodeGraph'), 7)
+        self.assertEqual(count_rows('Attr_title'), 7)
+        self.assertEqual(count_rows('fulltext'), 7)
+
+        # Moving the subtree leaves descendants untouched.
+        def dump_children():
+            return sorted(index.con.execute(
+                'SELECT * FROM NodeGraph WHERE nodeid IN (%s)' %
+                ','.join('?' * (len(nodeids) - 1)), nodeids[1:]).fetchall())
+        children = dump_children()
+        opened = []
+        open_fulltext = index._open_node_fulltext
+        index.set_open_fulltext_func(
+            lambda nodeid: opened.append(nodeid) or open_fulltext(nodeid))
+
+        top.move(book.get_node_by_id(self._pagex_nodeid))
+        self.assertEqual(dump_children(), children)
+        self.assertEqual(set(opened) & set(nodeids[1:]), set())
+        self.assertEqual(index.get_node_path(nodeids[-1])[-4:-2],
+                         [self._pagex_nodeid, nodeids[0]])
+        self.assertEqual(len(list(book.search_node_contents('subtree'))), 4)
+
+        # Deleting the subtree removes every row.
+        top.delete()
+        self.assertEqual(count_rows('NodeGraph'), 0)
+        self.assertEqual(count_rows('Attr_title'), 0)
+        self.assertEqual(count_rows('fulltext'), 0)
+        self.assertEqual(list(book.search_node_contents('subtree')), [])
+        for nodeid in nodeids:
+            self.assertFalse(book._conn._path_cache.has_node(nodeid))
+
+        # A failed removal keeps the other writes of the transaction.
+        pagex = self._pagex_nodeid
+        mtime = index.get_node_mtime(pagex)
+
+        def fail(*args):
+            raise sqlite.DatabaseError('disk I/O error')
+        index.remove_nodes_attr = fail
+        try:
+            with index.writing():
+                index.set_node_mtime(pagex, 123.0)
+                self.assertRaises(sqlite.DatabaseError,
+                                  index.remove_subtree, pagex)
+        finally:
+            del index.remove_nodes_attr
+        self.assertEqual(index.get_node_mtime(pagex), 123.0)
+        self.assertTrue(index.index_needed())
+        index.set_node_mtime(pagex, mtime)
+
+        book.close()
+
+    def test_skip_text_extraction(self):
+        """Only extract text when a page's content changes."""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+
+        page = notebook.new_page(book, 'Fingerprint')
+        write_content(page, 'fingerprint text')
+        count = index.get_text_extraction_count()
+
+        # Attribute changes do not extract text.
+        page.set_attr('expanded', True)
+        page.save(True)
+        page.set_attr('icon', 'note.png')
+        page.save(True)
+        self.assertEqual(index.get_text_extraction_count(), count)
+
+        # Content and title changes do.
+        write_content(page, 'changed text')
+        self.assertEqual(index.get_text_extraction_count(), count + 1)
+        self.assertEqual(list(book.search_node_contents('changed')),
+                         [page.get_attr('nodeid')])
+
+        page.set_attr('title', 'Refingerprint')
+        page.save(True)
+        self.assertEqual(index.get_text_extraction_count(), count + 2)
+        self.assertEqual(list(book.search_node_contents('refingerprint')),
+                         [page.get_attr('nodeid')])
+
+        page.delete()
+        book.close()
+
     def test_fts3(self):
         """Ensure full-text search is available."""
         con = sqlite.connect(":memory:")
@@ -227,6 +666,144 @@ class Index (unittest.TestCase):
 
         self.assertFalse(error[0])
 
+    def test_notebook_threads_writer(self):
+        """Read from many threads while another thread writes"""
+        errors = []
+        nreaders = 4
+
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+        self.assertTrue(index._wal)
+        pagex = self._pagex_nodeid
+        writing = threading.Event()
+        done = threading.Event()
+
+        def read():
+            try:
+                # reader threads read through pooled connections
+                con = index._get_reader()
+                self.assertTrue(con is not None)
+                index._put_reader(con)
+
+                writing.wait()
+                while not done.is_set():
+                    self.assertEqual(
+                        len(list(book.search_node_contents('world'))), 2)
+                    self.assertEqual(
+                        len(index.get_node_path(pagex)), 4)
+                    index.search_titles('Writer')
+            except Exception, e:
+                traceback.print_exception(type(e), e, sys.exc_info()[2])
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for i in range(nreaders)]
+        for thread in threads:
+            thread.start()
+
+        # write in the thread that opened the notebook
+        writing.set()
+        pages = []
+        try:
+            for i in range(20):
+                pages.append(notebook.new_page(book, 'Writer %d' % i))
+                book.save()
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(index._readers, set(index._idle))
+        self.assertTrue(
+            len(index._readers) <= fs_index.READER_POOL_SIZE)
+
+        # committed writes are visible to other threads
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.extend(index.search_titles('Writer')))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(results), 20)
+
+        for page in pages:
+            page.delete()
+        book.close()
+        self.assertEqual(index._readers, set())
+
+    def test_thread_writes_visible(self):
+        """Writes from a thread are visible to other threads at once"""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+        pagex = self._pagex_nodeid
+        mtimes = []
+
+        def write():
+            index.set_node_mtime(pagex, 123.0)
+
+        def read():
+            mtimes.append(index.get_node_mtime(pagex))
+
+        for target in (write, read):
+            thread = threading.Thread(target=target)
+            thread.start()
+            thread.join()
+        self.assertEqual(mtimes, [123.0])
+
+        book.close()
+
+    def test_thread_transactions(self):
+        """Threads see and wait on the transactions of other threads"""
+        book = notebook.NoteBook()
+        book.load(_notebook_file)
+        index = book._conn._index
+        pagex = self._pagex_nodeid
+        mtime = index.get_node_mtime(pagex)
+
+        def run(target):
+            results = []
+            thread = threading.Thread(
+                target=lambda: results.append(target()))
+            thread.start()
+            return thread, results
+
+        # writes outside of writing() are committed at once
+        page = notebook.new_page(book, 'Committed page')
+        write_content(page, 'zanzibar')
+        thread, results = run(lambda: (
+            list(index.search_contents('zanzibar')) +
+            [nodeid for nodeid, title in
+             index.search_titles('Committed page')]))
+        thread.join()
+        self.assertEqual(results, [[page.get_attr('nodeid')] * 2])
+
+        # a transaction is neither seen nor committed by readers, and
+        # writers wait for it to end
+        with index.writing():
+            index.set_node_mtime(pagex, 123.0)
+            thread, results = run(lambda: index.get_node_mtime(pagex))
+            thread.join()
+            self.assertEqual(results, [mtime])
+            self.assertEqual(index.get_node_mtime(pagex), 123.0)
+
+            thread, results = run(
+                lambda: index.set_node_mtime(pagex, 456.0))
+            thread.join(.2)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual(index.get_node_mtime(pagex), 456.0)
+
+        # reader connections are reused by later threads
+        for i in range(10):
+            run(lambda: index.get_node_mtime(pagex))[0].join()
+        self.assertTrue(
+            len(index._readers) <= fs_index.READER_POOL_SIZE)
+
+        index.set_node_mtime(pagex, mtime)
+        page.delete()
+        book.close()
+
     def _test_concurrent(self):
         """Open a notebook twice."""
         book1 = notebook.NoteBook()
@@ -1,7 +1,9 @@
 
 # python imports
+import gc
 import unittest
 import os
+import sys
 
 # keepnote imports
 from keepnote import notebook
@@ -87,6 +89,73 @@ class Test (unittest.TestCase):
         display_notebook(book)
         book.close()
 
+    def test_duplicate(self):
+
+        struct = [["a", ["a1"], ["a2"], ["a3"]],
+                  ["b", ["b1"], ["b2",
+                                 ["c1"], ["c2"]]]]
+
+        # initialize a notebook
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        make_notebook(book, struct)
+        conn = book._conn
+
+        b = book.get_children()[1]
+        out = b.open_file("file.txt", "w")
+        out.write("hello")
+        out.close()
+
+        # nodes are created in one batch, without further updates
+        batches = []
+        updates = []
+        apply_batch = conn.apply_batch
+        update_node = conn.update_node
+
+        def counting_apply_batch(ops):
+            batches.append(len(ops))
+            return apply_batch(ops)
+
+        def counting_update_node(nodeid, attr):
+            updates.append(nodeid)
+            return update_node(nodeid, attr)
+
+        conn.apply_batch = counting_apply_batch
+        conn.update_node = counting_update_node
+        a = book.get_children()[0]
+        b2 = b.duplicate(a, index=1, recurse=True)
+        del conn.apply_batch
+        del conn.update_node
+
+        self.assertEqual(batches, [5])
+        self.assertFalse(b2.get_attr("nodeid") in updates)
+        self.assertEqual(b2.get_attr("duplicate_of"), b.get_attr("nodeid"))
+        self.assertEqual([child.get_title() for child in a.get_children()],
+                         ["a1", "b", "a2", "a3"])
+        self.assertEqual(b2.open_file("file.txt").read(), "hello")
+
+        # indexed mtimes are current
+        for node in [a, b2] + b2.get_children():
+            nodeid = node.get_attr("nodeid")
+            self.assertTrue(conn._node_index_current(
+                nodeid, conn.get_node_path(nodeid))[0])
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        a = book.get_children()[0]
+        self.assertEqual([child.get_title() for child in a.get_children()],
+                         ["a1", "b", "a2", "a3"])
+        b2 = a.get_children()[1]
+        self.assertEqual([child.get_title() for child in b2.get_children()],
+                         ["b1", "b2"])
+        self.assertEqual(
+            [child.get_title()
+             for child in b2.get_children()[1].get_children()],
+            ["c1", "c2"])
+        book.close()
+
     def test_random_access(self):
 
         struct = [["a", ["a1"], ["a2"], ["a3"]],
@@ -115,6 +184,381 @@ class Test (unittest.TestCase):
 
         book.close()
 
+    def test_order_keys(self):
+        """Inserting a child rewrites the attr of O(1) nodes."""
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        parent = notebook.new_page(book, "parent")
+        for i in range(100):
+            notebook.new_page(parent, "c%d" % i)
+        book.save()
+
+        # Count attr writes.
+        writes = []
+        update_node = book._conn.update_node
+
+        def counting_update_node(nodeid, attr):
+            writes.append(nodeid)
+            return update_node(nodeid, attr)
+        book._conn.update_node = counting_update_node
+
+        def titles(node):
+            return [child.get_title() for child in node.get_children()]
+
+        # Insert and move children.
+        new = notebook.new_page(parent, "new", 0)
+        notebook.new_page(parent, "new2", 50)
+        book.save()
+        self.assertEqual(len(writes), 2)
+        del writes[:]
+        parent.get_children()[-1].move(parent, 10)
+        book.save()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(new.get_index(), 0)
+        expected = titles(parent)
+        self.assertEqual(expected[:2], ["new", "c0"])
+        self.assertEqual(expected[10], "c99")
+        self.assertEqual(expected[51], "new2")
+        book.close()
+
+        # The order is kept.
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        parent = book.get_children()[0]
+        self.assertEqual(titles(parent), expected)
+
+        # Dense orders of older notebooks are read without rewriting.
+        for i, child in enumerate(parent.get_children()):
+            child.set_attr("order", i)
+        book.close()
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        parent = book.get_children()[0]
+        self.assertEqual(titles(parent), expected)
+        self.assertFalse(book.save_needed())
+
+        # With no room between dense orders, the children are renumbered
+        # once.
+        notebook.new_page(parent, "new3", 20)
+        self.assertTrue(len([child for child in parent.get_children()
+                             if child._is_dirty()]) > 100)
+        book.save()
+        notebook.new_page(parent, "new4", 20)
+        self.assertFalse(book.save_needed())
+        orders = [child.get_attr("order") for child in parent.get_children()]
+        self.assertEqual(orders, sorted(orders))
+        book.close()
+
+    def test_identity_map(self):
+        """Load a node by nodeid without loading its siblings."""
+        struct = [["a", ["a1"], ["a2"], ["a3"]],
+                  ["b", ["b1"], ["b2",
+                                 ["c1"], ["c2"]]]]
+
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        make_notebook(book, struct)
+        c1id = (book.get_children()[1]
+                .get_children()[1].get_children()[0].get_attr("nodeid"))
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+
+        # Count node reads.
+        reads = []
+        read_node = book._conn.read_node
+
+        def counting_read_node(nodeid, *args, **kargs):
+            reads.append(nodeid)
+            return read_node(nodeid, *args, **kargs)
+        book._conn.read_node = counting_read_node
+
+        # Only the node and its ancestors are loaded.
+        c1 = book.get_node_by_id(c1id)
+        self.assertEqual(c1.get_title(), "c1")
+        self.assertEqual(len(reads), 2)
+        b2 = c1.get_parent()
+        b = b2.get_parent()
+        self.assertEqual([b2.get_title(), b.get_title()], ["b2", "b"])
+        self.assertTrue(b.get_parent() is book)
+        self.assertTrue(book.get_node_by_id(c1id) is c1)
+        self.assertEqual(len(reads), 2)
+
+        # Unreferenced nodes are dropped and read again.
+        del b2, c1
+        gc.collect()
+        self.assertTrue(book._get_loaded_node(c1id) is None)
+        c1 = book.get_node_by_id(c1id)
+        b2 = c1.get_parent()
+        self.assertEqual(len(reads), 4)
+
+        # Loading siblings keeps one node per nodeid.
+        self.assertTrue(b.get_children()[1] is b2)
+        self.assertTrue(b2.get_children()[0] is c1)
+        self.assertEqual(book.get_nodes_by_id([c1id, "unknown"]),
+                         [c1, None])
+
+        book.close()
+
+    def test_outside_move(self):
+        """Reattach a loaded node moved on disk to its new parent."""
+        struct = [["a", ["a1"], ["a2"]],
+                  ["b", ["b1"]]]
+
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        make_notebook(book, struct)
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        a, b = book.get_children()[:2]
+        a1, a2 = a.get_children()
+        self.assertEqual([c.get_title() for c in b.get_children()], ["b1"])
+
+        # Move a1 outside of KeepNote and reload the new parent first.
+        os.rename(a1.get_path(), os.path.join(b.get_path(), "a1"))
+        book._conn.get_stat_cache().clear()
+        b._reload()
+        a._reload()
+
+        self.assertTrue(a1._valid)
+        self.assertTrue(a1.get_parent() is b)
+        self.assertEqual(a1.get_attr("parentids"), [b.get_attr("nodeid")])
+        self.assertTrue(a1 in b.get_children())
+        self.assertEqual(a.get_children(), [a2])
+        self.assertEqual(a2._index, 0)
+        self.assertEqual(a1.get_path(),
+                         os.path.join(b.get_path(), "a1"))
+        self.assertTrue(book.get_node_by_id(a1.get_attr("nodeid")) is a1)
+
+        book.close()
+
+    def test_batch_changes(self):
+        """Changes made in a batch are delivered once, coalesced."""
+        struct = [["a", ["a1"], ["a2"], ["a3"]],
+                  ["b", ["b1"], ["b2",
+                                 ["c1"], ["c2"]]]]
+
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        make_notebook(book, struct)
+        a, b = book.get_children()[:2]
+        a1, a2, a3 = a.get_children()
+        b1, b2 = b.get_children()
+        c1, c2 = b2.get_children()
+
+        notifications = []
+
+        def on_changed(actions):
+            notifications.append(actions)
+        book.node_changed.add(on_changed)
+
+        # Moves become changes of the parents, duplicates are merged.
+        with book.batch_changes():
+            c1.notify_change(False)
+            a1.move(b)
+            c1.notify_change(False)
+            a2.move(b)
+            a3.notify_change(False)
+        self.assertEqual(notifications,
+                         [[("changed-recurse", a), ("changed-recurse", b)]])
+        del notifications[:]
+        with book.batch_changes():
+            a3.notify_change(False)
+            c1.notify_change(False)
+            a3.notify_change(False)
+        self.assertEqual(notifications,
+                         [[("changed", a3), ("changed", c1)]])
+
+        # Changes within recursively changed nodes are dropped.
+        del notifications[:]
+        book.begin_changes()
+        c1.notify_change(False)
+        with book.batch_changes():
+            c2.duplicate(b2)
+            b2.notify_change(False)
+        self.assertEqual(notifications, [])
+        b.notify_change(False)
+        b2.move(a)
+        book.end_changes()
+        self.assertEqual(notifications,
+                         [[("changed-recurse", b), ("changed-recurse", a)]])
+
+        # Deleted nodes are dropped.
+        del notifications[:]
+        with book.batch_changes():
+            b1.notify_change(False)
+            b1.delete()
+            a3.notify_change(False)
+        self.assertEqual(notifications,
+                         [[("changed-recurse", b), ("changed", a3)]])
+
+        # Unbatched changes are delivered as they occur.
+        del notifications[:]
+        a3.notify_change(False)
+        self.assertEqual(notifications, [[("changed", a3)]])
+
+        # Debounced changes are delivered after the delay.
+        timers = []
+        book.node_changed.set_debounce(
+            0.5, lambda delay, func: timers.append(func))
+        del notifications[:]
+        a3.notify_change(False)
+        c1.notify_change(False)
+        self.assertEqual(notifications, [])
+        self.assertEqual(len(timers), 1)
+        book.node_changed._last -= 1.0
+        self.assertFalse(timers.pop()())
+        self.assertEqual(notifications,
+                         [[("changed", a3), ("changed", c1)]])
+        book.node_changed.set_debounce(0)
+
+        book.close()
+
+    def test_iter_subtree(self):
+        """Walk a notebook without keeping its nodes."""
+        struct = [["a", ["a1"], ["a2"], ["a3"]],
+                  ["b", ["b1"], ["b2",
+                                 ["c1"], ["c2"]]]]
+
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        make_notebook(book, struct)
+        book.get_children()[0].move(book, 2)
+
+        def walk(node, order):
+            if order == "pre":
+                yield node.get_title()
+            for child in node.get_children():
+                for title in walk(child, order):
+                    yield title
+            if order == "post":
+                yield node.get_title()
+        expected = dict((order, list(walk(book, order)))
+                        for order in ("pre", "post"))
+        book.close()
+
+        for order in ("pre", "post"):
+            for prefetch in (False, True):
+                book = notebook.NoteBook()
+                book.load(_datapath + "/n1")
+
+                # Only the nodes on the current path are kept, besides
+                # the notebook's children, which are loaded with it.
+                nroot = len(book.get_children()) + 1
+                titles = []
+                depths = []
+                for node in book.iter_subtree(order=order,
+                                              prefetch=prefetch):
+                    titles.append(node.get_title())
+                    depth = 0
+                    while node.get_parent():
+                        depth += 1
+                        node = node.get_parent()
+                    del node
+                    gc.collect()
+                    depths.append((len(book._nodes) - nroot, depth))
+                self.assertEqual(titles, expected[order])
+                self.assertTrue(all(nloaded <= depth
+                                    for nloaded, depth in depths))
+                self.assertTrue(all(child._children is None
+                                    for child in book.get_children()))
+                book.close()
+
+        # Loaded nodes, including unsaved ones, are walked.
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        a = [child for child in book.get_children()
+             if child.get_title() == "a"][0]
+        new = notebook.new_page(a, "a0", 0)
+        titles = [node.get_title() for node in book.iter_subtree(a)]
+        self.assertEqual(titles, ["a", "a0", "a1", "a2", "a3"])
+        self.assertTrue(list(book.iter_subtree(a))[1] is new)
+        book.close()
+
+    def test_compact_nodes(self):
+        """Loaded nodes share their attr keys and common values."""
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        parent = notebook.new_page(book, "parent")
+        for i in range(10):
+            notebook.new_page(parent, "c%d" % i)
+        parent.get_children()[0].set_attr("icon", u"note.png")
+        parent.get_children()[1].set_attr("icon", u"note.png")
+        book.close()
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        parent = book.get_children()[0]
+        children = parent.get_children()
+        self.assertFalse(hasattr(children[0], "__dict__"))
+
+        def get_ids(values):
+            return set(id(value) for value in values)
+        for child in children[1:]:
+            self.assertEqual(get_ids(child._attr.keys()) -
+                             get_ids(children[0]._attr.keys()), set())
+        self.assertEqual(
+            len(get_ids(child.get_attr("content_type")
+                        for child in children)), 1)
+        self.assertTrue(children[0].get_attr("icon") is
+                        children[1].get_attr("icon"))
+        self.assertTrue(children[0].get_attr("parentids")[0] is
+                        parent.get_attr("nodeid"))
+        book.close()
+
+    def _test_node_memory(self):
+        """Benchmark the memory used by loaded nodes."""
+        nchildren = 100
+        make_clean_dir(_datapath)
+        book = notebook.NoteBook()
+        book.create(_datapath + "/n1")
+        for i in range(nchildren):
+            parent = notebook.new_page(book, "p%d" % i)
+            for j in range(nchildren):
+                notebook.new_page(parent, "c%d" % j)
+        book.close()
+
+        def get_size(obj, seen):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            size = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                for key, value in obj.iteritems():
+                    size += get_size(key, seen) + get_size(value, seen)
+            elif isinstance(obj, (list, tuple)):
+                for value in obj:
+                    size += get_size(value, seen)
+            return size
+
+        book = notebook.NoteBook()
+        book.load(_datapath + "/n1")
+        nodes = list(book.iter_subtree())
+        for node in nodes:
+            node.get_children()
+        nodes = list(book.iter_subtree())
+
+        seen = set()
+        size = 0
+        for node in nodes:
+            size += (sys.getsizeof(node) +
+                     get_size(getattr(node, "__dict__", None), seen) +
+                     get_size(node._attr, seen) +
+                     get_size(node._children, seen))
+        print
+        print 'nodes', len(nodes)
+        print 'bytes per node', size // len(nodes)
+        book.close()
+
     def test_orphans(self):
 
         clean_dir(_datapath + "/conn")
@@ -1,6 +1,8 @@
 import os
+import time
 import unittest
 
+import keepnote
 from keepnote import safefile
 
 from . import make_clean_dir, TMP_DIR
@@ -88,3 +90,108 @@ class TestCaseSafeFile (unittest.TestCase):
         self.assertEquals(lines, [u"\u2022 hello\n",
                                   u"there\n",
                                   u"again\n"])
+
+    def test_tempfile_location(self):
+        """tempfile is created next to the file"""
+
+        filename = _tmpdir + "/safefile"
+
+        out = safefile.open(filename, "w")
+        self.assertEquals(os.path.dirname(out.get_tempfile()),
+                          os.path.abspath(_tmpdir))
+        out.close()
+
+    def test_durability(self):
+        """test fsyncs of each durability level"""
+
+        filename = _tmpdir + "/safefile"
+        fsyncs = []
+        fsync = os.fsync
+        interval = safefile.RELAXED_SYNC_INTERVAL
+
+        def counting_fsync(fd):
+            fsyncs.append(fd)
+            fsync(fd)
+
+        # flush files of earlier tests and prevent periodic syncs
+        safefile.sync()
+        safefile.RELAXED_SYNC_INTERVAL = 1e9
+        os.fsync = counting_fsync
+
+        try:
+            def write(durability):
+                del fsyncs[:]
+                out = safefile.open(filename, "w", durability=durability)
+                out.write(str(durability))
+                out.close()
+                self.assertEquals(open(filename).read(), str(durability))
+                return len(fsyncs)
+
+            # file and directory
+            self.assertEquals(write("strict"), 2)
+
+            # file only
+            self.assertEquals(write("default"), 1)
+
+            # nothing until sync()
+            self.assertEquals(write("relaxed"), 0)
+            safefile.sync()
+            self.assertEquals(len(fsyncs), 2)
+
+            # default level
+            safefile.set_durability("relaxed")
+            self.assertEquals(write(None), 0)
+            safefile.set_durability("default")
+            self.assertEquals(write(None), 1)
+        finally:
+            os.fsync = fsync
+            safefile.sync()
+            safefile.RELAXED_SYNC_INTERVAL = interval
+            safefile.set_durability("default")
+
+        self.assertRaises(ValueError, safefile.open, filename, "w",
+                          durability="sometimes")
+
+    def test_relaxed_sync(self):
+        """test background syncs of relaxed files"""
+
+        filename = os.path.abspath(_tmpdir + "/safefile")
+        interval = safefile.RELAXED_SYNC_INTERVAL
+        safefile.RELAXED_SYNC_INTERVAL = .05
+
+        try:
+            out = safefile.open(filename, "w", durability="relaxed")
+            out.write("relaxed")
+            out.close()
+            self.assertTrue(filename in safefile._unsynced)
+
+            # the file is synced without another write
+            for i in range(100):
+                if filename not in safefile._unsynced:
+                    break
+                time.sleep(.05)
+            self.assertFalse(filename in safefile._unsynced)
+            self.assertTrue(safefile._sync_timer is None)
+        finally:
+            safefile.RELAXED_SYNC_INTERVAL = interval
+
+    def test_app_durability(self):
+        """test the durability preference of the application"""
+
+        app = keepnote.KeepNote(pref_dir=_tmpdir + "/pref")
+        app.init()
+        self.assertEquals(safefile.get_durability(), "default")
+
+        try:
+            app.pref.set("durability", "strict")
+            app.save_preferences()
+            app = keepnote.KeepNote(pref_dir=_tmpdir + "/pref")
+            app.init()
+            self.assertEquals(safefile.get_durability(), "strict")
+
+            # unknown levels fall back to the default
+            app.pref.set("durability", "sometimes")
+            app.load_preferences()
+            self.assertEquals(safefile.get_durability(), "default")
+        finally:
+            safefile.set_durability("default")